@@ -0,0 +1,33 @@
+import argparse
+import json
+import timeit
+from typing import Any, Callable
+
+from x2webrtc import models
+
+
+def _measure(name: str, func: Callable[[Any], Any], data: Any, number: int) -> float:
+    sec = min(timeit.repeat(lambda: func(data), number=number, repeat=3))
+    print("{}: {:.2f} usec/message".format(name, sec / number * 1e6))
+    return sec
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="compare the message decoder against the dacite-based one")
+    parser.add_argument("-n", "--number", type=int, default=10000, help="number of messages to decode")
+    parser.add_argument("--events", type=int, default=1, help="number of mouse moves in a message")
+    args = parser.parse_args()
+
+    events = [models.MouseMoveEvent(i, i) for i in range(args.events)]
+    events.append(models.MouseButtonEvent(models.MouseButtonKind.LEFT_BUTTON, models.ButtonEventKind.BUTTON_DOWN))
+    data = json.loads(models.to_json(models.InputReport(events)))
+    assert models.from_dict(data) == models._from_dict_dacite(data)
+
+    print("decode a message of {} events ({} times)".format(len(events), args.number))
+    dacite_sec = _measure("dacite", models._from_dict_dacite, data, args.number)
+    fast_sec = _measure("from_dict", models.from_dict, data, args.number)
+    print("DONE.\nspeedup: {:.1f}x".format(dacite_sec / fast_sec))
+
+
+if __name__ == "__main__":
+    main()
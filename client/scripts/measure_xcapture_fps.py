@@ -1,6 +1,7 @@
 import time
 import argparse
 
+from x2webrtc.capture_backend import CAPTURE_BACKEND_CHOICES
 from x2webrtc.screen_capture import Display
 
 
@@ -14,21 +15,28 @@ def main() -> None:
     parser.add_argument(
         "--display", type=str, help="display_name of the X server to connect to (e.g., hostname:1, :1.)"
     )
+    parser.add_argument(
+        "--capture-backend", type=str, choices=CAPTURE_BACKEND_CHOICES, default="auto", help="method to grab the screen"
+    )
     args = parser.parse_args()
 
-    display = Display(args.display)
+    display = Display(args.display, args.capture_backend)
     screen = display.screen()
-    window = screen.root_window
+    window = display.bind(screen.root_window, "capture")
 
     duration = float(args.duration)
-    print("start performance measurement of screen capture (duration={} sec.)".format(duration))
+    print(
+        "start performance measurement of screen capture (duration={} sec., backend={})".format(
+            duration, display.capture_backend.name
+        )
+    )
 
     stime = time.time()
     etime = stime + duration
     frames = 0
 
     while time.time() < etime:
-        window.capture()
+        window.capture_bgrx()
         frames += 1
 
     print("DONE.\nfps: {} (duration={} sec.)".format(frames / duration, duration))
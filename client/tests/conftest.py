@@ -0,0 +1,39 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List
+
+import pytest
+
+
+class FakeChannel:
+    """A data channel that records the messages sent over it."""
+
+    def __init__(self) -> None:
+        self.readyState = "open"
+        self.bufferedAmount = 0
+        self.sent: List[bytes] = []
+        self._handlers: Dict[str, Callable[[], None]] = {}
+
+    def on(self, name: str, handler: Callable[[], None]) -> None:
+        self._handlers[name] = handler
+
+    def send(self, data: bytes) -> None:
+        self.sent.append(data)
+
+
+async def _wait_for(predicate: Callable[[], Any]) -> None:
+    for _ in range(100):
+        if predicate():
+            return
+        await asyncio.sleep(0.01)
+    raise AssertionError("timed out")
+
+
+@pytest.fixture
+def new_channel() -> Callable[[], FakeChannel]:
+    return FakeChannel
+
+
+@pytest.fixture
+def wait_for() -> Callable[[Callable[[], Any]], Awaitable[None]]:
+    """Wait for a condition to hold on the event loop, while worker threads make progress."""
+    return _wait_for
@@ -0,0 +1,44 @@
+from x2webrtc.adaptation import AdaptationController, LinkObservation
+from x2webrtc.config import AdaptationConfig, AdaptationLevel
+from x2webrtc.track import ScreenCaptureTrack
+
+
+def _create_controller() -> AdaptationController:
+    config = AdaptationConfig(
+        [AdaptationLevel(30, 1.0, 1000000), AdaptationLevel(15, 0.5, 300000)], degrade_after=2, upgrade_after=3
+    )
+    return AdaptationController(config, ScreenCaptureTrack())
+
+
+def test_degrade_and_upgrade() -> None:
+    controller = _create_controller()
+    lossy = LinkObservation(0.2, None, None)
+    clean = LinkObservation(0.0, None, 2000000)
+
+    assert not controller.observe(lossy)
+    # NOTE: a single clean observation resets the hysteresis counter
+    assert not controller.observe(clean)
+    assert not controller.observe(lossy)
+    assert controller.observe(lossy)
+    assert controller.level.fps == 15
+
+    # NOTE: there is no level below the last one
+    assert not controller.observe(lossy)
+    assert not controller.observe(lossy)
+
+    assert not controller.observe(clean)
+    assert not controller.observe(clean)
+    assert controller.observe(clean)
+    assert controller.level.fps == 30
+
+
+def test_degrade_by_estimated_bitrate() -> None:
+    controller = _create_controller()
+    narrow = LinkObservation(0.0, 0.05, 500000)
+    assert not controller.observe(narrow)
+    assert controller.observe(narrow)
+    assert controller.level.scale == 0.5
+
+    # NOTE: the estimate is still too low to go back to the better level
+    for _ in range(5):
+        assert not controller.observe(narrow)
@@ -0,0 +1,41 @@
+import asyncio
+import shutil
+
+import numpy
+import pytest
+
+from x2webrtc.bench import MARKER_CELL, BenchOptions, decode_marker, encode_marker, run_bench
+
+
+def _render_marker(seq: int, width: int = 640, height: int = 32) -> numpy.ndarray:
+    luma = numpy.zeros((height, width), dtype=numpy.uint8)
+    for i, cell in enumerate(encode_marker(seq)):
+        luma[:MARKER_CELL, i * MARKER_CELL : (i + 1) * MARKER_CELL] = 235 if cell == 1 else 16
+    return luma
+
+
+@pytest.mark.parametrize("seq", [0, 1, 0x1234, 0xFFFF])
+def test_marker_roundtrip(seq: int) -> None:
+    assert decode_marker(_render_marker(seq)) == seq
+
+
+def test_marker_wraps() -> None:
+    assert decode_marker(_render_marker(0x10005)) == 5
+
+
+def test_marker_not_found() -> None:
+    assert decode_marker(numpy.zeros((32, 640), dtype=numpy.uint8)) is None
+    assert decode_marker(numpy.zeros((8, 8), dtype=numpy.uint8)) is None
+
+
+@pytest.mark.skipif(shutil.which("Xvfb") is None, reason="Xvfb is not installed")
+def test_run_bench() -> None:
+    loop = asyncio.new_event_loop()
+    try:
+        result = loop.run_until_complete(run_bench(BenchOptions(width=320, height=240, duration=2.0, warmup=1.0)))
+    finally:
+        loop.close()
+
+    assert result.capture_fps > 0
+    assert result.receive_fps > 0
+    assert result.latency_max_ms >= result.latency_p50_ms
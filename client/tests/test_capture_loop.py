@@ -0,0 +1,246 @@
+import asyncio
+import socket
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy
+import pytest
+
+from x2webrtc.capture_loop import (
+    DamageGrabber,
+    Grabber,
+    StaticFrameFilter,
+    XEventReader,
+    forward_screen_async,
+    forward_screen_pipelined,
+)
+from x2webrtc.screen_capture import Rectangle
+from x2webrtc.track import ScreenCaptureTrack
+
+
+class _CountingGrabber(Grabber):
+    def __init__(self) -> None:
+        self._bufs: Dict[int, numpy.ndarray] = {}
+        self.count = 0
+
+    def grab(self, slot: int = 0) -> Optional[numpy.ndarray]:
+        self.count += 1
+        if self.count % 2 == 0:
+            return None
+        buf = self._bufs.setdefault(slot, numpy.zeros((8, 16, 4), dtype=numpy.uint8))
+        buf[...] = self.count % 256
+        return buf
+
+
+def test_forward_screen_pipelined() -> None:
+    grabber = _CountingGrabber()
+    track = ScreenCaptureTrack(fps=200)
+    track.active = True
+    quit = threading.Event()
+
+    thread = threading.Thread(target=forward_screen_pipelined, args=(grabber, track, quit))
+    thread.start()
+    time.sleep(0.2)
+    quit.set()
+    thread.join()
+
+    assert grabber.count > 2
+    assert track.stats.published > 0
+    # NOTE: unchanged images (None) are never handed to the track
+    assert track.stats.published <= (grabber.count + 1) // 2
+
+
+class _CheckingSink:
+    """Convert slowly, and check that the image is not overwritten meanwhile."""
+
+    def __init__(self) -> None:
+        self.converted = 0
+        self.overwritten = 0
+        self.convert_yuv: List[bool] = []
+
+    def wait_for_next_put(self) -> None:
+        time.sleep(0.002)
+
+    def put_frame(self, img: numpy.ndarray, format: str = "rgb24", convert_yuv: bool = False) -> None:
+        value = img[0, 0, 0]
+        time.sleep(0.02)
+        if (img != value).any():
+            self.overwritten += 1
+        self.converted += 1
+        self.convert_yuv.append(convert_yuv)
+
+
+def test_forward_screen_pipelined_owns_slots() -> None:
+    grabber = _CountingGrabber()
+    sink = _CheckingSink()
+    quit = threading.Event()
+
+    thread = threading.Thread(target=forward_screen_pipelined, args=(grabber, sink, quit))
+    thread.start()
+    time.sleep(0.2)
+    quit.set()
+    thread.join()
+
+    # NOTE: the capture runs ahead of the slow conversion without copying images or overwriting them
+    assert grabber.count > sink.converted * 2 > 0
+    assert sink.overwritten == 0
+    assert all(sink.convert_yuv)
+    assert len(grabber._bufs) <= 4
+
+
+class _FakeDamageTracker:
+    def __init__(self) -> None:
+        self.size = (8, 4)
+        self.damaged: List[Rectangle] = []
+
+    def poll(self) -> List[Rectangle]:
+        damaged, self.damaged = self.damaged, []
+        return damaged
+
+    def close(self) -> None:
+        pass
+
+
+class _FakeDamageWindow:
+    def __init__(self) -> None:
+        self.capture_rect = Rectangle(0, 0, 8, 4)
+        self.screen = numpy.zeros((4, 8, 4), dtype=numpy.uint8)
+        self.tracker = _FakeDamageTracker()
+
+    def track_damage(self) -> Any:
+        return self.tracker
+
+    def capture_bgrx(self, rect: Optional[Rectangle] = None, slot: int = 0) -> numpy.ndarray:
+        r = rect or self.capture_rect
+        return self.screen[r.y : r.y + r.height, r.x : r.x + r.width]
+
+    def draw(self, rect: Rectangle, value: int) -> None:
+        self.screen[rect.y : rect.y + rect.height, rect.x : rect.x + rect.width] = value
+        self.tracker.damaged.append(rect)
+
+
+def test_damage_grabber_slots() -> None:
+    window = _FakeDamageWindow()
+    grabber = DamageGrabber(window)  # type: ignore
+    a = grabber.grab(0)
+    b = grabber.grab(1)
+    assert a is not None and b is not None and a is not b
+    assert grabber.grab(0) is None
+
+    # NOTE: a change captured into slot 0 is still applied to slot 1 at its next grab
+    window.draw(Rectangle(0, 0, 2, 2), 1)
+    assert grabber.grab(0) is a
+    window.draw(Rectangle(4, 2, 2, 2), 2)
+    assert grabber.grab(1) is b
+    numpy.testing.assert_array_equal(b, window.screen)
+    assert grabber.grab(0) is a
+    numpy.testing.assert_array_equal(a, window.screen)
+    assert grabber.grab(0) is None
+    assert grabber.grab(1) is None
+
+
+@pytest.mark.asyncio
+async def test_forward_screen_async() -> None:
+    grabber = _CountingGrabber()
+    track = ScreenCaptureTrack(fps=200)
+    track.active = True
+
+    task = asyncio.ensure_future(forward_screen_async(grabber, track))
+    await asyncio.sleep(0.2)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert grabber.count > 2
+    assert 0 < track.stats.published <= (grabber.count + 1) // 2
+    # NOTE: no capture runs after the task has been cancelled
+    count = grabber.count
+    await asyncio.sleep(0.05)
+    assert grabber.count == count
+
+
+class _SlowGrabber(Grabber):
+    def __init__(self) -> None:
+        self.running = False
+
+    def grab(self, slot: int = 0) -> Optional[numpy.ndarray]:
+        self.running = True
+        time.sleep(0.1)
+        self.running = False
+        return None
+
+
+@pytest.mark.asyncio
+async def test_forward_screen_async_cancel_waits_for_capture() -> None:
+    grabber = _SlowGrabber()
+    track = ScreenCaptureTrack(fps=200)
+
+    task = asyncio.ensure_future(forward_screen_async(grabber, track))
+    await asyncio.sleep(0.05)
+    assert grabber.running
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert not grabber.running
+
+
+class _FakeWindow:
+    def __init__(self) -> None:
+        self.server, self.client = socket.socketpair()
+        self.busy = False
+        self.received = b""
+
+    def fileno(self) -> int:
+        return self.client.fileno()
+
+    def try_process_events(self) -> bool:
+        if self.busy:
+            return False
+        self.received += self.client.recv(1024)
+        return True
+
+
+@pytest.mark.asyncio
+async def test_x_event_reader() -> None:
+    window = _FakeWindow()
+    events = XEventReader(window)  # type: ignore
+    try:
+        window.server.send(b"a")
+        await asyncio.sleep(0.01)
+        assert window.received == b"a"
+
+        # NOTE: the socket is not watched while the connection is in use, and is watched again on `resume`
+        window.busy = True
+        window.server.send(b"b")
+        await asyncio.sleep(0.01)
+        window.busy = False
+        await asyncio.sleep(0.01)
+        assert window.received == b"a"
+        events.resume()
+        await asyncio.sleep(0.01)
+        assert window.received == b"ab"
+    finally:
+        events.close()
+        window.server.close()
+        window.client.close()
+
+
+def test_static_frame_filter() -> None:
+    static_filter = StaticFrameFilter(refresh_interval=0.05, stride=4)
+    img = numpy.zeros((16, 8, 4), dtype=numpy.uint8)
+
+    assert static_filter.filter(img) is img
+    assert static_filter.filter(img) is None
+    assert static_filter.filter(None) is None
+
+    # NOTE: a change in a single row is noticed within `stride` frames
+    img[5, 3] = 255
+    results = [static_filter.filter(img) for _ in range(4)]
+    assert sum(r is not None for r in results) == 1
+
+    time.sleep(0.06)
+    refreshed = static_filter.filter(None)
+    assert refreshed is not None
+    assert refreshed[5, 3, 0] == 255
+    assert static_filter.filter(img) is None
@@ -4,7 +4,16 @@ import tempfile
 from unittest import mock
 
 import x2webrtc.config
-from x2webrtc.config import CONFIG_ENVKEY, Config, IceServer, load_config, load_config_from_file
+from x2webrtc.config import (
+    CONFIG_ENVKEY,
+    AdaptationConfig,
+    AdaptationLevel,
+    Config,
+    IceServer,
+    load_config,
+    load_config_from_dict,
+    load_config_from_file,
+)
 
 BASE_DIR = pathlib.Path(__file__).resolve().parent
 
@@ -64,3 +73,16 @@ def test_load_config() -> None:
             # NOTE(igarashi): load_config() would use config2.yaml
             config = load_config()
             assert config.signaling_plugin == pathlib.Path("/hoge/fuga.py")
+
+
+def test_load_adaptation_config() -> None:
+    config = load_config_from_dict({}, BASE_DIR)
+    assert config.get_adaptation_config() == AdaptationConfig.get_default()
+
+    config = load_config_from_dict(
+        {"adaptation": {"levels": [{"fps": 30, "scale": 1.0, "bitrate": 1000000}], "upgrade_after": 3}}, BASE_DIR
+    )
+    adaptation = config.get_adaptation_config()
+    assert adaptation.levels == [AdaptationLevel(30, 1.0, 1000000)]
+    assert adaptation.upgrade_after == 3
+    assert adaptation.degrade_after == 2
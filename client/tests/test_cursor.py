@@ -0,0 +1,112 @@
+import asyncio
+import io
+import struct
+from typing import Any, Awaitable, Callable, List, Optional, Tuple
+
+import numpy
+import pytest
+from PIL import Image
+
+from x2webrtc.cursor import CursorStream, encode_position, encode_shape
+from x2webrtc.screen_capture import CursorImage
+
+
+def _image(serial: int) -> CursorImage:
+    pixels = numpy.zeros((4, 2, 4), dtype=numpy.uint8)
+    pixels[..., 3] = 255
+    return CursorImage(serial, 1, 2, pixels)
+
+
+def test_encode_shape() -> None:
+    data = encode_shape(_image(7))
+    assert struct.unpack_from("<BBxxIHHHH", data) == (2, 0, 7, 2, 4, 1, 2)
+    png = Image.open(io.BytesIO(data[16:]))
+    assert (png.mode, png.size) == ("RGBA", (2, 4))
+
+
+def test_encode_position() -> None:
+    assert struct.unpack("<BBHIhh", encode_position(3, 7, -5, 10)) == (2, 1, 3, 7, -5, 10)
+    assert struct.unpack("<BBHIhh", encode_position(0x10001, 7, 100000, -100000))[2:] == (1, 7, 0x7FFF, -0x8000)
+
+
+class _FakeTracker:
+    def __init__(self) -> None:
+        self.serial: Optional[int] = None
+        self.position = (0, 0)
+        self.fetched = 0
+
+    def poll(self) -> Tuple[Optional[int], int, int]:
+        return (self.serial,) + self.position
+
+    def get_image(self) -> CursorImage:
+        self.fetched += 1
+        self.serial = self.serial or 1
+        return _image(self.serial)
+
+    def close(self) -> None:
+        pass
+
+
+class _FakeWindow:
+    def __init__(self) -> None:
+        self.tracker = _FakeTracker()
+
+    def track_cursor(self) -> _FakeTracker:
+        return self.tracker
+
+
+def _positions(channel: Any) -> List[Tuple[int, int, int, int]]:
+    return [struct.unpack("<BBHIhh", data)[2:] for data in channel.sent]
+
+
+def _shapes(channel: Any) -> List[int]:
+    return [struct.unpack_from("<BBxxI", data)[2] for data in channel.sent]
+
+
+@pytest.mark.asyncio
+async def test_cursor_stream(new_channel: Callable[[], Any], wait_for: Callable[..., Awaitable[None]]) -> None:
+    window = _FakeWindow()
+    stream = CursorStream(window, rate=200)  # type: ignore
+    channel, position_channel = new_channel(), new_channel()
+    try:
+        stream.attach(channel, position_channel)  # type: ignore
+        await wait_for(lambda: len(position_channel.sent) > 0)
+        assert _shapes(channel) == [1]
+        assert _positions(position_channel)[0] == (1, 1, 0, 0)
+
+        window.tracker.position = (3, 4)
+        await wait_for(lambda: _positions(position_channel)[-1][1:] == (1, 3, 4))
+
+        # NOTE: a shape seen before is not fetched again
+        window.tracker.serial = 2
+        await wait_for(lambda: _positions(position_channel)[-1][1] == 2)
+        window.tracker.serial = 1
+        await wait_for(lambda: _positions(position_channel)[-1][1] == 1)
+        assert _shapes(channel) == [1, 2]
+        assert window.tracker.fetched == 2
+
+        # NOTE: positions are numbered, and an unchanged one is sent again only now and then, in case it was lost
+        seqs = [position[0] for position in _positions(position_channel)]
+        assert seqs == list(range(1, len(seqs) + 1))
+        count = len(position_channel.sent)
+        await asyncio.sleep(0.1)
+        assert len(position_channel.sent) <= count + 1
+    finally:
+        stream.close()
+
+
+@pytest.mark.asyncio
+async def test_cursor_stream_video_scale(
+    new_channel: Callable[[], Any], wait_for: Callable[..., Awaitable[None]]
+) -> None:
+    window = _FakeWindow()
+    window.tracker.position = (30, 41)
+    # NOTE: positions are sent in pixels of the video, which is half the size of the capture
+    stream = CursorStream(window, rate=200, video_scale=lambda: (0.5, 0.5))  # type: ignore
+    channel, position_channel = new_channel(), new_channel()
+    try:
+        stream.attach(channel, position_channel)  # type: ignore
+        await wait_for(lambda: len(position_channel.sent) > 0)
+        assert _positions(position_channel)[0][2:] == (15, 20)
+    finally:
+        stream.close()
@@ -0,0 +1,170 @@
+import threading
+import time
+from typing import Any, List, Tuple
+
+import Xlib.XK
+from Xlib import X
+
+from x2webrtc import models
+from x2webrtc.input import InputDispatcher, InputHandler, coalesce_motion
+from x2webrtc.screen_capture import Rectangle
+
+
+def test_coalesce_motion() -> None:
+    assert coalesce_motion([]) == []
+
+    down = models.MouseButtonEvent(models.MouseButtonKind.LEFT_BUTTON, models.ButtonEventKind.BUTTON_DOWN)
+    up = models.MouseButtonEvent(models.MouseButtonKind.LEFT_BUTTON, models.ButtonEventKind.BUTTON_UP)
+    events = [
+        models.MouseMoveEvent(0, 0),
+        models.MouseMoveEvent(1, 1),
+        down,
+        models.MouseMoveEvent(2, 2),
+        models.MouseMoveEvent(3, 3),
+        models.MouseMoveEvent(4, 4),
+        up,
+        models.MouseMoveEvent(5, 5),
+    ]
+    assert coalesce_motion(events) == [
+        models.MouseMoveEvent(1, 1),
+        down,
+        models.MouseMoveEvent(4, 4),
+        up,
+        models.MouseMoveEvent(5, 5),
+    ]
+
+
+class _BlockingHandler(InputHandler):
+    def __init__(self) -> None:
+        super().__init__()
+        self.unblock = threading.Event()
+        self.reports: List[models.InputReport] = []
+
+    def send(self, message: models.InputReport) -> None:
+        self.unblock.wait()
+        self.reports.append(message)
+
+
+def test_input_dispatcher() -> None:
+    handler = _BlockingHandler()
+    dispatcher = InputDispatcher(handler, queue_size=4)
+
+    def report(*events: models.EventTypes) -> str:
+        return models.to_json(models.InputReport(list(events)))
+
+    down = models.MouseButtonEvent(models.MouseButtonKind.LEFT_BUTTON, models.ButtonEventKind.BUTTON_DOWN)
+    # NOTE: the first report keeps the injector busy while the others are queued
+    dispatcher.put(report(models.MouseMoveEvent(0, 0)))
+    time.sleep(0.05)
+    for i in range(1, 10):
+        dispatcher.put(report(models.MouseMoveEvent(i, i)))
+    dispatcher.put(report(down))
+    dispatcher.put(report(models.MouseMoveEvent(10, 10)))
+    dispatcher.put("invalid")
+
+    handler.unblock.set()
+    dispatcher.close()
+
+    events = [ev for r in handler.reports for ev in r.events]
+    assert events == [models.MouseMoveEvent(0, 0), models.MouseMoveEvent(9, 9), down, models.MouseMoveEvent(10, 10)]
+    assert dispatcher.stats.received == 13
+    assert dispatcher.stats.merged > 0
+    assert dispatcher.stats.max_latency >= dispatcher.stats.mean_latency > 0.0
+    # NOTE: the latency of every valid message is recorded, including the merged ones
+    assert dispatcher.stats._injected == 12
+
+
+def test_input_dispatcher_never_parses_in_put() -> None:
+    handler = _BlockingHandler()
+    dispatcher = InputDispatcher(handler, queue_size=4)
+    parsed_on: List[str] = []
+    parse = dispatcher._parse
+
+    def recording_parse(item: Any) -> Any:
+        parsed_on.append(threading.current_thread().name)
+        return parse(item)
+
+    dispatcher._parse = recording_parse  # type: ignore
+    down = models.MouseButtonEvent(models.MouseButtonKind.LEFT_BUTTON, models.ButtonEventKind.BUTTON_DOWN)
+    dispatcher.put(models.InputReport([models.MouseMoveEvent(0, 0)]))
+    time.sleep(0.05)
+    for i in range(1, 20):
+        dispatcher.put(models.InputReport([models.MouseMoveEvent(i, i)]))
+        if i == 10:
+            dispatcher.put(models.to_json(models.InputReport([down])))
+
+    handler.unblock.set()
+    dispatcher.close()
+
+    assert set(parsed_on) == {"x2webrtc-input"}
+    events = [ev for r in handler.reports for ev in r.events]
+    assert events == [models.MouseMoveEvent(0, 0), models.MouseMoveEvent(10, 10), down, models.MouseMoveEvent(19, 19)]
+    assert dispatcher.stats._injected == 21
+
+
+class _FakeWindow:
+    def __init__(self) -> None:
+        self.geometry = Rectangle(100, 50, 640, 480)
+        self.capture_rect = Rectangle(10, 20, 320, 240)
+        self.inputs: List[Tuple[int, int, int, int]] = []
+
+    def add_event_handler(self, handler: Any) -> None:
+        pass
+
+    def keysym_to_keycode(self, keysym: int) -> int:
+        return 38 if keysym == Xlib.XK.string_to_keysym("a") else 0
+
+    def fake_inputs(self, inputs: List[Tuple[int, int, int, int]]) -> None:
+        self.inputs.extend(inputs)
+
+
+def test_input_handler_send() -> None:
+    window = _FakeWindow()
+    handler = InputHandler()
+    handler.set_target(window)  # type: ignore
+
+    handler.send(
+        models.InputReport(
+            [
+                models.MouseMoveEvent(1, 2),
+                models.KeyEvent("KeyA", models.ButtonEventKind.BUTTON_DOWN),
+                models.KeyEvent("KeyA", models.ButtonEventKind.BUTTON_UP),
+                models.KeyEvent("Unknown", models.ButtonEventKind.BUTTON_DOWN),
+                models.WheelEvent(0, -2),
+                models.WheelEvent(1, 0),
+            ]
+        )
+    )
+    assert window.inputs == [
+        (X.MotionNotify, 0, 111, 72),
+        (X.KeyPress, 38, 0, 0),
+        (X.KeyRelease, 38, 0, 0),
+        (X.ButtonPress, 4, 0, 0),
+        (X.ButtonRelease, 4, 0, 0),
+        (X.ButtonPress, 4, 0, 0),
+        (X.ButtonRelease, 4, 0, 0),
+        (X.ButtonPress, 7, 0, 0),
+        (X.ButtonRelease, 7, 0, 0),
+    ]
+
+
+def test_input_handler_video_scale() -> None:
+    window = _FakeWindow()
+    # NOTE: the video is half the size of the capture region
+    handler = InputHandler(lambda: (0.5, 0.5))
+    handler.set_target(window)  # type: ignore
+
+    handler.send(models.InputReport([models.MouseMoveEvent(1, 2)]))
+    assert window.inputs == [(X.MotionNotify, 0, 112, 74)]
+
+
+def test_input_handler_skips_malformed_event() -> None:
+    window = _FakeWindow()
+    handler = InputHandler()
+    handler.set_target(window)  # type: ignore
+
+    up = models.MouseButtonEvent(models.MouseButtonKind.LEFT_BUTTON, models.ButtonEventKind.BUTTON_UP)
+    broken = models.MouseButtonEvent("unknown", models.ButtonEventKind.BUTTON_DOWN)  # type: ignore
+    handler.send(models.InputReport([broken, up]))
+    # NOTE: only the malformed event is dropped, and the button is still released
+    assert window.inputs == [(X.ButtonRelease, 1, 0, 0)]
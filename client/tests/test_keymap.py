@@ -0,0 +1,35 @@
+import Xlib.X
+import Xlib.XK
+from Xlib.protocol import event
+
+from x2webrtc.keymap import KeycodeTable
+
+
+class _FakeWindow:
+    def __init__(self) -> None:
+        self.keycodes = {Xlib.XK.string_to_keysym("a"): 38, Xlib.XK.string_to_keysym("Return"): 36}
+        self.refreshed = 0
+
+    def keysym_to_keycode(self, keysym: int) -> int:
+        return self.keycodes.get(keysym, 0)
+
+    def refresh_keyboard_mapping(self, ev: event.MappingNotify) -> None:
+        self.refreshed += 1
+
+
+def test_keycode_table() -> None:
+    window = _FakeWindow()
+    table = KeycodeTable(window)  # type: ignore
+    assert table.lookup("KeyA") == 38
+    assert table.lookup("Enter") == 36
+    assert table.lookup("KeyB") is None
+    assert table.lookup("Unknown") is None
+
+    window.keycodes[Xlib.XK.string_to_keysym("b")] = 56
+    ev = event.MappingNotify(request=Xlib.X.MappingKeyboard, first_keycode=56, count=1)
+    table.on_event(ev)
+    assert window.refreshed == 1
+    assert table.lookup("KeyB") == 56
+
+    table.on_event(event.MappingNotify(request=Xlib.X.MappingPointer, first_keycode=0, count=0))
+    assert window.refreshed == 1
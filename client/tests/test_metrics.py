@@ -0,0 +1,66 @@
+import asyncio
+
+from x2webrtc.metrics import MetricsRegistry, serve
+
+
+def test_render() -> None:
+    registry = MetricsRegistry()
+    counter = registry.counter("test_events_total", "events")
+    registry.gauge("test_depth", "depth", lambda: 3)
+    histogram = registry.histogram("test_seconds", "time", buckets=[0.1, 1.0])
+
+    counter.inc()
+    counter.inc(2)
+    histogram.observe(0.05)
+    histogram.observe(0.5)
+    histogram.observe(5.0)
+
+    lines = registry.render().splitlines()
+    assert "# TYPE test_events_total counter" in lines
+    assert "test_events_total 3.0" in lines
+    assert "test_depth 3.0" in lines
+    assert 'test_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 3' in lines
+    assert "test_seconds_count 3" in lines
+
+
+def test_summary() -> None:
+    registry = MetricsRegistry()
+    counter = registry.counter("x2webrtc_events_total", "events")
+    histogram = registry.histogram("x2webrtc_seconds", "time")
+
+    counter.inc(2)
+    histogram.observe(0.002)
+    histogram.observe(0.004)
+    assert registry.summary() == "events_total=+2, seconds=2/3.00ms"
+
+    counter.inc()
+    assert registry.summary() == "events_total=+1, seconds=0/0.00ms"
+
+
+def test_serve() -> None:
+    registry = MetricsRegistry()
+    registry.gauge("test_depth", "depth", lambda: 1)
+
+    async def get(path: str) -> bytes:
+        server = await serve(0, registry=registry)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write("GET {} HTTP/1.0\r\nHost: localhost\r\n\r\n".format(path).encode())
+            ret = await reader.read()
+            writer.close()
+            return ret
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    loop = asyncio.new_event_loop()
+    try:
+        response = loop.run_until_complete(get("/metrics"))
+        assert response.startswith(b"HTTP/1.0 200 OK")
+        assert b"test_depth 1.0" in response
+        assert loop.run_until_complete(get("/")).startswith(b"HTTP/1.0 404")
+    finally:
+        loop.close()
@@ -1,10 +1,21 @@
+import pytest
+
 from x2webrtc.models import (
     ButtonEventKind,
     InputReport,
+    KeyEvent,
     MouseButtonEvent,
     MouseButtonKind,
     MouseMoveEvent,
+    _from_dict_dacite,
+    decode,
+    from_binary,
+    from_binary_motion,
+    from_dict,
     from_json,
+    is_newer_seq,
+    to_binary,
+    to_binary_motion,
     to_json,
 )
 
@@ -18,3 +29,82 @@ def test_convert_convertback():
 
     deserialized = from_json(serialized)
     assert deserialized == data
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        {"kind": "input", "events": []},
+        {"kind": "input", "events": [{"kind": "mouse-move", "x": 1.5, "y": 2}]},
+        {"kind": "input", "events": [{"kind": "mouse-button", "button_kind": "RIGHT", "event_kind": 1}]},
+        {"kind": "input", "events": [{"kind": "key", "code": "KeyA", "event_kind": 0}]},
+        {"kind": "input", "events": [{"kind": "key", "code": 1, "event_kind": 0}]},
+        {"kind": "input", "events": [{"kind": "key", "code": "KeyA", "event_kind": 3}]},
+        {"kind": "input", "events": [{"kind": "wheel", "delta_x": 0, "delta_y": -2.0}]},
+        {"kind": "input", "events": [{"kind": "wheel", "delta_y": 1}]},
+        {"events": []},
+        {"kind": "foo", "events": []},
+        {"kind": 1, "events": []},
+        {"kind": "input"},
+        {"kind": "input", "events": [], "extra": 1},
+        {"kind": "input", "events": {}},
+        {"kind": "input", "events": [1]},
+        {"kind": "input", "events": [{"x": 1, "y": 2}]},
+        {"kind": "input", "events": [{"kind": "foo"}]},
+        {"kind": "input", "events": [{"kind": "mouse-move", "x": 1}]},
+        {"kind": "input", "events": [{"kind": "mouse-move", "x": 1, "y": 2, "z": 3}]},
+        {"kind": "input", "events": [{"kind": "mouse-move", "x": "1", "y": 2}]},
+        {"kind": "input", "events": [{"kind": "mouse-button", "button_kind": "FOO", "event_kind": 0}]},
+        {"kind": "input", "events": [{"kind": "mouse-button", "button_kind": "LEFT", "event_kind": 2}]},
+        [],
+    ],
+)
+def test_from_dict_same_as_dacite(data):
+    try:
+        expected = _from_dict_dacite(data)
+    except Exception as e:
+        with pytest.raises(type(e)) as actual:
+            from_dict(data)
+        assert str(actual.value) == str(e)
+    else:
+        assert from_dict(data) == expected
+
+
+def test_binary_convert_convertback():
+    a = MouseMoveEvent(10, 20)
+    b = MouseButtonEvent(MouseButtonKind.RIGHT_BUTTON, ButtonEventKind.BUTTON_DOWN)
+    c = MouseButtonEvent(MouseButtonKind.RIGHT_BUTTON, ButtonEventKind.BUTTON_UP)
+    data = InputReport([a, b, c])
+    serialized = to_binary(data, timestamp=1234)
+    assert len(serialized) < len(to_json(data)) / 3
+
+    assert from_binary(serialized) == data
+    assert decode(serialized) == data
+    assert decode(to_json(data)) == data
+
+
+def test_binary_unsupported_event():
+    with pytest.raises(RuntimeError):
+        to_binary(InputReport([KeyEvent("KeyA", ButtonEventKind.BUTTON_DOWN)]))
+
+
+def test_binary_invalid():
+    serialized = to_binary(InputReport([MouseMoveEvent(10, 20)]))
+    with pytest.raises(RuntimeError):
+        from_binary(serialized[:-1])
+    with pytest.raises(RuntimeError):
+        from_binary(b"\x02" + serialized[1:])
+    with pytest.raises(RuntimeError):
+        from_binary(serialized[:4] + b"\x05" + serialized[5:])
+
+
+def test_binary_motion():
+    serialized = to_binary_motion(42, MouseMoveEvent(10, 20), timestamp=1234)
+    assert from_binary_motion(serialized) == (42, MouseMoveEvent(10, 20))
+    with pytest.raises(RuntimeError):
+        from_binary_motion(serialized[:-1])
+
+    assert is_newer_seq(43, 42)
+    assert not is_newer_seq(42, 42)
+    assert not is_newer_seq(41, 42)
+    assert is_newer_seq(0, 0xFFFFFFFF)
@@ -0,0 +1,66 @@
+import fractions
+
+import numpy
+import pytest
+from aiortc import RTCRtpCodecParameters
+from av import VideoFrame
+
+from x2webrtc.relay import EncoderRelay, RelayedEncoder
+
+VP8 = RTCRtpCodecParameters(mimeType="video/VP8", clockRate=90000, payloadType=96)
+
+
+def _create_frame(pts: int) -> VideoFrame:
+    frame = VideoFrame.from_ndarray(numpy.full((64, 64, 3), pts % 256, dtype=numpy.uint8), format="rgb24")
+    frame.pts = pts
+    frame.time_base = fractions.Fraction(1, 1000)
+    return frame
+
+
+def test_select_tier() -> None:
+    relay = EncoderRelay([1000000, 500000])
+    assert relay.select_tier(None) == 500000
+    assert relay.select_tier(100000) == 500000
+    assert relay.select_tier(999999) == 500000
+    assert relay.select_tier(5000000) == 1000000
+
+
+def test_relayed_encoder() -> None:
+    relay = EncoderRelay([500000], min_keyframe_interval=0.0)
+    a = RelayedEncoder(relay, VP8)
+    b = RelayedEncoder(relay, VP8)
+
+    frames = [_create_frame(i * 33) for i in range(4)]
+    payloads_a, timestamp_a = a.encode(frames[0])
+    payloads_b, timestamp_b = b.encode(frames[0])
+    assert len(payloads_a) > 0
+    assert payloads_a is payloads_b
+    assert timestamp_a == timestamp_b
+
+    # NOTE: `b` skips frames[1], so it must wait for the next keyframe
+    assert len(a.encode(frames[1])[0]) > 0
+    assert len(b.encode(frames[2])[0]) == 0
+    assert len(a.encode(frames[2])[0]) > 0
+    assert len(b.encode(frames[3])[0]) > 0
+    assert a.encode(frames[3])[0] is b.encode(frames[3])[0]
+
+    # NOTE: frames older than the last encoded one cannot be served anymore
+    assert a.encode(_create_frame(1))[0] == []
+
+
+def test_relayed_encoder_keyframe_interval() -> None:
+    relay = EncoderRelay([500000], min_keyframe_interval=0.1)
+    a = RelayedEncoder(relay, VP8)
+    b = RelayedEncoder(relay, VP8)
+    a.encode(_create_frame(0))
+
+    # NOTE: the keyframe requested by the late peer is delayed, while the others still get delta frames
+    assert len(b.encode(_create_frame(33))[0]) == 0
+    assert len(a.encode(_create_frame(33))[0]) > 0
+    assert len(b.encode(_create_frame(66))[0]) == 0
+    assert len(a.encode(_create_frame(66))[0]) > 0
+    assert len(b.encode(_create_frame(100))[0]) > 0
+    assert len(a.encode(_create_frame(100))[0]) > 0
+
+    with pytest.raises(RuntimeError):
+        a.encode(VideoFrame(64, 64, "rgb24"))
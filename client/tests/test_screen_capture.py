@@ -0,0 +1,65 @@
+from types import SimpleNamespace as NS
+from typing import Any
+
+import numpy
+from Xlib.ext import randr
+
+from x2webrtc.screen_capture import Monitor, Rectangle, Screen, _unpremultiply_bgra, merge_rectangles
+
+
+def test_merge_rectangles() -> None:
+    assert merge_rectangles([], 100, 100) == []
+    assert merge_rectangles([Rectangle(-10, -10, 20, 20)], 100, 100) == [Rectangle(0, 0, 10, 10)]
+    assert merge_rectangles([Rectangle(100, 0, 10, 10)], 100, 100) == []
+
+    sparse = [Rectangle(0, 0, 10, 10), Rectangle(80, 80, 10, 10)]
+    assert merge_rectangles(sparse, 100, 100) == sparse
+
+    dense = [Rectangle(0, 0, 10, 10), Rectangle(10, 0, 10, 10)]
+    assert merge_rectangles(dense, 100, 100) == [Rectangle(0, 0, 20, 10)]
+
+    many = [Rectangle(i * 5, i * 5, 1, 1) for i in range(10)]
+    assert merge_rectangles(many, 100, 100, max_count=4) == [Rectangle(0, 0, 46, 46)]
+
+
+def test_rectangle_intersect() -> None:
+    assert Rectangle(0, 0, 10, 10).intersect(Rectangle(5, 5, 10, 10)) == Rectangle(5, 5, 5, 5)
+    assert Rectangle(0, 0, 10, 10).intersect(Rectangle(10, 0, 10, 10)) is None
+    assert Rectangle(20, 30, 10, 10).intersect(Rectangle(0, 0, 100, 100)) == Rectangle(20, 30, 10, 10)
+
+
+def test_unpremultiply_bgra() -> None:
+    # NOTE: half-transparent red, opaque blue and a fully transparent pixel
+    bgra = numpy.array([[[0, 0, 128, 128], [255, 0, 0, 255], [0, 0, 0, 0]]], dtype=numpy.uint8)
+    rgba = _unpremultiply_bgra(bgra)
+    assert rgba.tolist() == [[[255, 0, 0, 128], [0, 0, 255, 255], [0, 0, 0, 0]]]
+
+
+class _FakeRootWindow:
+    def xrandr_get_screen_resources_current(self) -> Any:
+        return NS(outputs=[1, 2, 3, 4], config_timestamp=0)
+
+    def xrandr_get_output_primary(self) -> Any:
+        return NS(output=2)
+
+
+class _FakeRandrDisplay:
+    def has_extension(self, name: str) -> bool:
+        return name == randr.extname
+
+    def xrandr_get_output_info(self, output: int, timestamp: int) -> Any:
+        # NOTE: output 3 mirrors output 2, and output 4 is disconnected
+        crtcs = {1: 10, 2: 20, 3: 20, 4: 0}
+        connection = randr.Disconnected if output == 4 else randr.Connected
+        return NS(name="OUT-{}".format(output).encode(), crtc=crtcs[output], connection=connection)
+
+    def xrandr_get_crtc_info(self, crtc: int, timestamp: int) -> Any:
+        return NS(x=0 if crtc == 10 else 1920, y=0, width=1920, height=1080)
+
+
+def test_monitors() -> None:
+    screen = Screen(_FakeRandrDisplay(), NS(root=_FakeRootWindow(), width_in_pixels=3840, height_in_pixels=1080))
+    assert screen.monitors() == [
+        Monitor("OUT-1", Rectangle(0, 0, 1920, 1080), False),
+        Monitor("OUT-2", Rectangle(1920, 0, 1920, 1080), True),
+    ]
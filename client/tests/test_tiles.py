@@ -0,0 +1,84 @@
+import io
+from typing import Any, Awaitable, Callable
+
+import numpy
+import pytest
+from PIL import Image
+
+from x2webrtc.tiles import TileStream, changed_tiles, decode_tile, encode_tile
+
+
+def test_changed_tiles() -> None:
+    previous = numpy.zeros((100, 150, 4), dtype=numpy.uint8)
+    current = previous.copy()
+    assert changed_tiles(previous, current, 64) == []
+    assert len(changed_tiles(None, current, 64)) == 2 * 3
+
+    current[70, 140, 1] = 1
+    current[0, 0, 0] = 1
+    assert changed_tiles(previous, current, 64) == [(0, 0), (128, 64)]
+
+
+def test_encode_tile() -> None:
+    img = numpy.zeros((100, 150, 4), dtype=numpy.uint8)
+    img[64:, 128:] = (10, 20, 30, 0)
+
+    size, rect, png = decode_tile(encode_tile(img, 128, 64, 64))
+    assert size == (150, 100)
+    assert rect == (128, 64, 22, 36)
+    tile = numpy.asarray(Image.open(io.BytesIO(png)).convert("RGB"))
+    assert tile.shape == (36, 22, 3)
+    assert (tile == (30, 20, 10)).all()
+
+    with pytest.raises(RuntimeError):
+        decode_tile(b"\x00")
+
+
+@pytest.mark.asyncio
+async def test_tile_stream(new_channel: Callable[[], Any], wait_for: Callable[..., Awaitable[None]]) -> None:
+    stream = TileStream(tile_size=64)
+    channel = new_channel()
+    try:
+        stream.attach(channel)  # type: ignore
+        img = numpy.zeros((100, 150, 4), dtype=numpy.uint8)
+
+        # NOTE: a new channel receives every tile first
+        stream.put_frame(img)
+        await wait_for(lambda: len(channel.sent) == 6)
+
+        img[10, 10] = 255
+        stream.put_frame(img)
+        await wait_for(lambda: len(channel.sent) == 7)
+        assert decode_tile(channel.sent[-1])[1] == (0, 0, 64, 64)
+    finally:
+        stream.close()
+
+
+@pytest.mark.asyncio
+async def test_tile_stream_congested_channel(
+    new_channel: Callable[[], Any], wait_for: Callable[..., Awaitable[None]]
+) -> None:
+    stream = TileStream(tile_size=64)
+    channel, congested = new_channel(), new_channel()
+    try:
+        stream.attach(channel)  # type: ignore
+        stream.attach(congested)  # type: ignore
+        img = numpy.zeros((100, 150, 4), dtype=numpy.uint8)
+        stream.put_frame(img)
+        await wait_for(lambda: len(channel.sent) == len(congested.sent) == 6)
+
+        # NOTE: a congested channel does not hold the others back
+        congested.bufferedAmount = 1 << 30
+        img[10, 10] = 255
+        stream.put_frame(img)
+        await wait_for(lambda: len(channel.sent) == 7)
+        assert len(congested.sent) == 6
+
+        # NOTE: it receives every tile once it has drained
+        congested.bufferedAmount = 0
+        img[90, 140] = 255
+        stream.put_frame(img)
+        await wait_for(lambda: len(channel.sent) == 8 and len(congested.sent) == 12)
+        assert decode_tile(channel.sent[-1])[1] == (128, 64, 22, 36)
+    finally:
+        stream.close()
@@ -0,0 +1,42 @@
+import pytest
+
+from x2webrtc.timer import FrameSchedule, Timer, monotonic_ns
+
+MS = 1000000
+
+
+def test_frame_schedule() -> None:
+    schedule = FrameSchedule(100)
+    assert schedule.next_tick(0) == (0, 0)
+    assert schedule.next_tick(3 * MS) == (10 * MS, 7 * MS)
+
+    # NOTE: a tick that is late within a period does not shift the following deadlines
+    assert schedule.next_tick(25 * MS) == (20 * MS, 0)
+    assert schedule.next_tick(26 * MS) == (30 * MS, 4 * MS)
+    assert schedule.stats.skipped == 0
+
+    # NOTE: ticks more than one period late are skipped
+    assert schedule.next_tick(75 * MS) == (70 * MS, 0)
+    assert schedule.stats.skipped == 3
+    assert schedule.next_tick(75 * MS) == (80 * MS, 5 * MS)
+
+
+def test_frame_schedule_stats() -> None:
+    schedule = FrameSchedule(100)
+    schedule.record(0, 1 * MS)
+    schedule.record(10 * MS, 13 * MS)
+    schedule.record(20 * MS, 19 * MS)
+    stats = schedule.stats
+    assert stats.ticks == 3
+    assert stats.max_lateness == pytest.approx(0.003)
+    assert stats.mean_lateness == pytest.approx(0.004 / 3)
+    assert stats.jitter > 0.0
+
+
+def test_timer() -> None:
+    timer = Timer(200)
+    start = monotonic_ns()
+    for _ in range(11):
+        timer.wait()
+    assert monotonic_ns() - start >= 50 * MS
+    assert timer.stats.ticks == 11
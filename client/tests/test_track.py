@@ -0,0 +1,220 @@
+import asyncio
+import time
+
+import numpy
+import pytest
+from aiortc.mediastreams import MediaStreamError
+
+from x2webrtc.track import BroadcastTrack, LatestFrameBuffer, ScreenCaptureTrack, fit_size
+
+
+def test_latest_frame_buffer() -> None:
+    buf = LatestFrameBuffer(depth=1, latency_budget=10.0)
+    assert buf.take() is None
+
+    a, view_a = buf.acquire(33, 10, "bgr0")
+    assert view_a.shape == (10, 33, 4)
+    assert (a.width, a.height, a.format.name) == (33, 10, "bgr0")
+    buf.publish(a, view_a)
+    b, view_b = buf.acquire(33, 10, "bgr0")
+    assert b is not a
+    buf.publish(b, view_b)
+
+    # NOTE: `a` has been overwritten by `b`, so it can be reused
+    assert buf.stats.overwritten == 1
+    c, view_c = buf.acquire(33, 10, "bgr0")
+    assert c is a
+    assert buf.take() is b
+    assert buf.take() is None
+
+    # NOTE: `b` is recycled once the next frame is taken
+    buf.publish(c, view_c)
+    assert buf.take() is c
+    d, _ = buf.acquire(33, 10, "bgr0")
+    assert d is b
+
+    e, _ = buf.acquire(16, 8, "bgr0")
+    assert (e.width, e.height) == (16, 8)
+
+
+def test_latest_frame_buffer_serves_newest() -> None:
+    buf = LatestFrameBuffer(depth=2, latency_budget=10.0)
+    frames = []
+    for _ in range(2):
+        frame, view = buf.acquire(16, 8, "bgr0")
+        buf.publish(frame, view)
+        frames.append(frame)
+
+    # NOTE: both frames are within the budget, and the older one is skipped
+    assert buf.take() is frames[1]
+    assert buf.stats.skipped == 1
+    assert buf.stats.stale == 0
+    assert buf.stats.overwritten == 0
+    assert buf.take() is None
+
+
+def test_latest_frame_buffer_latency_budget() -> None:
+    buf = LatestFrameBuffer(depth=3, latency_budget=0.05)
+    frames = []
+    for i in range(3):
+        frame, view = buf.acquire(16, 8, "bgr0")
+        buf.publish(frame, view)
+        frames.append(frame)
+        if i == 0:
+            time.sleep(0.1)
+
+    # NOTE: the first frame exceeded the budget when the second one was published
+    assert buf.stats.stale == 1
+    assert buf.queue_depth == 2
+    assert buf.take() is frames[2]
+    assert (buf.stats.stale, buf.stats.skipped) == (1, 1)
+
+    frame, view = buf.acquire(16, 8, "bgr0")
+    buf.publish(frame, view)
+    time.sleep(0.1)
+    # NOTE: the newest frame is always served even if it exceeds the budget
+    assert buf.take() is frame
+
+
+@pytest.mark.asyncio
+async def test_put_frame_bgrx() -> None:
+    track = ScreenCaptureTrack(fps=1000)
+    track.active = True
+
+    img = numpy.zeros((8, 16, 4), dtype=numpy.uint8)
+    img[..., 0] = 10
+    img[..., 1] = 20
+    img[..., 2] = 30
+    track.put_frame(img, "bgr0")
+
+    frame = await track.recv()
+    assert (frame.width, frame.height, frame.format.name) == (16, 8, "bgr0")
+    rgb = frame.to_ndarray(format="rgb24")
+    assert (rgb[..., 0] == 30).all()
+    assert (rgb[..., 2] == 10).all()
+
+    # NOTE: the pipelined capture converts to YUV before the encoder
+    track.put_frame(img, "bgr0", convert_yuv=True)
+    frame = await track.recv()
+    assert (frame.width, frame.height, frame.format.name) == (16, 8, "yuv420p")
+
+
+def test_fit_size() -> None:
+    assert fit_size(1920, 1080, 1280, 720) == (1280, 720)
+    assert fit_size(1920, 1200, 1280, 720) == (1152, 720)
+    # NOTE: rounded down to even numbers
+    assert fit_size(1366, 768, 1000, 1000) == (1000, 562)
+    # NOTE: never scaled up
+    assert fit_size(800, 600, 1280, 720) == (800, 600)
+
+
+@pytest.mark.asyncio
+async def test_put_frame_output_size() -> None:
+    track = ScreenCaptureTrack(fps=1000, output_size=(32, 32))
+    track.active = True
+
+    img = numpy.zeros((48, 64, 4), dtype=numpy.uint8)
+    img[..., 0] = 10
+    img[..., 1] = 20
+    img[..., 2] = 30
+    track.put_frame(img, "bgr0")
+
+    frame = await track.recv()
+    assert (frame.width, frame.height, frame.format.name) == (32, 24, "yuv420p")
+    rgb = frame.to_ndarray(format="rgb24").astype(int)
+    assert (abs(rgb - [30, 20, 10]) <= 2).all()
+
+    assert track.video_scale == (0.5, 0.5)
+
+    # NOTE: the adaptation scale shrinks the output size further
+    track.scale = 0.5
+    track.put_frame(img, "bgr0")
+    frame = await track.recv()
+    assert (frame.width, frame.height) == (16, 12)
+    assert track.video_scale == (0.25, 0.25)
+
+
+@pytest.mark.asyncio
+async def test_put_frame_adaptation_scale() -> None:
+    track = ScreenCaptureTrack(fps=1000)
+    track.active = True
+
+    # NOTE: without an output size, the captured size is scaled and kept even
+    img = numpy.zeros((30, 62, 4), dtype=numpy.uint8)
+    track.scale = 0.5
+    track.put_frame(img, "bgr0")
+    frame = await track.recv()
+    assert (frame.width, frame.height, frame.format.name) == (30, 14, "yuv420p")
+    assert track.video_scale == (30 / 62, 14 / 30)
+
+
+@pytest.mark.asyncio
+async def test_recv_without_repeat() -> None:
+    track = ScreenCaptureTrack(fps=1000, repeat_frames=False)
+    track.active = True
+    track.put_frame(numpy.zeros((8, 16, 4), dtype=numpy.uint8), "bgr0")
+    await track.recv()
+
+    # NOTE: no frame is repeated until a new one is put
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(track.recv(), 0.05)
+
+
+@pytest.mark.asyncio
+async def test_broadcast_track() -> None:
+    track = BroadcastTrack(fps=1000, queue_size=2, max_subscribers=2)
+    a = track.subscribe()
+    b = track.subscribe()
+    with pytest.raises(RuntimeError):
+        track.subscribe()
+
+    a.active = True
+    b.active = True
+    for i in range(3):
+        track.put_frame(numpy.full((8, 16, 4), i, dtype=numpy.uint8), "bgr0")
+
+    # NOTE: the oldest frame has been dropped for both subscribers
+    assert a.dropped_frames == 1
+    frame_a = await a.recv()
+    frame_b = await b.recv()
+    assert frame_a is frame_b
+    assert frame_a.to_ndarray(format="rgb24")[0, 0, 0] == 1
+    assert (await a.recv()).pts >= frame_a.pts
+
+    track.unsubscribe(a)
+    assert track.subscriber_count == 1
+    assert a.readyState == "ended"
+
+
+@pytest.mark.asyncio
+async def test_broadcast_track_last_frame() -> None:
+    track = BroadcastTrack(fps=1000)
+    # NOTE: an image captured while nobody is watching is sent to the next subscriber
+    track.put_frame(numpy.full((8, 16, 4), 5, dtype=numpy.uint8), "bgr0")
+    a = track.subscribe()
+    a.active = True
+    frame = await a.recv()
+    assert (frame.width, frame.height, frame.format.name) == (16, 8, "yuv420p")
+
+    # NOTE: a later subscriber starts from the last frame broadcast, and then waits for new ones
+    track.put_frame(numpy.full((8, 16, 4), 7, dtype=numpy.uint8), "bgr0")
+    frame = await a.recv()
+    b = track.subscribe()
+    b.active = True
+    assert await b.recv() is frame
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(b.recv(), 0.05)
+
+
+@pytest.mark.asyncio
+async def test_subscriber_track_stop_wakes_recv() -> None:
+    track = BroadcastTrack(fps=1000)
+    a = track.subscribe()
+    a.active = True
+    task = asyncio.ensure_future(a.recv())
+    await asyncio.sleep(0.01)
+    assert not task.done()
+
+    track.unsubscribe(a)
+    with pytest.raises(MediaStreamError):
+        await asyncio.wait_for(task, 1.0)
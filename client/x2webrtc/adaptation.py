@@ -0,0 +1,153 @@
+import asyncio
+import dataclasses
+import logging
+from typing import Any, Iterator, List, Optional
+
+from aiortc import RTCPeerConnection, RTCRtpSender
+from aiortc.rtp import RTCP_PSFB_APP, RtcpPsfbPacket, unpack_remb_fci
+
+from x2webrtc.config import AdaptationConfig, AdaptationLevel
+from x2webrtc.track import ScreenCaptureTrack
+
+_logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass
+class LinkObservation:
+    # NOTE: ratio of packets lost since the previous receiver report (0.0 - 1.0)
+    fraction_lost: float
+    round_trip_time: Optional[float]
+    # NOTE: the latest bandwidth estimated by the receiver (REMB) in bits per second
+    estimated_bitrate: Optional[int]
+
+
+def _get_encoder(sender: RTCRtpSender) -> Any:
+    # NOTE: aiortc does not expose the encoder of RTCRtpSender
+    return getattr(sender, "_RTCRtpSender__encoder", None)
+
+
+class AdaptationController:
+    """Step the capture fps, capture scale and encoder bitrate through `AdaptationConfig.levels`.
+
+    Levels are ordered from the best to the most degraded one. A level is left only after
+    `degrade_after` (or `upgrade_after`) consecutive observations agree, which keeps the
+    stream from oscillating on a noisy link.
+    """
+
+    def __init__(self, config: AdaptationConfig, track: ScreenCaptureTrack) -> None:
+        if len(config.levels) == 0:
+            raise RuntimeError("at least one adaptation level is required")
+
+        self._config = config
+        self._track = track
+        self._index = 0
+        self._degrade_count = 0
+        self._upgrade_count = 0
+        self._estimated_bitrate: Optional[int] = None
+        self._senders: List[RTCRtpSender] = []
+
+    @property
+    def level(self) -> AdaptationLevel:
+        return self._config.levels[self._index]
+
+    def observe(self, observation: LinkObservation) -> bool:
+        """Update the level by an observation and return whether it has changed."""
+        config = self._config
+        estimate = observation.estimated_bitrate
+        congested = observation.fraction_lost >= config.degrade_loss or (
+            estimate is not None and estimate < self.level.bitrate
+        )
+        recovered = False
+        if self._index > 0 and observation.fraction_lost <= config.upgrade_loss:
+            better = config.levels[self._index - 1]
+            recovered = estimate is None or estimate >= better.bitrate
+
+        self._degrade_count = self._degrade_count + 1 if congested else 0
+        self._upgrade_count = self._upgrade_count + 1 if recovered else 0
+
+        if self._degrade_count >= config.degrade_after and self._index < len(config.levels) - 1:
+            self._index += 1
+        elif self._upgrade_count >= config.upgrade_after:
+            self._index -= 1
+        else:
+            return False
+
+        self._degrade_count = 0
+        self._upgrade_count = 0
+        return True
+
+    def _video_senders(self, pc: RTCPeerConnection) -> Iterator[RTCRtpSender]:
+        for sender in pc.getSenders():
+            if sender.track is not None and sender.track.kind == "video":
+                yield sender
+
+    def _cap_bitrate(self, sender: RTCRtpSender) -> None:
+        encoder = _get_encoder(sender)
+        if encoder is None or not hasattr(encoder, "target_bitrate"):
+            return
+
+        bitrate = self.level.bitrate
+        if self._estimated_bitrate is not None:
+            bitrate = min(bitrate, self._estimated_bitrate)
+        encoder.target_bitrate = bitrate
+
+    def _hook_rtcp(self, sender: RTCRtpSender) -> None:
+        original = sender._handle_rtcp_packet
+
+        async def handle_rtcp_packet(packet: Any) -> None:
+            await original(packet)
+            if isinstance(packet, RtcpPsfbPacket) and packet.fmt == RTCP_PSFB_APP:
+                try:
+                    bitrate, ssrcs = unpack_remb_fci(packet.fci)
+                except ValueError:
+                    return
+                if sender._ssrc in ssrcs:
+                    self._estimated_bitrate = bitrate
+                    # NOTE: aiortc has just set the encoder bitrate to the estimate, so cap it again
+                    self._cap_bitrate(sender)
+
+        # NOTE: the DTLS transport looks up the handler on each packet, so an instance attribute overrides it
+        setattr(sender, "_handle_rtcp_packet", handle_rtcp_packet)
+
+    def attach(self, pc: RTCPeerConnection) -> None:
+        for sender in self._video_senders(pc):
+            self._hook_rtcp(sender)
+            self._senders.append(sender)
+
+    async def _observe_link(self) -> Optional[LinkObservation]:
+        fraction_lost: Optional[float] = None
+        round_trip_time: Optional[float] = None
+        for sender in self._senders:
+            report = await sender.getStats()
+            for stats in report.values():
+                if stats.type != "remote-inbound-rtp":
+                    continue
+                # NOTE: RTCP receiver reports carry the fraction lost as an 8-bit fixed point number
+                lost = stats.fractionLost / 256.0
+                fraction_lost = lost if fraction_lost is None else max(fraction_lost, lost)
+                if stats.roundTripTime is not None:
+                    round_trip_time = stats.roundTripTime
+
+        if fraction_lost is None:
+            return None
+        return LinkObservation(fraction_lost, round_trip_time, self._estimated_bitrate)
+
+    def _apply(self) -> None:
+        level = self.level
+        _logger.info("adaptation level: fps={}, scale={}, bitrate={}".format(level.fps, level.scale, level.bitrate))
+        self._track.set_fps(level.fps)
+        self._track.scale = level.scale
+        for sender in self._senders:
+            self._cap_bitrate(sender)
+
+    async def run(self) -> None:
+        self._apply()
+        while True:
+            await asyncio.sleep(self._config.interval)
+            observation = await self._observe_link()
+            if observation is None:
+                continue
+
+            _logger.debug("link observation: {}".format(observation))
+            if self.observe(observation):
+                self._apply()
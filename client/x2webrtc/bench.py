@@ -0,0 +1,325 @@
+import asyncio
+import dataclasses
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import numpy
+import Xlib.display
+from aiortc import RTCPeerConnection
+from aiortc.mediastreams import MediaStreamError
+
+from x2webrtc.capture_loop import run_capture_async
+from x2webrtc.config import Config
+from x2webrtc.input import InputDispatcher, InputHandler
+from x2webrtc.screen_capture import Display
+from x2webrtc.signaling import LoopbackSignaling
+from x2webrtc.timer import Timer
+from x2webrtc.track import ScreenCaptureTrack
+from x2webrtc.webrtc import WebRTCClient
+
+_logger = logging.getLogger(__name__)
+
+# NOTE: The marker is a row of black and white cells at the top-left corner of the screen:
+# two guard cells (white, black) followed by the bits of a frame number, MSB first.
+# The cells are large enough to survive the lossy encoding.
+MARKER_CELL = 16
+MARKER_BITS = 16
+_MARKER_GUARD = (1, 0)
+_MARKER_CELLS = len(_MARKER_GUARD) + MARKER_BITS
+
+
+def encode_marker(seq: int) -> List[int]:
+    """Return the cells (1 for white, 0 for black) of the marker of a frame number."""
+    seq &= (1 << MARKER_BITS) - 1
+    return list(_MARKER_GUARD) + [(seq >> (MARKER_BITS - 1 - i)) & 1 for i in range(MARKER_BITS)]
+
+
+def decode_marker(luma: numpy.ndarray) -> Optional[int]:
+    """Read the frame number from the luma plane of a frame, or return None if no marker is found."""
+    if luma.shape[0] < MARKER_CELL or luma.shape[1] < MARKER_CELL * _MARKER_CELLS:
+        return None
+
+    # NOTE: sample the center of each cell, where the encoder blurs the edges the least
+    center = MARKER_CELL // 2
+    samples = luma[center, center : MARKER_CELL * _MARKER_CELLS : MARKER_CELL]
+    cells = [1 if v >= 128 else 0 for v in samples]
+    if tuple(cells[: len(_MARKER_GUARD)]) != _MARKER_GUARD:
+        return None
+
+    seq = 0
+    for bit in cells[len(_MARKER_GUARD) :]:
+        seq = (seq << 1) | bit
+    return seq
+
+
+class VirtualDisplay:
+    """Run Xvfb on a free display number while in the `with` block."""
+
+    def __init__(self, width: int, height: int) -> None:
+        self._width = width
+        self._height = height
+        self._process: Optional["subprocess.Popen[bytes]"] = None
+
+    def __enter__(self) -> str:
+        path = shutil.which("Xvfb")
+        if path is None:
+            raise RuntimeError("Xvfb is not found; it is required to run the benchmark")
+
+        # NOTE: `-displayfd` lets Xvfb pick a free display number and tells it once the server is ready
+        r, w = os.pipe()
+        try:
+            self._process = subprocess.Popen(
+                [path, "-displayfd", str(w), "-screen", "0", "{}x{}x24".format(self._width, self._height)]
+                + ["-nolisten", "tcp"],
+                pass_fds=(w,),
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+        finally:
+            os.close(w)
+
+        with os.fdopen(r) as f:
+            number = f.readline().strip()
+        if len(number) == 0:
+            self.__exit__()
+            raise RuntimeError("failed to start Xvfb")
+
+        _logger.info("started Xvfb on :{}".format(number))
+        return ":{}".format(number)
+
+    def __exit__(self, *args: Any) -> None:
+        if self._process is None:
+            return
+
+        self._process.terminate()
+        try:
+            self._process.wait(timeout=5.0)
+        except subprocess.TimeoutExpired:
+            self._process.kill()
+            self._process.wait()
+        self._process = None
+
+
+class AnimatedWorkload:
+    """Draw a moving box and the marker of the frame number on the root window at a fixed rate.
+
+    The time each frame reaches the X server is kept in `drawn_at`, keyed by the frame number in the marker.
+    """
+
+    def __init__(self, display_name: str, fps: int) -> None:
+        # NOTE: a connection of its own, so the drawing never waits for the capture
+        self._display = Xlib.display.Display(display_name)
+        screen = self._display.screen()
+        self._root = screen.root
+        self._width = screen.width_in_pixels
+        self._height = screen.height_in_pixels
+        self._black = self._root.create_gc(foreground=screen.black_pixel)
+        self._white = self._root.create_gc(foreground=screen.white_pixel)
+        self._timer = Timer(fps)
+        self.drawn_at: Dict[int, float] = {}
+        self._quit = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="x2webrtc-bench-workload", daemon=True)
+
+    def start(self) -> None:
+        self._root.fill_rectangle(self._black, 0, 0, self._width, self._height)
+        self._thread.start()
+
+    def _draw(self, seq: int) -> None:
+        size = min(self._width, self._height) // 4
+        top = MARKER_CELL * 2
+        span = max(1, self._width - size)
+        x = (seq * 8) % (span * 2)
+        x = x if x < span else span * 2 - x
+        self._root.fill_rectangle(self._black, 0, top, self._width, size)
+        self._root.fill_rectangle(self._white, x, top, size, size)
+
+        for i, cell in enumerate(encode_marker(seq)):
+            gc = self._white if cell == 1 else self._black
+            self._root.fill_rectangle(gc, i * MARKER_CELL, 0, MARKER_CELL, MARKER_CELL)
+
+    def _run(self) -> None:
+        seq = 0
+        while not self._quit.is_set():
+            self._timer.wait()
+            self._draw(seq)
+            # NOTE: wait until the server has drawn the frame, so the latency starts from the "glass"
+            self._display.sync()
+            self.drawn_at[seq & ((1 << MARKER_BITS) - 1)] = time.monotonic()
+            seq += 1
+
+    def stop(self) -> None:
+        self._quit.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self._display.close()
+
+
+class LoopbackReceiver:
+    """An in-process peer which receives the video and measures the latency from the markers."""
+
+    def __init__(self, drawn_at: Dict[int, float]) -> None:
+        self.pc = RTCPeerConnection()
+        self.pc.on("track", self._on_track)
+        self._drawn_at = drawn_at
+        self._task: Optional["asyncio.Future[None]"] = None
+        self.first_frame = asyncio.Event()
+        self.reset()
+
+    def reset(self) -> None:
+        self.frames = 0
+        self.new_frames = 0
+        self.undecoded = 0
+        self.latencies: List[float] = []
+
+    def _on_track(self, track: Any) -> None:
+        if track.kind == "video":
+            self._task = asyncio.ensure_future(self._consume(track))
+
+    async def _consume(self, track: Any) -> None:
+        last_seq: Optional[int] = None
+        while True:
+            try:
+                frame = await track.recv()
+            except MediaStreamError:
+                return
+
+            now = time.monotonic()
+            self.frames += 1
+            self.first_frame.set()
+            # NOTE: the first rows of a yuv420p array are the luma plane
+            seq = decode_marker(frame.to_ndarray(format="yuv420p")[: frame.height])
+            if seq is None:
+                self.undecoded += 1
+                continue
+            if seq == last_seq:
+                continue
+
+            last_seq = seq
+            self.new_frames += 1
+            drawn = self._drawn_at.get(seq)
+            if drawn is not None:
+                self.latencies.append(now - drawn)
+
+    async def close(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+        await self.pc.close()
+
+
+@dataclasses.dataclass
+class BenchOptions:
+    width: int = 1280
+    height: int = 720
+    duration: float = 10.0
+    warmup: float = 2.0
+    fps: int = 30
+    workload_fps: int = 60
+    capture_backend: str = "auto"
+    capture_mode: str = "full"
+    pipelined: bool = False
+    # NOTE: in seconds; the connection and the first frame must arrive within this time
+    first_frame_timeout: float = 10.0
+
+
+@dataclasses.dataclass
+class BenchResult:
+    duration: float
+    # NOTE: frames captured and handed over to the encoder
+    capture_fps: float
+    # NOTE: frames received with a new marker
+    receive_fps: float
+    latency_mean_ms: float
+    latency_p50_ms: float
+    latency_p95_ms: float
+    latency_max_ms: float
+    # NOTE: CPU time of the whole process (capture, encode, and also the decode of the receiver) per captured frame
+    cpu_per_frame_ms: float
+    max_rss_mib: float
+    undecoded_frames: int
+
+    def format(self) -> str:
+        return "\n".join(
+            [
+                "duration: {:.1f} sec.".format(self.duration),
+                "capture fps: {:.1f}".format(self.capture_fps),
+                "receive fps: {:.1f}".format(self.receive_fps),
+                "latency: mean={:.1f}ms, p50={:.1f}ms, p95={:.1f}ms, max={:.1f}ms".format(
+                    self.latency_mean_ms, self.latency_p50_ms, self.latency_p95_ms, self.latency_max_ms
+                ),
+                "cpu per frame: {:.2f}ms".format(self.cpu_per_frame_ms),
+                "max rss: {:.1f}MiB".format(self.max_rss_mib),
+                "undecoded frames: {}".format(self.undecoded_frames),
+            ]
+        )
+
+
+async def run_bench(options: BenchOptions) -> BenchResult:
+    """Forward an animated Xvfb screen to an in-process peer over loopback and measure the whole pipeline."""
+    with VirtualDisplay(options.width, options.height) as display_name:
+        display = Display(display_name, options.capture_backend)
+        capture_window = display.bind(display.screen().root_window, "capture")
+        capture_window.watch_geometry()
+
+        workload = AnimatedWorkload(display_name, options.workload_fps)
+        receiver = LoopbackReceiver(workload.drawn_at)
+        track = ScreenCaptureTrack(fps=options.fps)
+        input_dispatcher = InputDispatcher(InputHandler())
+        # NOTE: no ICE servers are needed over loopback, so the user config is not loaded
+        connection = WebRTCClient(
+            Config.get_default(), track, input_dispatcher, signaling=LoopbackSignaling(receiver.pc)
+        )
+        workload.start()
+        forward_screen_task: Optional["asyncio.Future[None]"] = None
+        try:
+            await connection.connect()
+            forward_screen_task = asyncio.ensure_future(
+                run_capture_async(options.capture_mode, capture_window, track, options.pipelined)
+            )
+            try:
+                await asyncio.wait_for(receiver.first_frame.wait(), options.first_frame_timeout)
+            except asyncio.TimeoutError:
+                raise RuntimeError(
+                    "no frame has been received in {} sec.; check the capture and the codecs".format(
+                        options.first_frame_timeout
+                    )
+                )
+            await asyncio.sleep(options.warmup)
+
+            receiver.reset()
+            published = track.stats.published
+            cpu = time.process_time()
+            start = time.monotonic()
+            await asyncio.sleep(options.duration)
+            duration = time.monotonic() - start
+            cpu = time.process_time() - cpu
+            published = track.stats.published - published
+            latencies = numpy.array(receiver.latencies) * 1000 if len(receiver.latencies) > 0 else numpy.zeros(1)
+        finally:
+            await connection.disconnect()
+            await receiver.close()
+            if forward_screen_task is not None:
+                forward_screen_task.cancel()
+                await asyncio.gather(forward_screen_task, return_exceptions=True)
+            input_dispatcher.close()
+            workload.stop()
+
+    # NOTE: ru_maxrss is in kilobytes on Linux
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return BenchResult(
+        duration=duration,
+        capture_fps=published / duration,
+        receive_fps=receiver.new_frames / duration,
+        latency_mean_ms=float(latencies.mean()),
+        latency_p50_ms=float(numpy.percentile(latencies, 50)),
+        latency_p95_ms=float(numpy.percentile(latencies, 95)),
+        latency_max_ms=float(latencies.max()),
+        cpu_per_frame_ms=cpu / max(1, published) * 1000,
+        max_rss_mib=max_rss,
+        undecoded_frames=receiver.undecoded,
+    )
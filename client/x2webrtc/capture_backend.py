@@ -0,0 +1,266 @@
+import abc
+import ctypes
+import ctypes.util
+import logging
+import threading
+from typing import Any, Dict, Optional, Tuple, Type
+
+import Xlib.error
+import Xlib.X
+from Xlib.protocol import rq
+
+_logger = logging.getLogger(__name__)
+
+SHM_EXTENSION_NAME = "MIT-SHM"
+_IPC_PRIVATE = 0
+_IPC_CREAT = 0o1000
+_IPC_RMID = 0
+
+
+class CaptureBackend(abc.ABC):
+
+    name = ""
+
+    @abc.abstractmethod
+    def capture(self, drawable: Any, x: int, y: int, width: int, height: int, slot: int = 0) -> memoryview:
+        """Grab the specified area of the drawable as BGRX pixels.
+
+        The returned buffer is only valid until the next call of `capture` with the same `slot`,
+        so images captured into different slots can be used at the same time.
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class XGetImageBackend(CaptureBackend):
+
+    name = "xgetimage"
+
+    def capture(self, drawable: Any, x: int, y: int, width: int, height: int, slot: int = 0) -> memoryview:
+        # NOTE: every reply has a buffer of its own, so slots need no care
+        image = drawable.get_image(x, y, width, height, Xlib.X.ZPixmap, 0xFFFFFFFF)
+        # 'depth', 'sequence_number', 'visual', 'data'
+        assert image.depth == 24
+        return memoryview(image.data)
+
+
+class _ShmQueryVersion(rq.ReplyRequest):  # type: ignore
+    _request = rq.Struct(rq.Card8("opcode"), rq.Opcode(0), rq.RequestLength())
+    _reply = rq.Struct(
+        rq.ReplyCode(),
+        rq.Bool("shared_pixmaps"),
+        rq.Card16("sequence_number"),
+        rq.ReplyLength(),
+        rq.Card16("major_version"),
+        rq.Card16("minor_version"),
+        rq.Card16("uid"),
+        rq.Card16("gid"),
+        rq.Card8("pixmap_format"),
+        rq.Pad(15),
+    )
+
+
+class _ShmAttach(rq.Request):  # type: ignore
+    _request = rq.Struct(
+        rq.Card8("opcode"),
+        rq.Opcode(1),
+        rq.RequestLength(),
+        rq.Card32("shmseg"),
+        rq.Card32("shmid"),
+        rq.Bool("read_only"),
+        rq.Pad(3),
+    )
+
+
+class _ShmDetach(rq.Request):  # type: ignore
+    _request = rq.Struct(rq.Card8("opcode"), rq.Opcode(2), rq.RequestLength(), rq.Card32("shmseg"))
+
+
+class _ShmGetImage(rq.ReplyRequest):  # type: ignore
+    _request = rq.Struct(
+        rq.Card8("opcode"),
+        rq.Opcode(4),
+        rq.RequestLength(),
+        rq.Drawable("drawable"),
+        rq.Int16("x"),
+        rq.Int16("y"),
+        rq.Card16("width"),
+        rq.Card16("height"),
+        rq.Card32("plane_mask"),
+        rq.Card8("format"),
+        rq.Pad(3),
+        rq.Card32("shmseg"),
+        rq.Card32("offset"),
+    )
+    _reply = rq.Struct(
+        rq.ReplyCode(),
+        rq.Card8("depth"),
+        rq.Card16("sequence_number"),
+        rq.ReplyLength(),
+        rq.Card32("visual"),
+        rq.Card32("size"),
+        rq.Pad(16),
+    )
+
+
+def _load_libc() -> Any:
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+    libc.shmget.restype = ctypes.c_int
+    libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+    libc.shmat.restype = ctypes.c_void_p
+    libc.shmdt.argtypes = [ctypes.c_void_p]
+    libc.shmdt.restype = ctypes.c_int
+    libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+    libc.shmctl.restype = ctypes.c_int
+    return libc
+
+
+class _SharedSegment:
+    def __init__(self, libc: Any, size: int) -> None:
+        self._libc = libc
+        self.size = size
+        self.shmid = libc.shmget(_IPC_PRIVATE, size, _IPC_CREAT | 0o600)
+        if self.shmid < 0:
+            raise OSError(ctypes.get_errno(), "shmget failed")
+
+        addr = libc.shmat(self.shmid, None, 0)
+        if addr is None or addr == ctypes.c_void_p(-1).value:
+            libc.shmctl(self.shmid, _IPC_RMID, None)
+            raise OSError(ctypes.get_errno(), "shmat failed")
+
+        self._addr: Optional[int] = addr
+        self._buffer = (ctypes.c_ubyte * size).from_address(addr)
+
+    def view(self, length: int) -> memoryview:
+        return memoryview(self._buffer).cast("B")[:length]
+
+    def mark_for_removal(self) -> None:
+        # NOTE: The segment is destroyed once both the X server and we detach from it,
+        # so that it never leaks even if the process gets killed.
+        self._libc.shmctl(self.shmid, _IPC_RMID, None)
+
+    def close(self) -> None:
+        if self._addr is not None:
+            self._libc.shmdt(self._addr)
+            self._addr = None
+
+
+def _is_local_display(display: Any) -> bool:
+    name = display.get_display_name() or ""
+    host = name.rsplit(":", 1)[0]
+    return host in ("", "unix") or host.startswith("/")
+
+
+class XShmBackend(CaptureBackend):
+
+    name = "shm"
+
+    def __init__(self, display: Any) -> None:
+        if not _is_local_display(display):
+            raise RuntimeError("MIT-SHM is unavailable for a remote X server")
+
+        ext = display.query_extension(SHM_EXTENSION_NAME)
+        if ext is None or not ext.present:
+            raise RuntimeError("the X server does not support MIT-SHM")
+
+        self._display = display
+        self._opcode: int = ext.major_opcode
+        self._libc = _load_libc()
+        self._lock = threading.Lock()
+        # NOTE: an attached segment and its id on the server for each slot
+        self._segments: Dict[int, Tuple[_SharedSegment, int]] = {}
+
+        _ShmQueryVersion(display=display.display, opcode=self._opcode)
+        # NOTE: Attach a small segment once to make sure that the server can actually map our memory
+        self._ensure_segment(4, 0)
+
+    def _detach(self, slot: int) -> None:
+        entry = self._segments.pop(slot, None)
+        if entry is None:
+            return
+
+        segment, shmseg = entry
+        _ShmDetach(display=self._display.display, opcode=self._opcode, shmseg=shmseg)
+        self._display.sync()
+        self._display.display.free_resource_id(shmseg)
+        segment.close()
+
+    def _ensure_segment(self, size: int, slot: int) -> Tuple[_SharedSegment, int]:
+        entry = self._segments.get(slot)
+        if entry is not None and entry[0].size >= size:
+            return entry
+
+        self._detach(slot)
+        segment = _SharedSegment(self._libc, size)
+        shmseg = self._display.display.allocate_resource_id()
+        catcher = Xlib.error.CatchError()
+        _ShmAttach(
+            display=self._display.display,
+            onerror=catcher,
+            opcode=self._opcode,
+            shmseg=shmseg,
+            shmid=segment.shmid,
+            read_only=False,
+        )
+        self._display.sync()
+        segment.mark_for_removal()
+        if catcher.get_error() is not None:
+            segment.close()
+            self._display.display.free_resource_id(shmseg)
+            raise RuntimeError("failed to attach a shared memory segment: {}".format(catcher.get_error()))
+
+        self._segments[slot] = (segment, shmseg)
+        return segment, shmseg
+
+    def capture(self, drawable: Any, x: int, y: int, width: int, height: int, slot: int = 0) -> memoryview:
+        with self._lock:
+            segment, shmseg = self._ensure_segment(width * height * 4, slot)
+            reply = _ShmGetImage(
+                display=self._display.display,
+                opcode=self._opcode,
+                drawable=drawable,
+                x=x,
+                y=y,
+                width=width,
+                height=height,
+                plane_mask=0xFFFFFFFF,
+                format=Xlib.X.ZPixmap,
+                shmseg=shmseg,
+                offset=0,
+            )
+            assert reply.depth == 24
+            return segment.view(reply.size)
+
+    def close(self) -> None:
+        with self._lock:
+            for slot in list(self._segments.keys()):
+                self._detach(slot)
+
+
+CAPTURE_BACKENDS: Dict[str, Type[CaptureBackend]] = {
+    XShmBackend.name: XShmBackend,
+    XGetImageBackend.name: XGetImageBackend,
+}
+CAPTURE_BACKEND_CHOICES = ["auto"] + list(CAPTURE_BACKENDS.keys())
+
+
+def get_capture_backend(display: Any, name: str = "auto") -> CaptureBackend:
+    if name == XGetImageBackend.name:
+        return XGetImageBackend()
+    elif name == XShmBackend.name:
+        return XShmBackend(display)
+    elif name != "auto":
+        raise RuntimeError(
+            "unknown capture backend: {} [must be one of {}]".format(name, ", ".join(CAPTURE_BACKEND_CHOICES))
+        )
+
+    try:
+        backend: CaptureBackend = XShmBackend(display)
+    except Exception as e:
+        _logger.info("MIT-SHM is unavailable ({}), fall back to {}".format(e, XGetImageBackend.name))
+        backend = XGetImageBackend()
+
+    _logger.info("use the capture backend: {}".format(backend.name))
+    return backend
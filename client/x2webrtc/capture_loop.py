@@ -0,0 +1,379 @@
+import abc
+import asyncio
+import concurrent.futures
+import logging
+import queue
+import threading
+import time
+from typing import Dict, List, Optional, Tuple, Type
+
+import numpy
+
+from x2webrtc import metrics
+from x2webrtc.screen_capture import Rectangle, Window, merge_rectangles
+from x2webrtc.tiles import TileStream
+from x2webrtc.track import FrameSink
+
+_logger = logging.getLogger(__name__)
+
+_STATIC_FRAMES = metrics.REGISTRY.counter(
+    "x2webrtc_static_frames_total", "captured images skipped for being identical to the previous one"
+)
+
+# NOTE: in seconds; a static screen is still sent this often, so a late joiner or a lost frame is recovered
+STATIC_REFRESH_INTERVAL = 1.0
+
+
+class Grabber(abc.ABC):
+    def __init__(self, window: Window) -> None:
+        self._window = window
+
+    @abc.abstractmethod
+    def grab(self, slot: int = 0) -> Optional[numpy.ndarray]:
+        """Return the current BGRX image of the window, or None if nothing has changed.
+
+        The image is held in `slot`, and is only valid until the next call of `grab` with the same slot,
+        so the images of different slots can be handed over to another thread without any copy.
+        "Nothing has changed" is relative to the last image of the slot.
+        """
+
+    def close(self) -> None:
+        pass
+
+
+class FullGrabber(Grabber):
+    def grab(self, slot: int = 0) -> Optional[numpy.ndarray]:
+        return self._window.capture_bgrx(slot=slot)
+
+
+class DamageGrabber(Grabber):
+    def __init__(self, window: Window) -> None:
+        super().__init__(window)
+        self._tracker = window.track_damage()
+        self._framebuffers: Dict[int, numpy.ndarray] = {}
+        # NOTE: areas damaged since each framebuffer was last updated, which were captured into another slot
+        self._stale: Dict[int, List[Rectangle]] = {}
+        self._area: Optional[Rectangle] = None
+
+    def grab(self, slot: int = 0) -> Optional[numpy.ndarray]:
+        damaged = self._tracker.poll()
+        area = self._window.capture_rect
+        if area != self._area:
+            self._area = area
+            self._framebuffers.clear()
+            self._stale.clear()
+
+        for other, rects in self._stale.items():
+            if other != slot:
+                rects.extend(damaged)
+
+        framebuffer = self._framebuffers.get(slot)
+        if framebuffer is None:
+            framebuffer = self._framebuffers[slot] = self._window.capture_bgrx(area).copy()
+            self._stale[slot] = []
+            return framebuffer
+
+        stale, self._stale[slot] = self._stale[slot], []
+        if len(stale) > 0:
+            damaged = merge_rectangles(stale + damaged, *self._tracker.size)
+
+        updated = False
+        for r in damaged:
+            c = r.intersect(area)
+            if c is None:
+                continue
+            x, y = c.x - area.x, c.y - area.y
+            framebuffer[y : y + c.height, x : x + c.width] = self._window.capture_bgrx(c)
+            updated = True
+
+        return framebuffer if updated else None
+
+    def close(self) -> None:
+        self._tracker.close()
+
+
+GRABBERS: Dict[str, Type[Grabber]] = {
+    "full": FullGrabber,
+    "damage": DamageGrabber,
+}
+
+
+class StaticFrameFilter:
+    """Drop captured images identical to the previous one, except one every `refresh_interval` seconds.
+
+    Only every `stride`-th row is compared, starting from an offset rotated every frame, so the cost is
+    a fraction of a copy. A change covering few rows may be noticed up to `stride` frames late.
+    """
+
+    def __init__(self, refresh_interval: float = STATIC_REFRESH_INTERVAL, stride: int = 8) -> None:
+        if stride < 1:
+            raise RuntimeError("stride must be positive: {}".format(stride))
+
+        self._refresh_interval = refresh_interval
+        self._stride = stride
+        self._offset = 0
+        self._reference: Optional[numpy.ndarray] = None
+        self._last_passed = 0.0
+
+    def _is_changed(self, img: numpy.ndarray) -> bool:
+        ref = self._reference
+        if ref is None or ref.shape != img.shape:
+            return True
+
+        self._offset = (self._offset + 1) % self._stride
+        rows = slice(self._offset, None, self._stride)
+        return not numpy.array_equal(img[rows], ref[rows])
+
+    def filter(self, img: Optional[numpy.ndarray]) -> Optional[numpy.ndarray]:
+        """Return the image to send, or None if nothing should be sent.
+
+        `img` may be None if the grabber knows that nothing has changed. The returned image is only
+        valid until the next call of `filter`.
+        """
+        now = time.monotonic()
+        if img is not None and self._is_changed(img):
+            if self._reference is None or self._reference.shape != img.shape:
+                self._reference = img.copy()
+            else:
+                numpy.copyto(self._reference, img)
+            self._last_passed = now
+            return img
+
+        if img is not None:
+            _STATIC_FRAMES.inc()
+        if self._reference is not None and now - self._last_passed >= self._refresh_interval:
+            self._last_passed = now
+            return self._reference
+        return None
+
+
+def _grab(grabber: Grabber, static_filter: Optional[StaticFrameFilter]) -> Optional[numpy.ndarray]:
+    arr = grabber.grab()
+    if static_filter is not None:
+        arr = static_filter.filter(arr)
+    return arr
+
+
+def forward_screen(
+    grabber: Grabber,
+    track: FrameSink,
+    quit: threading.Event,
+    static_filter: Optional[StaticFrameFilter] = None,
+    tiles: Optional[TileStream] = None,
+) -> None:
+    while not quit.is_set():
+        try:
+            track.wait_for_next_put()
+            arr = _grab(grabber, static_filter)
+            if arr is not None:
+                track.put_frame(arr, "bgr0")
+                if tiles is not None:
+                    tiles.put_frame(arr)
+        except Exception:
+            _logger.exception("got an unexpected exception")
+
+
+def forward_screen_pipelined(
+    grabber: Grabber,
+    track: FrameSink,
+    quit: threading.Event,
+    static_filter: Optional[StaticFrameFilter] = None,
+    tiles: Optional[TileStream] = None,
+    depth: int = 2,
+) -> None:
+    """Run capture and conversion in separate threads connected by a bounded buffer.
+
+    The capture stage only grabs images, each into a slot of the grabber which is then owned by
+    the buffer and the conversion stage until it is converted, so no image is copied between them.
+    The conversion stage scales and converts the images to YUV, which takes the conversion off
+    the encoder. The throughput is limited by the slowest stage instead of the sum of both.
+    """
+    ready: "queue.Queue[Tuple[Optional[int], numpy.ndarray]]" = queue.Queue(depth)
+    free: "queue.Queue[int]" = queue.Queue()
+    # NOTE: one slot for each of the capture, the buffer and the conversion, so the capture never waits for a slot
+    for slot in range(depth + 2):
+        free.put(slot)
+
+    def release(slot: Optional[int]) -> None:
+        if slot is not None:
+            free.put(slot)
+
+    def convert() -> None:
+        while not quit.is_set():
+            try:
+                slot, arr = ready.get(timeout=0.1)
+            except queue.Empty:
+                continue
+
+            try:
+                track.put_frame(arr, "bgr0", convert_yuv=True)
+                if tiles is not None:
+                    tiles.put_frame(arr)
+            except Exception:
+                _logger.exception("got an unexpected exception")
+            finally:
+                release(slot)
+
+    converter = threading.Thread(target=convert, name="x2webrtc-convert", daemon=True)
+    converter.start()
+    try:
+        while not quit.is_set():
+            try:
+                track.wait_for_next_put()
+                slot = free.get()
+                grabbed = grabber.grab(slot)
+                arr = grabbed if static_filter is None else static_filter.filter(grabbed)
+                if arr is None:
+                    free.put(slot)
+                    continue
+                owner: Optional[int] = slot
+                if arr is not grabbed:
+                    # NOTE: a refresh of a static screen comes from the filter, which keeps updating it; it is
+                    # copied, but only once in a refresh interval
+                    free.put(slot)
+                    owner, arr = None, arr.copy()
+
+                try:
+                    ready.put_nowait((owner, arr))
+                except queue.Full:
+                    # NOTE: the conversion stage is behind; drop the oldest image rather than stalling the capture
+                    try:
+                        release(ready.get_nowait()[0])
+                    except queue.Empty:
+                        pass
+                    ready.put_nowait((owner, arr))
+            except Exception:
+                _logger.exception("got an unexpected exception")
+    finally:
+        converter.join()
+
+
+def run_capture(
+    mode: str,
+    window: Window,
+    track: FrameSink,
+    quit: threading.Event,
+    pipelined: bool = False,
+    skip_static: bool = False,
+    tiles: Optional[TileStream] = None,
+) -> None:
+    grabber = GRABBERS[mode](window)
+    static_filter = StaticFrameFilter() if skip_static else None
+    try:
+        if pipelined:
+            forward_screen_pipelined(grabber, track, quit, static_filter, tiles)
+        else:
+            forward_screen(grabber, track, quit, static_filter, tiles)
+    finally:
+        grabber.close()
+
+
+class XEventReader:
+    """Dispatch the X events of a window on the event loop as soon as they arrive on its connection.
+
+    While a capture holds the connection, the socket is not watched; the capture reads the events
+    by itself, and `resume` watches the socket again once it is done.
+    """
+
+    def __init__(self, window: Window) -> None:
+        self._loop = asyncio.get_event_loop()
+        self._window = window
+        self._fd = window.fileno()
+        self._watching = False
+        self.resume()
+
+    def _on_readable(self) -> None:
+        try:
+            if self._window.try_process_events():
+                return
+        except Exception:
+            _logger.exception("got an unexpected exception")
+        # NOTE: the reader is level-triggered, so it must be removed rather than spin on the unread socket
+        self._loop.remove_reader(self._fd)
+        self._watching = False
+
+    def resume(self) -> None:
+        if not self._watching:
+            self._loop.add_reader(self._fd, self._on_readable)
+            self._watching = True
+
+    def close(self) -> None:
+        if self._watching:
+            self._loop.remove_reader(self._fd)
+            self._watching = False
+
+
+async def forward_screen_async(
+    grabber: Grabber,
+    track: FrameSink,
+    static_filter: Optional[StaticFrameFilter] = None,
+    tiles: Optional[TileStream] = None,
+    events: Optional[XEventReader] = None,
+) -> None:
+    """Capture the screen at the rate of the track until cancelled.
+
+    Ticks are scheduled on the clock of the event loop, and only grabbing and copying the pixels run
+    on a thread of their own. At most one capture is in flight, so a slow one skips ticks instead of
+    queueing them up.
+    """
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="x2webrtc-capture")
+
+    def step() -> None:
+        arr = _grab(grabber, static_filter)
+        if arr is not None:
+            track.put_frame(arr, "bgr0")
+            if tiles is not None:
+                tiles.put_frame(arr)
+
+    job: Optional["concurrent.futures.Future[None]"] = None
+    try:
+        while True:
+            await track.wait_for_next_put_async()
+            job = executor.submit(step)
+            try:
+                await asyncio.wrap_future(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                _logger.exception("got an unexpected exception")
+            if events is not None:
+                events.resume()
+    finally:
+        # NOTE: a running capture cannot be interrupted, but it is short; wait for it,
+        # so the grabber is not closed under it
+        if job is not None:
+            await asyncio.wait([asyncio.wrap_future(job)])
+        executor.shutdown(wait=False)
+
+
+async def run_capture_async(
+    mode: str,
+    window: Window,
+    track: FrameSink,
+    pipelined: bool = False,
+    skip_static: bool = False,
+    tiles: Optional[TileStream] = None,
+) -> None:
+    """Run the capture until cancelled.
+
+    The pipelined capture still runs on threads, which are stopped once this is cancelled.
+    """
+    if pipelined:
+        loop = asyncio.get_event_loop()
+        quit = threading.Event()
+        future = loop.run_in_executor(None, run_capture, mode, window, track, quit, True, skip_static, tiles)
+        try:
+            await asyncio.shield(future)
+        finally:
+            quit.set()
+            await future
+        return
+
+    grabber = GRABBERS[mode](window)
+    static_filter = StaticFrameFilter() if skip_static else None
+    events = XEventReader(window)
+    try:
+        await forward_screen_async(grabber, track, static_filter, tiles, events)
+    finally:
+        events.close()
+        grabber.close()
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+from typing import Callable, Dict, Generic, List, Optional, Tuple, TypeVar
+
+from aiortc import RTCDataChannel
+
+from x2webrtc import metrics
+
+_T = TypeVar("_T")
+
+
+class ChannelSet(Generic[_T]):
+    """Open data channels, each with a state, that a worker thread sends messages to.
+
+    Channels are registered as they open and dropped as they close. The worker thread takes a snapshot
+    with `items` and owns the states from then on, while the messages are handed over to the event loop,
+    which owns the channels.
+    """
+
+    def __init__(self, sent_bytes: Optional[metrics.Counter] = None) -> None:
+        self._sent_bytes = sent_bytes
+        self._loop = asyncio.get_event_loop()
+        self._lock = threading.Lock()
+        self._channels: Dict[RTCDataChannel, _T] = {}
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._channels)
+
+    def attach(self, channel: RTCDataChannel, new_state: Callable[[], _T]) -> None:
+        def on_open() -> None:
+            with self._lock:
+                self._channels[channel] = new_state()
+
+        def on_close() -> None:
+            with self._lock:
+                self._channels.pop(channel, None)
+
+        channel.on("open", on_open)
+        channel.on("close", on_close)
+        if channel.readyState == "open":
+            on_open()
+
+    def items(self) -> List[Tuple[RTCDataChannel, _T]]:
+        with self._lock:
+            return list(self._channels.items())
+
+    def send(self, messages: List[Tuple[RTCDataChannel, bytes]]) -> None:
+        """Send messages from any thread; those to a channel closed meanwhile are dropped."""
+        if len(messages) > 0:
+            self._loop.call_soon_threadsafe(self._send, messages)
+
+    def _send(self, messages: List[Tuple[RTCDataChannel, bytes]]) -> None:
+        for channel, data in messages:
+            if channel.readyState != "open":
+                continue
+            channel.send(data)
+            if self._sent_bytes is not None:
+                self._sent_bytes.inc(len(data))
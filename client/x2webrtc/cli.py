@@ -1,60 +1,321 @@
 import argparse
 import asyncio
+import dataclasses
+import json
 import logging
+import re
 import sys
-import threading
-from typing import Optional, Tuple
-
-import numpy
+from typing import List, Optional, Set, Tuple
 
+from x2webrtc import metrics
+from x2webrtc.adaptation import AdaptationController
+from x2webrtc.bench import BenchOptions, run_bench
+from x2webrtc.capture_backend import CAPTURE_BACKEND_CHOICES
+from x2webrtc.capture_loop import GRABBERS, run_capture_async
 from x2webrtc.config import load_config
-from x2webrtc.input import InputHandler
-from x2webrtc.screen_capture import Display, Screen, Window
-from x2webrtc.track import ScreenCaptureTrack
+from x2webrtc.cursor import CursorStream
+from x2webrtc.input import InputDispatcher, InputHandler
+from x2webrtc.relay import EncoderRelay
+from x2webrtc.screen_capture import Display, Monitor, Rectangle, Screen, Window
+from x2webrtc.tiles import TileStream
+from x2webrtc.track import BroadcastTrack, FrameSink, ScreenCaptureTrack, SubscriberTrack
 from x2webrtc.webrtc import WebRTCClient
 
 _logger = logging.getLogger(__name__)
 
 
-def forward_screen(window: Window, track: ScreenCaptureTrack, quit: threading.Event) -> None:
-    while not quit.is_set():
-        try:
-            track.wait_for_next_put()
-            im = window.capture()
-            arr = numpy.asarray(im)
-            track.put_frame(arr)
-        except Exception:
-            _logger.exception("got an unexpected exception")
+def _parse_region(value: str) -> Rectangle:
+    # NOTE: the same format as X geometry strings (e.g., 800x600+100+50)
+    m = re.fullmatch(r"(\d+)x(\d+)\+(\d+)\+(\d+)", value)
+    if m is None:
+        raise argparse.ArgumentTypeError("invalid region (expected WIDTHxHEIGHT+X+Y): {}".format(value))
+    width, height, x, y = (int(g) for g in m.groups())
+    return Rectangle(x, y, width, height)
 
 
-def _get_target_window(args: argparse.Namespace) -> Tuple[Display, Screen, Window]:
-    display = Display(args.display)
+def _parse_size(value: str) -> Tuple[int, int]:
+    m = re.fullmatch(r"(\d+)x(\d+)", value)
+    if m is None:
+        raise argparse.ArgumentTypeError("invalid size (expected WIDTHxHEIGHT): {}".format(value))
+    return int(m.group(1)), int(m.group(2))
+
+
+def _select_monitors(args: argparse.Namespace, screen: Screen) -> List[Monitor]:
+    monitors = screen.monitors()
+    if args.monitors == "all":
+        if len(monitors) == 0:
+            raise RuntimeError("no monitor is found")
+        return monitors
+
+    by_name = {m.name: m for m in monitors}
+    selected = []
+    for name in args.monitors.split(","):
+        if name not in by_name:
+            raise RuntimeError("unknown monitor: {} (available: {})".format(name, ", ".join(by_name.keys())))
+        selected.append(by_name[name])
+    return selected
+
+
+def _get_target_window(args: argparse.Namespace) -> Tuple[Display, Window, Window]:
+    """Find the window to forward and return it bound to the capture and the input connections.
+
+    With `--monitors`, the window is the area of the first monitor on the root window.
+    """
+    display = Display(args.display, args.capture_backend)
     screen = display.screen()
-    # TODO(igarashi): Select a window using CLI argument
-    target_window = screen.root_window
-    return display, screen, target_window
+    target_window: Optional[Window] = screen.root_window
+    region = args.region
+    if getattr(args, "monitors", None) is not None:
+        if region is not None or any(v is not None for v in (args.window_id, args.window_class, args.window_name)):
+            raise RuntimeError("--monitors cannot be used with --region or the window options")
+        region = _select_monitors(args, screen)[0].rect
+    elif args.window_id is not None:
+        target_window = screen.get_window(args.window_id)
+    elif args.window_class is not None:
+        target_window = screen.find_window(lambda w: args.window_class in (w.wm_class or ()))
+    elif args.window_name is not None:
+        target_window = screen.find_window(lambda w: w.wm_name == args.window_name)
+
+    if target_window is None:
+        raise RuntimeError("no window matches the given condition")
+
+    _logger.info("target window: {} (wm_name={})".format(target_window.id, target_window.wm_name))
+    target_window.region = region
+    capture_window = display.bind(target_window, "capture")
+    input_window = display.bind(target_window, "input")
+    # NOTE: Keep the geometry up to date by ConfigureNotify events instead of querying it for every frame
+    capture_window.watch_geometry()
+    input_window.watch_geometry()
+    return display, capture_window, input_window
+
+
+def _get_extra_monitor_windows(args: argparse.Namespace, display: Display) -> List[Window]:
+    """Return the root window bound to a capture connection for each monitor selected after the first one."""
+    if getattr(args, "monitors", None) is None:
+        return []
+
+    windows = []
+    for monitor in _select_monitors(args, display.screen())[1:]:
+        # NOTE: each monitor has connections of its own, so the capture threads never wait for each other
+        monitor_display = Display(args.display, args.capture_backend)
+        root = monitor_display.screen().root_window
+        root.region = monitor.rect
+        window = monitor_display.bind(root, "capture")
+        window.watch_geometry()
+        windows.append(window)
+        _logger.info("extra monitor: {} ({})".format(monitor.name, monitor.rect))
+    return windows
+
+
+def _create_cursor_stream(
+    args: argparse.Namespace, display: Display, window: Window, track: FrameSink
+) -> Optional[CursorStream]:
+    if not args.cursor:
+        return None
+
+    # NOTE: The cursor is polled on a connection of its own, so it never waits for a capture
+    cursor_window = display.bind(window, "cursor")
+    cursor_window.watch_geometry()
+    return CursorStream(cursor_window, video_scale=lambda: track.video_scale)
+
+
+METRICS_SUMMARY_INTERVAL = 10.0
+
+
+def _register_metrics(track: FrameSink, input_dispatcher: InputDispatcher) -> None:
+    registry = metrics.REGISTRY
+    registry.gauge("x2webrtc_queue_depth", "frames waiting for the encoder", lambda: track.queue_depth)
+    if isinstance(track, ScreenCaptureTrack):
+        stats = track.stats
+        registry.counter("x2webrtc_published_frames_total", "frames captured", lambda: stats.published)
+        registry.counter(
+            "x2webrtc_overwritten_frames_total", "frames replaced by a newer one before sent", lambda: stats.overwritten
+        )
+        registry.counter(
+            "x2webrtc_stale_frames_total", "frames dropped for exceeding the latency budget", lambda: stats.stale
+        )
+        registry.counter(
+            "x2webrtc_skipped_frames_total", "frames skipped for a newer one before sent", lambda: stats.skipped
+        )
+    else:
+        registry.counter(
+            "x2webrtc_dropped_frames_total", "frames dropped by the queues of subscribers", lambda: track.dropped_frames
+        )
+    timer_stats = track.sender_timer_stats
+    registry.counter(
+        "x2webrtc_skipped_ticks_total", "capture ticks skipped for being late", lambda: timer_stats.skipped
+    )
+
+    input_stats = input_dispatcher.stats
+    registry.counter("x2webrtc_input_messages_total", "input messages received", lambda: input_stats.received)
+    registry.counter(
+        "x2webrtc_coalesced_motions_total", "mouse moves dropped by coalescing", lambda: input_stats.coalesced
+    )
+
+
+async def _start_metrics(
+    args: argparse.Namespace,
+) -> Tuple[Optional[asyncio.AbstractServer], Optional["asyncio.Future[None]"]]:
+    server: Optional[asyncio.AbstractServer] = None
+    if args.metrics_port is not None:
+        server = await metrics.serve(args.metrics_port)
+
+    # NOTE: `-vv` enables the periodic summary
+    summary_task: Optional["asyncio.Future[None]"] = None
+    if _logger.isEnabledFor(logging.INFO):
+        summary_task = asyncio.ensure_future(metrics.log_summary(METRICS_SUMMARY_INTERVAL))
+    return server, summary_task
+
+
+def _stop_metrics(server: Optional[asyncio.AbstractServer], summary_task: Optional["asyncio.Future[None]"]) -> None:
+    if server is not None:
+        server.close()
+    if summary_task is not None:
+        summary_task.cancel()
 
 
 async def start_forward(args: argparse.Namespace) -> None:
-    loop = asyncio.get_event_loop()
+    display, capture_window, input_window = _get_target_window(args)
+    extra_windows = _get_extra_monitor_windows(args, display)
 
-    display, screen, target_window = _get_target_window(args)
-    track = ScreenCaptureTrack()
-    input_handler = InputHandler()
+    def create_track() -> ScreenCaptureTrack:
+        return ScreenCaptureTrack(
+            fps=args.fps,
+            buffer_depth=args.buffer_depth,
+            latency_budget=args.latency_budget,
+            repeat_frames=not args.skip_static,
+            output_size=args.output_size,
+        )
+
+    track = create_track()
+    extra_tracks = [create_track() for _ in extra_windows]
+    input_handler = InputHandler(lambda: track.video_scale)
+    input_dispatcher = InputDispatcher(input_handler)
     config = load_config()
-    connection = WebRTCClient(config, track, input_handler)
-    quit = threading.Event()
+    adaptation: Optional[AdaptationController] = None
+    if args.adaptive:
+        adaptation = AdaptationController(config.get_adaptation_config(), track)
+    tiles = TileStream() if args.lossless_tiles else None
+    cursor = _create_cursor_stream(args, display, capture_window, track)
+    connection = WebRTCClient(
+        config, track, input_dispatcher, adaptation=adaptation, tiles=tiles, cursor=cursor, extra_tracks=extra_tracks
+    )
+    _register_metrics(track, input_dispatcher)
 
     await connection.connect()
+    metrics_server, summary_task = await _start_metrics(args)
+    capture_tasks: List["asyncio.Future[None]"] = []
     try:
-        # NOTE(igarashi): `forward_screen` might be a CPU-bound task, so we dispatch it to another thread
-        forward_screen_task = loop.run_in_executor(None, forward_screen, target_window, track, quit)
-        input_handler.set_target(target_window)
+        capture_tasks.append(
+            asyncio.ensure_future(
+                run_capture_async(args.capture_mode, capture_window, track, args.pipeline, args.skip_static, tiles)
+            )
+        )
+        capture_tasks.extend(
+            asyncio.ensure_future(
+                run_capture_async(args.capture_mode, window, extra_track, args.pipeline, args.skip_static)
+            )
+            for window, extra_track in zip(extra_windows, extra_tracks)
+        )
+        input_handler.set_target(input_window)
         await connection.wait_until_complete()
     finally:
-        quit.set()
         await connection.disconnect()
-        await forward_screen_task
+        await _stop_capture(capture_tasks)
+        input_dispatcher.close()
+        if tiles is not None:
+            tiles.close()
+        if cursor is not None:
+            cursor.close()
+        _stop_metrics(metrics_server, summary_task)
+
+
+async def _stop_capture(tasks: List["asyncio.Future[None]"]) -> None:
+    for task in tasks:
+        task.cancel()
+    for result in await asyncio.gather(*tasks, return_exceptions=True):
+        if isinstance(result, Exception) and not isinstance(result, asyncio.CancelledError):
+            _logger.error("capture failed: {!r}".format(result))
+
+
+async def _serve_session(track: BroadcastTrack, subscriber: SubscriberTrack, connection: WebRTCClient) -> None:
+    try:
+        await connection.wait_until_complete()
+    finally:
+        track.unsubscribe(subscriber)
+        await connection.disconnect()
+        _logger.info("session closed ({} peers remaining)".format(track.subscriber_count))
+
+
+async def start_serve(args: argparse.Namespace) -> None:
+    display, capture_window, input_window = _get_target_window(args)
+    track = BroadcastTrack(fps=args.fps, max_subscribers=args.max_peers, output_size=args.output_size)
+    input_handler = InputHandler(lambda: track.video_scale)
+    input_handler.set_target(input_window)
+    input_dispatcher = InputDispatcher(input_handler)
+    config = load_config()
+    relay: Optional[EncoderRelay] = None
+    if args.shared_encoder:
+        relay = EncoderRelay(config.get_encoder_relay_config().bitrate_tiers)
+    tiles = TileStream() if args.lossless_tiles else None
+    cursor = _create_cursor_stream(args, display, capture_window, track)
+    sessions: Set["asyncio.Future[None]"] = set()
+    _register_metrics(track, input_dispatcher)
+    metrics_server, summary_task = await _start_metrics(args)
+
+    # NOTE: A single capture loop feeds every peer, so the capture cost does not depend on the number of viewers
+    forward_screen_task = asyncio.ensure_future(
+        run_capture_async(args.capture_mode, capture_window, track, args.pipeline, args.skip_static, tiles)
+    )
+    try:
+        while True:
+            if len(sessions) >= args.max_peers:
+                _, sessions = await asyncio.wait(sessions, return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            subscriber = track.subscribe()
+            connection = WebRTCClient(config, subscriber, input_dispatcher, relay, tiles=tiles, cursor=cursor)
+            try:
+                await connection.connect()
+            except RuntimeError:
+                _logger.exception("failed to establish a new session")
+                track.unsubscribe(subscriber)
+                await connection.disconnect()
+                continue
+
+            sessions.add(asyncio.ensure_future(_serve_session(track, subscriber, connection)))
+            _logger.info("session started ({} peers)".format(track.subscriber_count))
+    finally:
+        for session in sessions:
+            session.cancel()
+        await asyncio.gather(*sessions, return_exceptions=True)
+        await _stop_capture([forward_screen_task])
+        input_dispatcher.close()
+        if tiles is not None:
+            tiles.close()
+        if cursor is not None:
+            cursor.close()
+        _stop_metrics(metrics_server, summary_task)
+
+
+async def start_bench(args: argparse.Namespace) -> None:
+    width, height = args.size
+    options = BenchOptions(
+        width=width,
+        height=height,
+        duration=args.duration,
+        warmup=args.warmup,
+        fps=args.fps,
+        workload_fps=args.workload_fps,
+        capture_backend=args.capture_backend,
+        capture_mode=args.capture_mode,
+        pipelined=args.pipeline,
+    )
+    result = await run_bench(options)
+    if args.json:
+        print(json.dumps(dataclasses.asdict(result)))
+    else:
+        print(result.format())
 
 
 def print_with_tabs(n_tab: int, s: str) -> None:
@@ -87,6 +348,14 @@ async def start_info(args: argparse.Namespace) -> None:
         screen = display.screen(screen_idx)
         screen_size = screen.size
         print_with_tabs(0, "[-] Screen {} (size={}x{})".format(screen_idx, screen_size[0], screen_size[1]))
+        for monitor in screen.monitors():
+            rect = monitor.rect
+            print_with_tabs(
+                2,
+                "- Monitor {}{}: x={}, y={}, w={}, h={}".format(
+                    monitor.name, " (primary)" if monitor.primary else "", rect.x, rect.y, rect.width, rect.height
+                ),
+            )
         traverse_windows(1, screen.root_window, args.props)
 
 
@@ -106,6 +375,64 @@ def set_logger_verbosity(verbosity: int) -> None:
     _logger.addHandler(handler)
 
 
+def add_forward_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument(
+        "--display", type=str, help="display_name of the X server to connect to (e.g., hostname:1, :1.)"
+    )
+    window_group = parser.add_mutually_exclusive_group()
+    window_group.add_argument(
+        "--window-id",
+        type=lambda v: int(v, 0),
+        help="id of the window to forward (e.g., 0x1e00003); the root window is forwarded by default",
+    )
+    window_group.add_argument("--window-class", type=str, help="forward the first window having this WM_CLASS")
+    window_group.add_argument("--window-name", type=str, help="forward the first window having this WM_NAME")
+    parser.add_argument(
+        "--region",
+        type=_parse_region,
+        help="forward only this area of the window, in the form of WIDTHxHEIGHT+X+Y (e.g., 800x600+0+0)",
+    )
+    parser.add_argument(
+        "--capture-backend",
+        type=str,
+        choices=CAPTURE_BACKEND_CHOICES,
+        default="auto",
+        help="method to grab the screen; auto uses MIT-SHM if available (default: auto)",
+    )
+    parser.add_argument(
+        "--capture-mode",
+        type=str,
+        choices=list(GRABBERS.keys()),
+        default="full",
+        help="full grabs the whole window every frame; damage re-reads only changed areas (default: full)",
+    )
+    parser.add_argument("--fps", type=int, default=30, help="frame rate of the video track (default: 30)")
+    parser.add_argument(
+        "--output-size",
+        type=_parse_size,
+        help="scale the screen down to fit in this size, in the form of WIDTHxHEIGHT (e.g., 1280x720), before encoding",
+    )
+    parser.add_argument(
+        "--pipeline", action="store_true", help="capture and convert frames in separate threads to raise throughput"
+    )
+    parser.add_argument(
+        "--skip-static",
+        action="store_true",
+        help="skip frames identical to the previous one and resend a static screen only once a second",
+    )
+    parser.add_argument(
+        "--lossless-tiles",
+        action="store_true",
+        help="also send changed tiles of the screen losslessly, so small text stays crisp on the viewer",
+    )
+    parser.add_argument(
+        "--cursor", action="store_true", help="send the cursor shape and position for the viewer to draw as an overlay"
+    )
+    parser.add_argument(
+        "--metrics-port", type=int, help="serve metrics for Prometheus at http://127.0.0.1:METRICS_PORT/metrics"
+    )
+
+
 def main():
     # NOTE(igarashi): Since `asyncio.run` is unavailable in Python 3.6, we use low-level APIs
     parser = argparse.ArgumentParser(description="x2webrtc")
@@ -115,11 +442,69 @@ def main():
     subparsers = parser.add_subparsers()
 
     forward_parser = subparsers.add_parser("forward", help="forward X Window")
+    add_forward_arguments(forward_parser)
     forward_parser.add_argument(
-        "--display", type=str, help="display_name of the X server to connect to (e.g., hostname:1, :1.)"
+        "--buffer-depth", type=int, default=1, help="number of captured frames buffered for the encoder (default: 1)"
+    )
+    forward_parser.add_argument(
+        "--latency-budget",
+        type=float,
+        default=0.1,
+        help="buffered frames older than this (in seconds) are dropped once a newer one is captured (default: 0.1)",
+    )
+    forward_parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="lower the frame rate, resolution and bitrate on a congested link following the adaptation policy",
+    )
+    forward_parser.add_argument(
+        "--monitors",
+        type=str,
+        help="forward monitors of the root window as separate video tracks; all, or names separated by commas "
+        "(e.g., HDMI-1,DP-1); the first one receives input",
     )
     forward_parser.set_defaults(func=start_forward)
 
+    serve_parser = subparsers.add_parser("serve", help="forward X Window to multiple peers sharing one capture loop")
+    add_forward_arguments(serve_parser)
+    serve_parser.add_argument(
+        "--max-peers", type=int, default=4, help="maximum number of peers connected at the same time (default: 4)"
+    )
+    serve_parser.add_argument(
+        "--shared-encoder",
+        action="store_true",
+        help="encode each frame once per codec and bitrate tier, and send the same bitstream to every peer",
+    )
+    serve_parser.set_defaults(func=start_serve)
+
+    bench_parser = subparsers.add_parser(
+        "bench", help="measure the whole pipeline on a virtual X server with an in-process peer (requires Xvfb)"
+    )
+    bench_parser.add_argument(
+        "--size", type=_parse_size, default=(1280, 720), help="screen size of the virtual X server (default: 1280x720)"
+    )
+    bench_parser.add_argument("--duration", type=float, default=10.0, help="time to measure in seconds (default: 10)")
+    bench_parser.add_argument(
+        "--warmup", type=float, default=2.0, help="time to run before measuring in seconds (default: 2)"
+    )
+    bench_parser.add_argument("--fps", type=int, default=30, help="frame rate of the video track (default: 30)")
+    bench_parser.add_argument(
+        "--workload-fps", type=int, default=60, help="frame rate of the animation drawn on the screen (default: 60)"
+    )
+    bench_parser.add_argument(
+        "--capture-backend",
+        type=str,
+        choices=CAPTURE_BACKEND_CHOICES,
+        default="auto",
+        help="method to grab the screen; auto uses MIT-SHM if available (default: auto)",
+    )
+    bench_parser.add_argument(
+        "--capture-mode", type=str, choices=list(GRABBERS.keys()), default="full", help="(default: full)"
+    )
+    bench_parser.add_argument("--pipeline", action="store_true", help="capture and convert frames in separate threads")
+    bench_parser.add_argument("--json", action="store_true", help="print the result as a JSON object")
+    bench_parser.set_defaults(func=start_bench)
+
     info_parser = subparsers.add_parser("info", help="show window information of the X server")
     info_parser.add_argument(
         "--display", type=str, help="display_name of the X server to connect to (e.g., hostname:1, :1.)"
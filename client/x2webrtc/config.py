@@ -26,16 +26,69 @@ class PeerConnectionConfig:
         return PeerConnectionConfig([IceServer("stun:stun.l.google.com:19302")])
 
 
+@dataclasses.dataclass
+class EncoderRelayConfig:
+    # NOTE: bits per second; each peer uses the highest tier below its estimated bandwidth
+    bitrate_tiers: List[int]
+
+    @classmethod
+    def get_default(cls) -> "EncoderRelayConfig":
+        return EncoderRelayConfig([500000, 1000000, 2000000])
+
+
+@dataclasses.dataclass
+class AdaptationLevel:
+    fps: int
+    # NOTE: in (0, 1]; applied to the captured size, or to the output size if any
+    scale: float
+    # NOTE: bits per second; the level is used while the estimated bandwidth is above this
+    bitrate: int
+
+
+@dataclasses.dataclass
+class AdaptationConfig:
+    # NOTE: from the best to the most degraded one
+    levels: List[AdaptationLevel]
+    interval: float = 1.0
+    degrade_loss: float = 0.1
+    upgrade_loss: float = 0.02
+    degrade_after: int = 2
+    upgrade_after: int = 5
+
+    @classmethod
+    def get_default(cls) -> "AdaptationConfig":
+        return AdaptationConfig(
+            [
+                AdaptationLevel(30, 1.0, 1000000),
+                AdaptationLevel(15, 1.0, 600000),
+                AdaptationLevel(15, 0.5, 300000),
+                AdaptationLevel(10, 0.5, 150000),
+            ]
+        )
+
+
 @dataclasses.dataclass
 class Config:
     peer_connection: Optional[PeerConnectionConfig] = None
     signaling_plugin: Optional[pathlib.Path] = None
+    encoder_relay: Optional[EncoderRelayConfig] = None
+    adaptation: Optional[AdaptationConfig] = None
 
     def get_peer_connection_config(self) -> PeerConnectionConfig:
         if self.peer_connection is not None:
             return self.peer_connection
         return PeerConnectionConfig.get_default()
 
+    def get_encoder_relay_config(self) -> EncoderRelayConfig:
+        if self.encoder_relay is not None:
+            return self.encoder_relay
+        return EncoderRelayConfig.get_default()
+
+    def get_adaptation_config(self) -> AdaptationConfig:
+        if self.adaptation is not None:
+            return self.adaptation
+        return AdaptationConfig.get_default()
+
     @classmethod
     def get_default(cls) -> "Config":
         return Config(None, None)
@@ -0,0 +1,128 @@
+import dataclasses
+import io
+import logging
+import struct
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from aiortc import RTCDataChannel
+from PIL import Image
+
+from x2webrtc.channels import ChannelSet
+from x2webrtc.screen_capture import CursorImage, Window
+from x2webrtc.timer import Timer
+
+_logger = logging.getLogger(__name__)
+
+CURSOR_PROTOCOL = "x2webrtc-cursor-2"
+CURSOR_RATE = 60
+
+# NOTE: Every message starts with (version, kind) in little endian. A shape message continues with
+# (serial of the shape, width, height, x and y of the hotspot) and a PNG image, and a position message
+# with (sequence number, serial of the shape, x, y) where (x, y) is in pixels of the video.
+# Shapes are sent reliably, and positions on an unordered channel without retransmits, so that a lost
+# position never delays the newer ones; the viewer drops a position older than one already received.
+_CURSOR_VERSION = 2
+_CURSOR_SHAPE = 0
+_CURSOR_POSITION = 1
+_SHAPE_HEADER = struct.Struct("<BBxxIHHHH")
+_POSITION = struct.Struct("<BBHIhh")
+
+# NOTE: in seconds; an unchanged position is sent again at this interval, since the last one may be lost
+_POSITION_RESEND_INTERVAL = 0.25
+
+
+def encode_shape(image: CursorImage) -> bytes:
+    height, width = image.pixels.shape[:2]
+    buf = io.BytesIO()
+    Image.fromarray(image.pixels, "RGBA").save(buf, format="PNG")
+    header = _SHAPE_HEADER.pack(_CURSOR_VERSION, _CURSOR_SHAPE, image.serial, width, height, image.xhot, image.yhot)
+    return header + buf.getvalue()
+
+
+def encode_position(seq: int, serial: int, x: int, y: int) -> bytes:
+    x = max(-0x8000, min(x, 0x7FFF))
+    y = max(-0x8000, min(y, 0x7FFF))
+    return _POSITION.pack(_CURSOR_VERSION, _CURSOR_POSITION, seq & 0xFFFF, serial, x, y)
+
+
+@dataclasses.dataclass
+class _Peer:
+    position_channel: RTCDataChannel
+    # NOTE: shapes already sent, which the viewer caches by their serial
+    shapes: Set[int] = dataclasses.field(default_factory=set)
+    last: Optional[Tuple[int, int, int]] = None
+    last_sent: float = 0.0
+    seq: int = 0
+
+
+class CursorStream:
+    """Send the cursor shape and position over data channels for the viewer to draw as an overlay.
+
+    The cursor is not in captured images, and moving it through the video would cost a frame of latency
+    and a re-encode. Here a move costs a message of 12 bytes, and each shape is sent once per viewer.
+    """
+
+    def __init__(
+        self, window: Window, rate: int = CURSOR_RATE, video_scale: Optional[Callable[[], Tuple[float, float]]] = None
+    ) -> None:
+        self._tracker = window.track_cursor()
+        # NOTE: returns the scale of the video against the captured area, as the viewer draws the cursor
+        # over the video
+        self._video_scale = video_scale or (lambda: (1.0, 1.0))
+        self._timer = Timer(rate)
+        # NOTE: shape channels, each with the state of its viewer
+        self._channels: ChannelSet[_Peer] = ChannelSet()
+        # NOTE: encoded shapes by their serial
+        self._shapes: Dict[int, bytes] = {}
+        self._quit = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="x2webrtc-cursor", daemon=True)
+        self._thread.start()
+
+    def attach(self, channel: RTCDataChannel, position_channel: RTCDataChannel) -> None:
+        """Send shapes on a reliable `channel` and positions on an unreliable `position_channel` of a viewer."""
+        self._channels.attach(channel, lambda: _Peer(position_channel))
+
+    def _update(self) -> None:
+        channels = self._channels.items()
+        if len(channels) == 0:
+            return
+
+        serial, x, y = self._tracker.poll()
+        if serial is None or serial not in self._shapes:
+            image = self._tracker.get_image()
+            serial = image.serial
+            if serial not in self._shapes:
+                self._shapes[serial] = encode_shape(image)
+
+        scale_x, scale_y = self._video_scale()
+        x, y = int(x * scale_x), int(y * scale_y)
+        state = (serial, x, y)
+        now = time.monotonic()
+        messages: List[Tuple[RTCDataChannel, bytes]] = []
+        for channel, peer in channels:
+            if serial not in peer.shapes:
+                messages.append((channel, self._shapes[serial]))
+                peer.shapes.add(serial)
+            if state == peer.last and now - peer.last_sent < _POSITION_RESEND_INTERVAL:
+                continue
+            peer.seq += 1
+            messages.append((peer.position_channel, encode_position(peer.seq, serial, x, y)))
+            peer.last = state
+            peer.last_sent = now
+
+        self._channels.send(messages)
+
+    def _run(self) -> None:
+        while not self._quit.is_set():
+            self._timer.wait()
+            try:
+                self._update()
+            except Exception:
+                _logger.exception("got an unexpected error")
+
+    def close(self) -> None:
+        self._quit.set()
+        self._thread.join()
+        self._tracker.close()
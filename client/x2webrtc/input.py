@@ -1,33 +1,79 @@
+import collections
+import dataclasses
 import logging
 import threading
-from typing import Optional, Tuple
+import time
+from typing import Callable, List, Optional, Sequence, Tuple, Union
 
 import Xlib.X
 
-from x2webrtc import models
+from x2webrtc import metrics, models
+from x2webrtc.keymap import KeycodeTable
 from x2webrtc.screen_capture import Window
 
 _logger = logging.getLogger(__name__)
 
+_INPUT_LATENCY_SECONDS = metrics.REGISTRY.histogram(
+    "x2webrtc_input_latency_seconds", "time from receiving an input message to injecting its events"
+)
+_INJECT_SECONDS = metrics.REGISTRY.histogram("x2webrtc_inject_seconds", "time to inject a batch of input events")
+
+
+def coalesce_motion(events: Sequence[models.EventTypes]) -> List[models.EventTypes]:
+    """Drop mouse moves immediately followed by another mouse move.
+
+    Only the last position of a run matters, and the order against the other events is kept.
+    """
+    ret: List[models.EventTypes] = []
+    for ev in events:
+        if isinstance(ev, models.MouseMoveEvent) and len(ret) > 0 and isinstance(ret[-1], models.MouseMoveEvent):
+            ret[-1] = ev
+        else:
+            ret.append(ev)
+    return ret
+
+
+# NOTE: X11 maps wheels to buttons: 4 (up), 5 (down), 6 (left) and 7 (right)
+_WHEEL_BUTTONS = ((6, 7), (4, 5))
+
+
+def _wheel_inputs(delta: int, buttons: Tuple[int, int]) -> List[Tuple[int, int, int, int]]:
+    button = buttons[0] if delta < 0 else buttons[1]
+    return [(t, button, 0, 0) for _ in range(abs(delta)) for t in (Xlib.X.ButtonPress, Xlib.X.ButtonRelease)]
+
 
 class InputHandler:
-    def __init__(self) -> None:
+    def __init__(self, video_scale: Optional[Callable[[], Tuple[float, float]]] = None) -> None:
+        # NOTE: returns the scale of the video against the capture region, as positions in the video
+        # are mapped back to the region
+        self._video_scale = video_scale or (lambda: (1.0, 1.0))
         self._target: Optional[Window] = None
+        self._keycodes: Optional[KeycodeTable] = None
         self._lock = threading.RLock()
 
     def set_target(self, target: Optional[Window]) -> None:
         with self._lock:
+            if self._target is not None and self._keycodes is not None:
+                self._target.remove_event_handler(self._keycodes.on_event)
+
             self._target = target
+            self._keycodes = None
+            if target is not None:
+                self._keycodes = KeycodeTable(target)
+                target.add_event_handler(self._keycodes.on_event)
+
+    def _from_video(self, x: int, y: int) -> Tuple[int, int]:
+        scale_x, scale_y = self._video_scale()
+        return int(x / scale_x), int(y / scale_y)
 
     def _translate_coords_from_root(self, x: int, y: int) -> Tuple[int, int]:
         with self._lock:
             assert self._target is not None
-            # root = self._target._screen.root
-            # ret = root.translate_coords(self._target._window, x, y)
-            # NOTE(igarashi): The result of translate_coords from root to the window seems to be the same
-            # as the following code.
-            rect = self._target.rect
-            return x + rect.x, y + rect.y
+            # NOTE: `geometry` holds the result of translate_coords from the window to root,
+            # and the video only shows the capture region of the window.
+            geo = self._target.geometry
+            region = self._target.capture_rect
+            return x + geo.x + region.x, y + geo.y + region.y
 
     def move_to(self, x: int, y: int, relative: bool = True) -> None:
         with self._lock:
@@ -35,7 +81,7 @@ class InputHandler:
                 return
 
             if relative:
-                x, y = self._translate_coords_from_root(x, y)
+                x, y = self._translate_coords_from_root(*self._from_video(x, y))
 
             _logger.debug("send: motion_notidy, pos=({}, {})".format(x, y))
             self._target.fake_input(Xlib.X.MotionNotify, x=x, y=y)
@@ -61,18 +107,209 @@ class InputHandler:
             self.mouse_down(button)
             self.mouse_up(button)
 
+    def _to_inputs(self, ev: models.EventTypes, offset_x: int, offset_y: int) -> List[Tuple[int, int, int, int]]:
+        if isinstance(ev, models.MouseMoveEvent):
+            x, y = self._from_video(ev.x, ev.y)
+            return [(Xlib.X.MotionNotify, 0, x + offset_x, y + offset_y)]
+        elif isinstance(ev, models.MouseButtonEvent):
+            if ev.event_kind == models.ButtonEventKind.BUTTON_UP:
+                return [(Xlib.X.ButtonRelease, ev.button_kind.to_X11(), 0, 0)]
+            elif ev.event_kind == models.ButtonEventKind.BUTTON_DOWN:
+                return [(Xlib.X.ButtonPress, ev.button_kind.to_X11(), 0, 0)]
+            _logger.error("unknown event kind: {}".format(ev.event_kind))
+        elif isinstance(ev, models.KeyEvent):
+            assert self._keycodes is not None
+            keycode = self._keycodes.lookup(ev.code)
+            if keycode is None:
+                _logger.warning("unknown key: {}".format(ev.code))
+            elif ev.event_kind == models.ButtonEventKind.BUTTON_UP:
+                return [(Xlib.X.KeyRelease, keycode, 0, 0)]
+            else:
+                return [(Xlib.X.KeyPress, keycode, 0, 0)]
+        elif isinstance(ev, models.WheelEvent):
+            return _wheel_inputs(ev.delta_x, _WHEEL_BUTTONS[0]) + _wheel_inputs(ev.delta_y, _WHEEL_BUTTONS[1])
+        return []
+
     def send(self, message: models.InputReport) -> None:
+        """Inject the events of a report as one batch flushed at once."""
         with self._lock:
-            for ev in message.events:
+            if self._target is None:
+                return
+
+            # NOTE: the geometry is cached, so this costs no round trip
+            offset_x, offset_y = self._translate_coords_from_root(0, 0)
+            inputs: List[Tuple[int, int, int, int]] = []
+            for ev in coalesce_motion(message.events):
+                # NOTE: a malformed event is skipped alone, so that the others (e.g. a button release) still apply
                 try:
-                    if isinstance(ev, models.MouseMoveEvent):
-                        self.move_to(ev.x, ev.y, True)
-                    elif isinstance(ev, models.MouseButtonEvent):
-                        if ev.event_kind == models.ButtonEventKind.BUTTON_UP:
-                            self.mouse_up(ev.button_kind)
-                        elif ev.event_kind == models.ButtonEventKind.BUTTON_DOWN:
-                            self.mouse_down(ev.button_kind)
-                        else:
-                            _logger.error("unknown event kind: {}".format(ev.event_kind))
+                    inputs.extend(self._to_inputs(ev, offset_x, offset_y))
                 except Exception:
                     _logger.exception("got an unexpected error")
+
+            _logger.debug("send: {} inputs ({} events)".format(len(inputs), len(message.events)))
+            self._target.fake_inputs(inputs)
+
+
+@dataclasses.dataclass
+class InputStats:
+    # NOTE: messages received from the control channel
+    received: int = 0
+    # NOTE: queued messages merged into one because the queue was full
+    merged: int = 0
+    # NOTE: mouse moves dropped by coalescing
+    coalesced: int = 0
+    # NOTE: time from receiving a message to injecting its events in seconds
+    max_latency: float = 0.0
+    _injected: int = 0
+    _total_latency: float = 0.0
+
+    @property
+    def mean_latency(self) -> float:
+        if self._injected == 0:
+            return 0.0
+        return self._total_latency / self._injected
+
+    def record_latency(self, latency: float) -> None:
+        self._injected += 1
+        self._total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+
+_Message = Union[str, bytes, models.InputReport]
+
+
+@dataclasses.dataclass
+class _Batch:
+    """Queued messages folded into one entry when the queue was full, still unparsed."""
+
+    entries: List[Tuple[float, _Message]]
+    # NOTE: received times of mouse moves replaced by a later one, which is injected for them
+    superseded: List[float]
+
+
+def _is_motion_only(item: Union[_Message, _Batch]) -> bool:
+    return isinstance(item, models.InputReport) and all(isinstance(ev, models.MouseMoveEvent) for ev in item.events)
+
+
+class InputDispatcher:
+    """Parse and inject messages of the control channel on a dedicated thread.
+
+    `put` never blocks the event loop. Messages queued while the X server is slow are injected
+    as one batch with their mouse moves coalesced, and when the queue is full, the queued
+    messages are folded into one entry, so no button event is lost.
+    """
+
+    def __init__(self, handler: InputHandler, queue_size: int = 64) -> None:
+        if queue_size < 1:
+            raise RuntimeError("queue_size must be positive: {}".format(queue_size))
+
+        self._handler = handler
+        self._queue_size = queue_size
+        self._queue: "collections.deque[Tuple[float, Union[_Message, _Batch]]]" = collections.deque()
+        self._cond = threading.Condition()
+        self._closed = False
+        self.stats = InputStats()
+        self._thread = threading.Thread(target=self._run, name="x2webrtc-input", daemon=True)
+        self._thread.start()
+
+    def _parse(self, item: _Message) -> Optional[models.InputReport]:
+        if isinstance(item, models.InputReport):
+            return item
+
+        try:
+            message = models.decode(item)
+        except Exception:
+            _logger.exception("failed to parse a message")
+            return None
+
+        if not isinstance(message, models.InputReport):
+            _logger.error("unexpected message: {}".format(message.kind))
+            return None
+        return message
+
+    def _fold_queued(self) -> None:
+        # NOTE: called on the event loop with `_cond` held when the injector falls behind, so nothing is parsed
+        # here. Mouse moves already parsed by the motion channel are coalesced to keep the batch small.
+        # Only the first entry can be a batch folded before, and it is extended in place.
+        first_received_at, first = self._queue.popleft()
+        batch = first if isinstance(first, _Batch) else _Batch([(first_received_at, first)], [])
+        merged = len(self._queue)
+        for received_at, item in self._queue:
+            assert not isinstance(item, _Batch)
+            self._append_to_batch(batch, received_at, item)
+
+        self.stats.merged += merged
+        self._queue.clear()
+        self._queue.append((batch.entries[0][0], batch))
+
+    @staticmethod
+    def _append_to_batch(batch: _Batch, received_at: float, item: _Message) -> None:
+        if len(batch.entries) > 0 and _is_motion_only(item) and _is_motion_only(batch.entries[-1][1]):
+            batch.superseded.append(batch.entries[-1][0])
+            batch.entries[-1] = (received_at, item)
+        else:
+            batch.entries.append((received_at, item))
+
+    def put(self, message: _Message) -> None:
+        with self._cond:
+            if self._closed:
+                return
+
+            self.stats.received += 1
+            if len(self._queue) >= self._queue_size:
+                self._fold_queued()
+            self._queue.append((time.monotonic(), message))
+            self._cond.notify()
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while len(self._queue) == 0 and not self._closed:
+                    self._cond.wait()
+                if len(self._queue) == 0:
+                    return
+
+                entries = list(self._queue)
+                self._queue.clear()
+
+            events: List[models.EventTypes] = []
+            received: List[float] = []
+            for received_at, item in entries:
+                if isinstance(item, _Batch):
+                    messages = item.entries
+                    received.extend(item.superseded)
+                else:
+                    messages = [(received_at, item)]
+
+                for message_received_at, message in messages:
+                    report = self._parse(message)
+                    if report is not None:
+                        events.extend(report.events)
+                        received.append(message_received_at)
+
+            coalesced = coalesce_motion(events)
+            self.stats.coalesced += len(events) - len(coalesced)
+            start = time.monotonic()
+            try:
+                self._handler.send(models.InputReport(coalesced))
+            except Exception:
+                _logger.exception("got an unexpected error")
+
+            now = time.monotonic()
+            _INJECT_SECONDS.observe(now - start)
+            for received_at in received:
+                self.stats.record_latency(now - received_at)
+                _INPUT_LATENCY_SECONDS.observe(now - received_at)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+        stats = self.stats
+        _logger.info(
+            "input: received={}, merged={}, coalesced={}, latency mean={:.3f}s max={:.3f}s".format(
+                stats.received, stats.merged, stats.coalesced, stats.mean_latency, stats.max_latency
+            )
+        )
@@ -0,0 +1,110 @@
+import logging
+import string
+from typing import Any, Dict, Optional
+
+import Xlib.X
+import Xlib.XK
+from Xlib.protocol import event
+
+from x2webrtc.screen_capture import Window
+
+_logger = logging.getLogger(__name__)
+
+
+def _build_dom_code_keysym_names() -> Dict[str, str]:
+    # NOTE: `KeyboardEvent.code` names a physical key, so each one is mapped to the keysym of its unshifted
+    # level on the US layout, and the X server finds the key bound to it on the current layout.
+    names = {
+        "Enter": "Return",
+        "Escape": "Escape",
+        "Backspace": "BackSpace",
+        "Tab": "Tab",
+        "Space": "space",
+        "Minus": "minus",
+        "Equal": "equal",
+        "BracketLeft": "bracketleft",
+        "BracketRight": "bracketright",
+        "Backslash": "backslash",
+        "Semicolon": "semicolon",
+        "Quote": "apostrophe",
+        "Backquote": "grave",
+        "Comma": "comma",
+        "Period": "period",
+        "Slash": "slash",
+        "CapsLock": "Caps_Lock",
+        "PrintScreen": "Print",
+        "ScrollLock": "Scroll_Lock",
+        "Pause": "Pause",
+        "Insert": "Insert",
+        "Home": "Home",
+        "PageUp": "Prior",
+        "Delete": "Delete",
+        "End": "End",
+        "PageDown": "Next",
+        "ArrowRight": "Right",
+        "ArrowLeft": "Left",
+        "ArrowDown": "Down",
+        "ArrowUp": "Up",
+        "NumLock": "Num_Lock",
+        "NumpadDivide": "KP_Divide",
+        "NumpadMultiply": "KP_Multiply",
+        "NumpadSubtract": "KP_Subtract",
+        "NumpadAdd": "KP_Add",
+        "NumpadEnter": "KP_Enter",
+        "NumpadDecimal": "KP_Decimal",
+        "ContextMenu": "Menu",
+        "ShiftLeft": "Shift_L",
+        "ShiftRight": "Shift_R",
+        "ControlLeft": "Control_L",
+        "ControlRight": "Control_R",
+        "AltLeft": "Alt_L",
+        "AltRight": "Alt_R",
+        "MetaLeft": "Super_L",
+        "MetaRight": "Super_R",
+    }
+    for c in string.ascii_uppercase:
+        names["Key{}".format(c)] = c.lower()
+    for d in string.digits:
+        names["Digit{}".format(d)] = d
+        names["Numpad{}".format(d)] = "KP_{}".format(d)
+    for i in range(1, 25):
+        names["F{}".format(i)] = "F{}".format(i)
+    return names
+
+
+DOM_CODE_KEYSYM_NAMES = _build_dom_code_keysym_names()
+
+
+class KeycodeTable:
+    """A table from `KeyboardEvent.code` to keycodes of the X server.
+
+    The table is built once from the keyboard mapping cached by Xlib, and rebuilt only when
+    a MappingNotify event tells that the mapping has changed, so a keystroke costs a dict lookup.
+    """
+
+    def __init__(self, window: Window) -> None:
+        self._window = window
+        self._table: Dict[str, int] = {}
+        self.rebuild()
+
+    def rebuild(self) -> None:
+        table = {}
+        for code, name in DOM_CODE_KEYSYM_NAMES.items():
+            keysym = Xlib.XK.string_to_keysym(name)
+            if keysym == Xlib.X.NoSymbol:
+                continue
+            keycode = self._window.keysym_to_keycode(keysym)
+            if keycode != 0:
+                table[code] = keycode
+
+        # NOTE: replacing the whole dict is atomic, so `lookup` never sees a partial table
+        self._table = table
+        _logger.debug("built a keycode table of {} keys".format(len(table)))
+
+    def lookup(self, code: str) -> Optional[int]:
+        return self._table.get(code)
+
+    def on_event(self, ev: Any) -> None:
+        if isinstance(ev, event.MappingNotify) and ev.request == Xlib.X.MappingKeyboard:
+            self._window.refresh_keyboard_mapping(ev)
+            self.rebuild()
@@ -0,0 +1,198 @@
+import asyncio
+import bisect
+import logging
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+_logger = logging.getLogger(__name__)
+
+# NOTE: in seconds; covers both a sub-millisecond copy and a capture of a large screen over the network
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+
+class Counter:
+    """A monotonically increasing value, either incremented in place or read from `func` on collection."""
+
+    def __init__(self, name: str, help: str, func: Optional[Callable[[], float]] = None) -> None:
+        self.name = name
+        self.help = help
+        self._func = func
+        self._value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1.0) -> None:
+        with self._lock:
+            self._value += value
+
+    @property
+    def value(self) -> float:
+        if self._func is not None:
+            return self._func()
+        return self._value
+
+
+class Gauge:
+    """A value which can go up and down, read from `func` on collection."""
+
+    def __init__(self, name: str, help: str, func: Callable[[], float]) -> None:
+        self.name = name
+        self.help = help
+        self._func = func
+
+    @property
+    def value(self) -> float:
+        return self._func()
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> None:
+        self.name = name
+        self.help = help
+        self._buckets = sorted(buckets)
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        i = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self._sum += value
+            self._count += 1
+
+    def snapshot(self) -> Tuple[List[Tuple[float, int]], float, int]:
+        """Return cumulative counts of each bucket, the sum and the count of observations."""
+        with self._lock:
+            counts = list(self._counts)
+            total, count = self._sum, self._count
+
+        cumulative = []
+        acc = 0
+        for bound, c in zip(self._buckets + [float("inf")], counts):
+            acc += c
+            cumulative.append((bound, acc))
+        return cumulative, total, count
+
+
+Metric = Union[Counter, Gauge, Histogram]
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class MetricsRegistry:
+    def __init__(self) -> None:
+        self._metrics: Dict[str, Metric] = {}
+        self._lock = threading.Lock()
+        self._last_summary: Dict[str, Tuple[float, int]] = {}
+
+    def _register(self, metric: Metric) -> None:
+        with self._lock:
+            # NOTE: a metric registered again (e.g., for a new track) replaces the old one
+            self._metrics[metric.name] = metric
+
+    def counter(self, name: str, help: str, func: Optional[Callable[[], float]] = None) -> Counter:
+        counter = Counter(name, help, func)
+        self._register(counter)
+        return counter
+
+    def gauge(self, name: str, help: str, func: Callable[[], float]) -> Gauge:
+        gauge = Gauge(name, help, func)
+        self._register(gauge)
+        return gauge
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        histogram = Histogram(name, help, buckets)
+        self._register(histogram)
+        return histogram
+
+    def _collect(self) -> List[Metric]:
+        with self._lock:
+            return sorted(self._metrics.values(), key=lambda m: m.name)
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format."""
+        lines = []
+        for metric in self._collect():
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            if isinstance(metric, Histogram):
+                lines.append("# TYPE {} histogram".format(metric.name))
+                buckets, total, count = metric.snapshot()
+                for bound, c in buckets:
+                    lines.append('{}_bucket{{le="{}"}} {}'.format(metric.name, _format_value(bound), c))
+                lines.append("{}_sum {}".format(metric.name, _format_value(total)))
+                lines.append("{}_count {}".format(metric.name, count))
+            else:
+                kind = "counter" if isinstance(metric, Counter) else "gauge"
+                lines.append("# TYPE {} {}".format(metric.name, kind))
+                lines.append("{} {}".format(metric.name, _format_value(metric.value)))
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """Summarize the metrics since the previous call in one line.
+
+        Counters are shown as increments and histograms as the number and the mean of new observations.
+        """
+        items = []
+        for metric in self._collect():
+            name = metric.name[len("x2webrtc_") :] if metric.name.startswith("x2webrtc_") else metric.name
+            if isinstance(metric, Histogram):
+                _, total, count = metric.snapshot()
+                last_total, last_count = self._last_summary.get(metric.name, (0.0, 0))
+                self._last_summary[metric.name] = (total, count)
+                n = count - last_count
+                mean = (total - last_total) / n if n > 0 else 0.0
+                items.append("{}={}/{:.2f}ms".format(name, n, mean * 1000))
+            elif isinstance(metric, Counter):
+                value = metric.value
+                last, _ = self._last_summary.get(metric.name, (0.0, 0))
+                self._last_summary[metric.name] = (value, 0)
+                items.append("{}=+{:g}".format(name, value - last))
+            else:
+                items.append("{}={:g}".format(name, metric.value))
+        return ", ".join(items)
+
+
+REGISTRY = MetricsRegistry()
+
+
+async def _handle_request(
+    registry: MetricsRegistry, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+) -> None:
+    try:
+        request_line = await reader.readline()
+        # NOTE: skip the headers
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1] == "/metrics":
+            body = registry.render().encode("utf-8")
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n")
+        else:
+            body = b"not found\n"
+            writer.write(b"HTTP/1.0 404 Not Found\r\nContent-Type: text/plain\r\n")
+        writer.write("Content-Length: {}\r\n\r\n".format(len(body)).encode("latin-1"))
+        writer.write(body)
+        await writer.drain()
+    except Exception:
+        _logger.exception("failed to handle a metrics request")
+    finally:
+        writer.close()
+
+
+async def serve(port: int, host: str = "127.0.0.1", registry: MetricsRegistry = REGISTRY) -> asyncio.AbstractServer:
+    """Serve the metrics at http://host:port/metrics for Prometheus."""
+    server = await asyncio.start_server(lambda r, w: _handle_request(registry, r, w), host, port)
+    _logger.info("serving metrics at http://{}:{}/metrics".format(host, port))
+    return server
+
+
+async def log_summary(interval: float, registry: MetricsRegistry = REGISTRY) -> None:
+    while True:
+        await asyncio.sleep(interval)
+        _logger.info("metrics: {}".format(registry.summary()))
@@ -1,7 +1,8 @@
 import enum
 import json
+import struct
 from dataclasses import asdict, dataclass, field
-from typing import Any, Dict, List, Mapping, Type, TypeVar, Union, cast
+from typing import Any, Callable, Dict, FrozenSet, List, Mapping, Tuple, Type, TypeVar, Union, cast
 
 import dacite
 
@@ -49,6 +50,14 @@ class MouseButtonKind(TupleEnum):
     def to_X11(self) -> int:
         return self.get_value()
 
+    @classmethod
+    def from_X11(cls, value: int) -> "MouseButtonKind":
+        for entry in cls:
+            if entry.get_value() == value:
+                return entry
+
+        raise ValueError("unknown button: {}".format(value))
+
 
 class ButtonEventKind(enum.Enum):
     BUTTON_DOWN = 0
@@ -62,10 +71,28 @@ class MouseButtonEvent(EventBase):
     event_kind: ButtonEventKind
 
 
-EventTypes = Union[MouseMoveEvent, MouseButtonEvent]
+@dataclass
+class KeyEvent(EventBase):
+    kind: str = field(default="key", init=False)
+    # NOTE: `KeyboardEvent.code` of DOM, which names a physical key (e.g., "KeyA", "ShiftLeft")
+    code: str
+    event_kind: ButtonEventKind
+
+
+@dataclass
+class WheelEvent(EventBase):
+    kind: str = field(default="wheel", init=False)
+    # NOTE: in steps; positive values scroll right and down
+    delta_x: int
+    delta_y: int
+
+
+EventTypes = Union[MouseMoveEvent, MouseButtonEvent, KeyEvent, WheelEvent]
 EVENT_TYPE_MAP: Dict[str, Type[EventTypes]] = {
     MouseMoveEvent.kind: MouseMoveEvent,
     MouseButtonEvent.kind: MouseButtonEvent,
+    KeyEvent.kind: KeyEvent,
+    WheelEvent.kind: WheelEvent,
 }
 
 
@@ -128,7 +155,7 @@ def _parse_event(data: Any, type_map: Mapping[str, Type[T]]) -> T:
     return cast(T, ret)
 
 
-def from_dict(data: Any) -> MessageBase:
+def _from_dict_dacite(data: Any) -> MessageBase:
     ret_type = _find_type(data, MESSAGE_TYPE_MAP)
     return cast(
         MessageBase,
@@ -148,6 +175,93 @@ def from_dict(data: Any) -> MessageBase:
     )
 
 
+# NOTE: The following decoders do the same as `_from_dict_dacite` including errors,
+# but dispatch on `kind` directly. dacite costs too much for mouse moves streamed at a high rate.
+
+
+def _get_field(data: Any, name: str, path: str = "") -> Any:
+    try:
+        return data[name]
+    except KeyError:
+        raise dacite.MissingValueError(path + name)
+
+
+def _check_fields(data: Dict[str, Any], names: FrozenSet[str], path: str = "") -> None:
+    for name in names:
+        if name not in data:
+            raise dacite.MissingValueError(path + name)
+    if len(data) > len(names):
+        raise dacite.UnexpectedDataError(set(data.keys()) - names)
+
+
+def _get_kind(data: Any, type_map: Mapping[str, Any], path: str = "") -> str:
+    kind = _get_field(data, "kind", path)
+    if not isinstance(kind, str):
+        raise dacite.WrongTypeError(str, kind, path + "kind")
+    if kind not in type_map:
+        raise RuntimeError("unknown type: {} [must be one of {}]".format(kind, ", ".join(type_map.keys())))
+    return kind
+
+
+_MOUSE_MOVE_FIELDS = frozenset(["kind", "x", "y"])
+_MOUSE_BUTTON_FIELDS = frozenset(["kind", "button_kind", "event_kind"])
+_KEY_FIELDS = frozenset(["kind", "code", "event_kind"])
+_WHEEL_FIELDS = frozenset(["kind", "delta_x", "delta_y"])
+_INPUT_REPORT_FIELDS = frozenset(["kind", "events"])
+
+
+def _decode_mouse_move(data: Dict[str, Any]) -> MouseMoveEvent:
+    _check_fields(data, _MOUSE_MOVE_FIELDS, "events.")
+    return MouseMoveEvent(_parse_int(data["x"]), _parse_int(data["y"]))
+
+
+def _decode_mouse_button(data: Dict[str, Any]) -> MouseButtonEvent:
+    _check_fields(data, _MOUSE_BUTTON_FIELDS, "events.")
+    return MouseButtonEvent(
+        MouseButtonKind.parse_representative(data["button_kind"]), ButtonEventKind(data["event_kind"])
+    )
+
+
+def _decode_key(data: Dict[str, Any]) -> KeyEvent:
+    _check_fields(data, _KEY_FIELDS, "events.")
+    code = data["code"]
+    if not isinstance(code, str):
+        raise dacite.WrongTypeError(str, code, "events.code")
+    return KeyEvent(code, ButtonEventKind(data["event_kind"]))
+
+
+def _decode_wheel(data: Dict[str, Any]) -> WheelEvent:
+    _check_fields(data, _WHEEL_FIELDS, "events.")
+    return WheelEvent(_parse_int(data["delta_x"]), _parse_int(data["delta_y"]))
+
+
+_EVENT_DECODERS: Dict[str, Callable[[Dict[str, Any]], EventTypes]] = {
+    MouseMoveEvent.kind: _decode_mouse_move,
+    MouseButtonEvent.kind: _decode_mouse_button,
+    KeyEvent.kind: _decode_key,
+    WheelEvent.kind: _decode_wheel,
+}
+
+
+def _decode_input_report(data: Dict[str, Any]) -> InputReport:
+    _check_fields(data, _INPUT_REPORT_FIELDS)
+    events = data["events"]
+    if not isinstance(events, list):
+        raise dacite.WrongTypeError(List[EventTypes], events, "events")
+
+    decoders = _EVENT_DECODERS
+    return InputReport([decoders[_get_kind(ev, decoders, "events.")](ev) for ev in events])
+
+
+_MESSAGE_DECODERS: Dict[str, Callable[[Dict[str, Any]], MessageType]] = {
+    InputReport.kind: _decode_input_report,
+}
+
+
+def from_dict(data: Any) -> MessageBase:
+    return _MESSAGE_DECODERS[_get_kind(data, _MESSAGE_DECODERS)](data)
+
+
 def to_dict(data: MessageBase) -> Dict[str, Any]:
     return asdict(data)
 
@@ -168,3 +282,85 @@ def from_json(s: str) -> MessageBase:
 
 def to_json(data: MessageBase) -> str:
     return json.dumps(to_dict(data), default=_serialize_object)
+
+
+# NOTE: The binary format is used only when the viewer accepts this data channel protocol; JSON is the fallback.
+# A message is a header (version, number of events) followed by fixed-size event records of
+# (event type, button, button event kind, x, y, timestamp in milliseconds), all in little endian.
+# The timestamp is the clock of the viewer and is not used for injection.
+# Reports including the other events (keys and wheels) are sent in JSON.
+BINARY_PROTOCOL = "x2webrtc-binary-1"
+_BINARY_VERSION = 1
+_BINARY_HEADER = struct.Struct("<BxH")
+_BINARY_EVENT = struct.Struct("<BBBxHHI")
+_BINARY_MOUSE_MOVE = 0
+_BINARY_MOUSE_BUTTON = 1
+
+
+def to_binary(data: InputReport, timestamp: int = 0) -> bytes:
+    buf = bytearray(_BINARY_HEADER.size + _BINARY_EVENT.size * len(data.events))
+    _BINARY_HEADER.pack_into(buf, 0, _BINARY_VERSION, len(data.events))
+    offset = _BINARY_HEADER.size
+    for ev in data.events:
+        if isinstance(ev, MouseMoveEvent):
+            _BINARY_EVENT.pack_into(buf, offset, _BINARY_MOUSE_MOVE, 0, 0, ev.x, ev.y, timestamp)
+        elif isinstance(ev, MouseButtonEvent):
+            _BINARY_EVENT.pack_into(
+                buf, offset, _BINARY_MOUSE_BUTTON, ev.button_kind.to_X11(), ev.event_kind.value, 0, 0, timestamp
+            )
+        else:
+            raise RuntimeError("the binary format does not support the event: {}".format(ev.kind))
+        offset += _BINARY_EVENT.size
+    return bytes(buf)
+
+
+def from_binary(data: bytes) -> InputReport:
+    if len(data) < _BINARY_HEADER.size:
+        raise RuntimeError("too short message: {} bytes".format(len(data)))
+
+    version, count = _BINARY_HEADER.unpack_from(data)
+    if version != _BINARY_VERSION:
+        raise RuntimeError("unsupported binary format version: {}".format(version))
+    if len(data) != _BINARY_HEADER.size + _BINARY_EVENT.size * count:
+        raise RuntimeError("message size mismatch: {} bytes for {} events".format(len(data), count))
+
+    events: List[EventTypes] = []
+    for event_type, button, event_kind, x, y, _ in _BINARY_EVENT.iter_unpack(memoryview(data)[_BINARY_HEADER.size :]):
+        if event_type == _BINARY_MOUSE_MOVE:
+            events.append(MouseMoveEvent(x, y))
+        elif event_type == _BINARY_MOUSE_BUTTON:
+            events.append(MouseButtonEvent(MouseButtonKind.from_X11(button), ButtonEventKind(event_kind)))
+        else:
+            raise RuntimeError("unknown event type: {}".format(event_type))
+    return InputReport(events)
+
+
+# NOTE: Pointer motion is sent on an unreliable and unordered data channel, one message per move, as
+# (version, sequence number, x, y, timestamp in milliseconds). The receiver drops a move older than the latest one.
+_BINARY_MOTION = struct.Struct("<BxxxIHHI")
+
+
+def is_newer_seq(seq: int, last: int) -> bool:
+    # NOTE: serial number arithmetic (RFC 1982), so that the wraparound of 32-bit sequence numbers is handled
+    return 0 < (seq - last) & 0xFFFFFFFF < 0x80000000
+
+
+def to_binary_motion(seq: int, event: MouseMoveEvent, timestamp: int = 0) -> bytes:
+    return _BINARY_MOTION.pack(_BINARY_VERSION, seq, event.x, event.y, timestamp)
+
+
+def from_binary_motion(data: bytes) -> Tuple[int, MouseMoveEvent]:
+    if len(data) != _BINARY_MOTION.size:
+        raise RuntimeError("message size mismatch: {} bytes for a motion".format(len(data)))
+
+    version, seq, x, y, _ = _BINARY_MOTION.unpack(data)
+    if version != _BINARY_VERSION:
+        raise RuntimeError("unsupported binary format version: {}".format(version))
+    return seq, MouseMoveEvent(x, y)
+
+
+def decode(message: Union[str, bytes]) -> MessageBase:
+    """Decode a message of the control data channel in either format."""
+    if isinstance(message, bytes):
+        return from_binary(message)
+    return from_json(message)
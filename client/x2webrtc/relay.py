@@ -0,0 +1,177 @@
+import collections
+import logging
+import threading
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from aiortc import RTCPeerConnection, RTCRtpCodecParameters
+from aiortc.codecs import get_encoder
+from av import VideoFrame
+
+_logger = logging.getLogger(__name__)
+
+_CACHE_SIZE = 8
+
+# NOTE: in seconds; a keyframe requested by a peer sooner than this after the last one waits, since every peer
+# sharing the encoder pays for its bitrate spike
+MIN_KEYFRAME_INTERVAL = 0.5
+
+
+class _EncodedFrame:
+    __slots__ = ("seq", "pts", "payloads", "timestamp", "keyframe")
+
+    def __init__(self, seq: int, pts: int, payloads: List[bytes], timestamp: int, keyframe: bool) -> None:
+        self.seq = seq
+        self.pts = pts
+        self.payloads = payloads
+        self.timestamp = timestamp
+        self.keyframe = keyframe
+
+
+class SharedEncoder:
+    """An encoder whose output is shared by every peer bound to the same (codec, bitrate tier).
+
+    Frames must be passed in the order of their `pts`, which holds for the frames fed by `BroadcastTrack`.
+    """
+
+    def __init__(
+        self, codec: RTCRtpCodecParameters, bitrate: int, min_keyframe_interval: float = MIN_KEYFRAME_INTERVAL
+    ) -> None:
+        self._encoder = get_encoder(codec)
+        if hasattr(self._encoder, "target_bitrate"):
+            self._encoder.target_bitrate = bitrate
+        self._lock = threading.Lock()
+        self._cache: "collections.OrderedDict[int, _EncodedFrame]" = collections.OrderedDict()
+        self._seq = 0
+        self._last_pts: Optional[int] = None
+        self._keyframe_requested = True
+        self._min_keyframe_interval = min_keyframe_interval
+        # NOTE: in seconds of the frame timestamps
+        self._last_keyframe: Optional[float] = None
+
+    def request_keyframe(self) -> None:
+        self._keyframe_requested = True
+
+    def encode(self, frame: VideoFrame) -> Optional[_EncodedFrame]:
+        """Encode the frame, or return the result encoded for another peer.
+
+        Returns None when the frame is older than anything we can still serve.
+        """
+        pts = frame.pts
+        if pts is None or frame.time_base is None:
+            raise RuntimeError("a shared encoder needs frames with timestamps")
+
+        with self._lock:
+            cached = self._cache.get(pts)
+            if cached is not None:
+                return cached
+
+            if self._last_pts is not None and pts <= self._last_pts:
+                return None
+
+            # NOTE: Keyframe requests from every peer since the last encode are coalesced into one keyframe
+            current = float(pts * frame.time_base)
+            keyframe = self._keyframe_requested and (
+                self._last_keyframe is None or current - self._last_keyframe >= self._min_keyframe_interval
+            )
+            if keyframe:
+                self._keyframe_requested = False
+                self._last_keyframe = current
+            payloads, timestamp = self._encoder.encode(frame, keyframe)
+
+            self._seq += 1
+            self._last_pts = pts
+            ret = _EncodedFrame(self._seq, pts, payloads, timestamp, keyframe)
+            self._cache[pts] = ret
+            while len(self._cache) > _CACHE_SIZE:
+                self._cache.popitem(last=False)
+            return ret
+
+
+class RelayedEncoder:
+    """A per-sender proxy that looks like an aiortc encoder but delegates to a `SharedEncoder`."""
+
+    def __init__(self, relay: "EncoderRelay", codec: RTCRtpCodecParameters) -> None:
+        self._relay = relay
+        self._codec = codec
+        self._tier = relay.select_tier(None)
+        self._encoder = relay.get_shared_encoder(codec, self._tier)
+        self._last_seq: Optional[int] = None
+
+    @property
+    def target_bitrate(self) -> int:
+        return self._tier
+
+    @target_bitrate.setter
+    def target_bitrate(self, bitrate: int) -> None:
+        tier = self._relay.select_tier(bitrate)
+        if tier != self._tier:
+            _logger.info("switch bitrate tier: {} -> {}".format(self._tier, tier))
+            self._tier = tier
+            self._encoder = self._relay.get_shared_encoder(self._codec, tier)
+            self._last_seq = None
+
+    def encode(self, frame: VideoFrame, force_keyframe: bool = False) -> Tuple[List[bytes], int]:
+        encoder = self._encoder
+        if force_keyframe or self._last_seq is None:
+            encoder.request_keyframe()
+
+        encoded = encoder.encode(frame)
+        if encoded is None:
+            encoder.request_keyframe()
+            self._last_seq = None
+            return [], 0
+
+        # NOTE: A peer which missed a frame (e.g. dropped by its queue) cannot decode the following delta frames,
+        # so we hold them back until the next keyframe.
+        if not encoded.keyframe and (self._last_seq is None or encoded.seq != self._last_seq + 1):
+            encoder.request_keyframe()
+            self._last_seq = None
+            return [], encoded.timestamp
+
+        self._last_seq = encoded.seq
+        return encoded.payloads, encoded.timestamp
+
+
+class EncoderRelay:
+    """Encode each frame once per (codec, bitrate tier) and share the bitstream among peer connections."""
+
+    def __init__(self, bitrate_tiers: Sequence[int], min_keyframe_interval: float = MIN_KEYFRAME_INTERVAL) -> None:
+        if len(bitrate_tiers) == 0:
+            raise RuntimeError("at least one bitrate tier is required")
+
+        self._tiers = sorted(bitrate_tiers)
+        self._min_keyframe_interval = min_keyframe_interval
+        self._lock = threading.Lock()
+        self._encoders: Dict[Tuple[str, int], SharedEncoder] = {}
+
+    def select_tier(self, bitrate: Optional[int]) -> int:
+        # NOTE: Start from the lowest tier until the receiver tells us its estimated bandwidth
+        if bitrate is None:
+            return self._tiers[0]
+
+        candidates = [t for t in self._tiers if t <= bitrate]
+        return candidates[-1] if candidates else self._tiers[0]
+
+    def get_shared_encoder(self, codec: RTCRtpCodecParameters, tier: int) -> SharedEncoder:
+        key = (codec.mimeType.lower(), tier)
+        with self._lock:
+            encoder = self._encoders.get(key)
+            if encoder is None:
+                _logger.info("create a shared encoder: codec={}, bitrate={}".format(*key))
+                encoder = SharedEncoder(codec, tier, self._min_keyframe_interval)
+                self._encoders[key] = encoder
+            return encoder
+
+    def attach(self, pc: RTCPeerConnection) -> None:
+        """Make the video senders of `pc` use shared encoders.
+
+        Must be called after the remote description has been set and before the first frame is sent.
+        """
+        for transceiver in pc.getTransceivers():
+            if transceiver.kind != "video" or len(transceiver._codecs) == 0:
+                continue
+
+            sender: Any = transceiver.sender
+            # NOTE: aiortc creates the encoder of RTCRtpSender lazily when the first frame arrives,
+            # so installing ours beforehand replaces it.
+            setattr(sender, "_RTCRtpSender__encoder", RelayedEncoder(self, transceiver._codecs[0]))
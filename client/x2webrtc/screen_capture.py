@@ -1,12 +1,25 @@
+import collections
 import dataclasses
+import logging
 import threading
-from typing import Dict, Iterator, List, Optional, Tuple
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple
 
+import numpy
 import Xlib
 import Xlib.display
 import Xlib.X
 from PIL import Image
+from Xlib.ext import damage, randr, xfixes
 from Xlib.ext.xtest import fake_input
+from Xlib.protocol import event
+
+from x2webrtc import metrics
+from x2webrtc.capture_backend import CaptureBackend, XGetImageBackend, get_capture_backend
+
+_logger = logging.getLogger(__name__)
+
+_CAPTURE_SECONDS = metrics.REGISTRY.histogram("x2webrtc_capture_seconds", "time to grab an image from the X server")
 
 
 @dataclasses.dataclass
@@ -16,13 +29,56 @@ class Rectangle:
     width: int
     height: int
 
+    @property
+    def area(self) -> int:
+        return self.width * self.height
+
+    def intersect(self, other: "Rectangle") -> Optional["Rectangle"]:
+        x0, y0 = max(self.x, other.x), max(self.y, other.y)
+        x1, y1 = min(self.x + self.width, other.x + other.width), min(self.y + self.height, other.y + other.height)
+        if x1 <= x0 or y1 <= y0:
+            return None
+        return Rectangle(x0, y0, x1 - x0, y1 - y0)
+
+    def clip(self, width: int, height: int) -> Optional["Rectangle"]:
+        return self.intersect(Rectangle(0, 0, width, height))
+
+
+def bounding_box(rects: Sequence[Rectangle]) -> Rectangle:
+    x0 = min(r.x for r in rects)
+    y0 = min(r.y for r in rects)
+    x1 = max(r.x + r.width for r in rects)
+    y1 = max(r.y + r.height for r in rects)
+    return Rectangle(x0, y0, x1 - x0, y1 - y0)
+
+
+def merge_rectangles(rects: Sequence[Rectangle], width: int, height: int, max_count: int = 16) -> List[Rectangle]:
+    """Clip damaged rectangles to the window and reduce the number of `get_image` calls.
+
+    Falls back to the bounding box when there are too many rectangles or when
+    they cover most of the bounding box anyway.
+    """
+    clipped = [c for c in (r.clip(width, height) for r in rects) if c is not None]
+    if len(clipped) <= 1:
+        return clipped
+
+    bbox = bounding_box(clipped)
+    if len(clipped) > max_count or sum(r.area for r in clipped) * 2 >= bbox.area:
+        return [bbox]
+    return clipped
+
 
 class Window:
-    def __init__(self, display, screen, window):
+    def __init__(self, display, screen, window, backend=None, lock=None):
         self._display = display
         self._screen = screen
         self._window = window
-        self._lock = threading.RLock()
+        self._backend = backend or XGetImageBackend()
+        # NOTE: python-xlib is not thread-safe, so every window on the same connection must share the lock
+        self._lock = lock or threading.RLock()
+        self._geometry: Optional[Rectangle] = None
+        self._region: Optional[Rectangle] = None
+        self._event_handlers: List[Callable[[Any], None]] = []
 
     @property
     def id(self) -> int:
@@ -48,6 +104,97 @@ class Window:
             geo = self._window.get_geometry()
             return Rectangle(geo.x, geo.y, geo.width, geo.height)
 
+    @property
+    def geometry(self) -> Rectangle:
+        """The position relative to the root window and the size of the window.
+
+        After `watch_geometry` is called, this is cached and updated by ConfigureNotify events,
+        so it costs no round trip to the X server.
+        """
+        with self._lock:
+            if self._geometry is None:
+                return self._query_geometry()
+
+            self.process_events()
+            return self._geometry
+
+    @property
+    def region(self) -> Optional[Rectangle]:
+        """The area to capture in the window coordinates, or None to capture the whole window."""
+        return self._region
+
+    @region.setter
+    def region(self, value: Optional[Rectangle]) -> None:
+        self._region = value
+
+    @property
+    def capture_rect(self) -> Rectangle:
+        """The area captured by default in the window coordinates."""
+        geo = self.geometry
+        whole = Rectangle(0, 0, geo.width, geo.height)
+        if self._region is None:
+            return whole
+
+        rect = self._region.intersect(whole)
+        if rect is None:
+            raise RuntimeError("the capture region is out of the window: {}".format(self._region))
+        return rect
+
+    def _query_geometry(self) -> Rectangle:
+        geo = self._window.get_geometry()
+        pos = self._screen.root.translate_coords(self._window, 0, 0)
+        return Rectangle(pos.x, pos.y, geo.width, geo.height)
+
+    def watch_geometry(self) -> None:
+        """Start caching the geometry of the window."""
+        with self._lock:
+            if self._geometry is not None:
+                return
+
+            self._window.change_attributes(event_mask=Xlib.X.StructureNotifyMask)
+            self._geometry = self._query_geometry()
+
+    def add_event_handler(self, handler: Callable[[Any], None]) -> None:
+        with self._lock:
+            self._event_handlers.append(handler)
+
+    def remove_event_handler(self, handler: Callable[[Any], None]) -> None:
+        with self._lock:
+            self._event_handlers.remove(handler)
+
+    def _on_configure(self, ev: Any) -> None:
+        if ev.send_event:
+            # NOTE: ICCCM requires window managers to send a synthetic ConfigureNotify in the root coordinates
+            # when they move a top-level window
+            self._geometry = Rectangle(ev.x, ev.y, ev.width, ev.height)
+        else:
+            pos = self._screen.root.translate_coords(self._window, 0, 0)
+            self._geometry = Rectangle(pos.x, pos.y, ev.width, ev.height)
+
+    def process_events(self) -> None:
+        """Dispatch the events which have already arrived, without any round trip."""
+        with self._lock:
+            for _ in range(self._display.pending_events()):
+                ev = self._display.next_event()
+                if isinstance(ev, event.ConfigureNotify) and ev.window == self._window and self._geometry is not None:
+                    self._on_configure(ev)
+                for handler in self._event_handlers:
+                    handler(ev)
+
+    def try_process_events(self) -> bool:
+        """Dispatch the events like `process_events`, or return False at once if the connection is in use."""
+        if not self._lock.acquire(blocking=False):
+            return False
+        try:
+            self.process_events()
+            return True
+        finally:
+            self._lock.release()
+
+    def fileno(self) -> int:
+        """The file descriptor of the connection, which becomes readable when an event arrives."""
+        return self._display.fileno()
+
     @property
     def properties(self) -> Dict[str, str]:
         with self._lock:
@@ -63,29 +210,200 @@ class Window:
             tree = self._window.query_tree()
 
         for d in tree.children:
-            yield Window(self._display, self._screen, d)
+            yield Window(self._display, self._screen, d, self._backend, self._lock)
 
     def capture(self, rect: Optional[Rectangle] = None) -> Image.Image:
         with self._lock:
-            capture_rect = rect or self.rect
-            image = self._window.get_image(
-                capture_rect.x, capture_rect.y, capture_rect.width, capture_rect.height, Xlib.X.ZPixmap, 0xFFFFFFFF
+            capture_rect = rect or self.capture_rect
+            data = self._backend.capture(
+                self._window, capture_rect.x, capture_rect.y, capture_rect.width, capture_rect.height
+            )
+            # NOTE: `data` may point to a buffer reused by the backend, so decode it before releasing the lock
+            return Image.frombytes("RGB", (capture_rect.width, capture_rect.height), data, "raw", "BGRX")
+
+    def capture_bgrx(self, rect: Optional[Rectangle] = None, slot: int = 0) -> numpy.ndarray:
+        """Capture the window as a (height, width, 4) BGRX array without any copy or conversion.
+
+        The array is a view of the backend buffer, so it is only valid until the next capture
+        into the same `slot`.
+        """
+        with self._lock:
+            capture_rect = rect or self.capture_rect
+            start = time.perf_counter()
+            data = self._backend.capture(
+                self._window, capture_rect.x, capture_rect.y, capture_rect.width, capture_rect.height, slot
             )
-        # 'depth', 'sequence_number', 'visual', 'data'
-        assert image.depth == 24
-        return Image.frombytes("RGB", (capture_rect.width, capture_rect.height), image.data, "raw", "BGRX")
+            _CAPTURE_SECONDS.observe(time.perf_counter() - start)
+            arr = numpy.frombuffer(data, dtype=numpy.uint8)
+            return arr.reshape(capture_rect.height, capture_rect.width, 4)
+
+    def track_damage(self) -> "DamageTracker":
+        with self._lock:
+            if not self._display.has_extension(damage.extname):
+                raise RuntimeError("the X server does not support DAMAGE")
+
+            self._display.damage_query_version()
+            geo = self.geometry
+            return DamageTracker(self, geo.width, geo.height)
+
+    def track_cursor(self) -> "CursorTracker":
+        with self._lock:
+            if not self._display.has_extension(xfixes.extname):
+                raise RuntimeError("the X server does not support XFIXES")
+            if not hasattr(self._display, "xfixes_get_cursor_image"):
+                raise RuntimeError("this version of python-xlib cannot get cursor images of XFIXES")
+
+            self._display.xfixes_query_version()
+            return CursorTracker(self)
+
+    def keysym_to_keycode(self, keysym: int) -> int:
+        # NOTE: Xlib looks up its cache of the keyboard mapping, so this costs no round trip
+        with self._lock:
+            return self._display.keysym_to_keycode(keysym)
+
+    def refresh_keyboard_mapping(self, ev: Any) -> None:
+        with self._lock:
+            self._display.refresh_keyboard_mapping(ev)
 
     def fake_input(self, event_type: int, detail: int = 0, x: int = 0, y: int = 0) -> None:
+        self.fake_inputs([(event_type, detail, x, y)])
+
+    def fake_inputs(self, inputs: Sequence[Tuple[int, int, int, int]]) -> None:
+        """Send XTest events of (event_type, detail, x, y) and flush them at once.
+
+        Unlike `sync`, `flush` does not wait for a reply, so a batch costs no round trip.
+        """
         with self._lock:
-            fake_input(self._display, event_type, detail, x=x, y=y)
+            for event_type, detail, x, y in inputs:
+                # NOTE: an invalid input (e.g. an out-of-range keycode) fails while packed, before anything is sent
+                try:
+                    fake_input(self._display, event_type, detail, x=x, y=y)
+                except Exception:
+                    _logger.exception("failed to send an input: {}".format((event_type, detail, x, y)))
+            self._display.flush()
+
+
+class DamageTracker:
+    """Accumulate damaged areas of a window reported by the X DAMAGE extension."""
+
+    def __init__(self, window: "Window", width: int, height: int):
+        self._window = window
+        self._display = window._display
+        self._lock = window._lock
+        self._size = (width, height)
+        self._rects: List[Rectangle] = []
+        self._damage = window._window.damage_create(damage.DamageReportDeltaRectangles)
+        self._display.flush()
+        window.add_event_handler(self._on_event)
+
+    @property
+    def size(self) -> Tuple[int, int]:
+        return self._size
+
+    def _on_event(self, ev: Any) -> None:
+        if not isinstance(ev, damage.DamageNotify) or ev.damage != self._damage:
+            return
+        geo = ev.drawable_geometry
+        self._size = (geo.width, geo.height)
+        self._rects.append(Rectangle(ev.area.x, ev.area.y, ev.area.width, ev.area.height))
+
+    def poll(self) -> List[Rectangle]:
+        # NOTE: No pending or dispatched event means that the damage region has been empty since the last poll,
+        # so we can return without any round trip in the idle case.
+        with self._lock:
+            if self._display.pending_events() == 0 and len(self._rects) == 0:
+                return []
+
+            # NOTE: Subtract first and then sync, so that every damage made before the subtraction has been
+            # delivered as an event by the time we drain the queue.
+            self._display.damage_subtract(self._damage)
             self._display.sync()
+            self._window.process_events()
+
+            rects, self._rects = self._rects, []
+
+        return merge_rectangles(rects, *self._size)
+
+    def close(self) -> None:
+        with self._lock:
+            self._window.remove_event_handler(self._on_event)
+            self._display.damage_destroy(self._damage)
+            self._display.flush()
+
+
+@dataclasses.dataclass
+class CursorImage:
+    serial: int
+    xhot: int
+    yhot: int
+    # NOTE: a (height, width, 4) RGBA array with straight alpha
+    pixels: numpy.ndarray
+
+
+def _unpremultiply_bgra(bgra: numpy.ndarray) -> numpy.ndarray:
+    """Convert a BGRA array with premultiplied alpha, as XFIXES returns, into RGBA with straight alpha."""
+    alpha = bgra[..., 3:4].astype(numpy.uint16)
+    rgb = bgra[..., 2::-1].astype(numpy.uint16)
+    rgb = numpy.where(alpha > 0, numpy.minimum(rgb * 255 // numpy.maximum(alpha, 1), 255), 0)
+    return numpy.concatenate([rgb, alpha], axis=2).astype(numpy.uint8)
+
+
+class CursorTracker:
+    """Follow the cursor shape by XFIXES events, and its position relative to the captured area of a window."""
+
+    def __init__(self, window: "Window"):
+        self._window = window
+        self._display = window._display
+        self._lock = window._lock
+        self._root = window._screen.root
+        # NOTE: None until the first image is fetched
+        self._serial: Optional[int] = None
+        self._display.xfixes_select_cursor_input(self._root, xfixes.XFixesDisplayCursorNotifyMask)
+        self._display.flush()
+        window.add_event_handler(self._on_event)
+
+    def _on_event(self, ev: Any) -> None:
+        if isinstance(ev, xfixes.DisplayCursorNotify):
+            self._serial = ev.cursor_serial
+
+    def poll(self) -> Tuple[Optional[int], int, int]:
+        """Return the serial of the current cursor shape, or None if unknown, and the position of the cursor."""
+        with self._lock:
+            self._window.process_events()
+            pointer = self._root.query_pointer()
+            geo = self._window.geometry
+            rect = self._window.capture_rect
+            return self._serial, pointer.root_x - geo.x - rect.x, pointer.root_y - geo.y - rect.y
+
+    def get_image(self) -> CursorImage:
+        with self._lock:
+            reply = self._display.xfixes_get_cursor_image(self._root)
+            self._serial = reply.cursor_serial
+
+        argb = numpy.array(reply.cursor_image, dtype="<u4").reshape(reply.height, reply.width)
+        bgra = argb.view(numpy.uint8).reshape(reply.height, reply.width, 4)
+        return CursorImage(reply.cursor_serial, reply.xhot, reply.yhot, _unpremultiply_bgra(bgra))
+
+    def close(self) -> None:
+        with self._lock:
+            self._window.remove_event_handler(self._on_event)
+            self._display.xfixes_select_cursor_input(self._root, 0)
+            self._display.flush()
+
+
+@dataclasses.dataclass
+class Monitor:
+    name: str
+    # NOTE: in the root window coordinates
+    rect: Rectangle
+    primary: bool = False
 
 
 class Screen:
-    def __init__(self, display, screen):
+    def __init__(self, display, screen, backend=None, lock=None):
         self._display = display
         self._screen = screen
-        self._root_window = Window(display, screen, self._screen.root)
+        self._root_window = Window(display, screen, self._screen.root, backend, lock)
 
     @property
     def size(self) -> Tuple[int, int]:
@@ -95,13 +413,100 @@ class Screen:
     def root_window(self) -> Window:
         return self._root_window
 
+    def monitors(self) -> List[Monitor]:
+        """Return the monitors showing the screen, from the outputs of RandR.
+
+        The whole screen is returned as one monitor if the X server does not support RandR.
+        """
+        root = self._root_window
+        with root._lock:
+            if not self._display.has_extension(randr.extname):
+                width, height = self.size
+                return [Monitor("default", Rectangle(0, 0, width, height), True)]
+
+            resources = root._window.xrandr_get_screen_resources_current()
+            primary = root._window.xrandr_get_output_primary().output
+            monitors = []
+            crtcs = set()
+            for output in resources.outputs:
+                info = self._display.xrandr_get_output_info(output, resources.config_timestamp)
+                # NOTE: outputs mirroring the same CRTC show the same area, so only the first one is listed
+                if info.connection != randr.Connected or info.crtc == 0 or info.crtc in crtcs:
+                    continue
+
+                crtcs.add(info.crtc)
+                crtc = self._display.xrandr_get_crtc_info(info.crtc, resources.config_timestamp)
+                name = info.name.decode() if isinstance(info.name, bytes) else info.name
+                rect = Rectangle(crtc.x, crtc.y, crtc.width, crtc.height)
+                monitors.append(Monitor(name, rect, output == primary))
+            return monitors
+
+    def get_window(self, window_id: int) -> Window:
+        window = self._display.create_resource_object("window", window_id)
+        root = self._root_window
+        return Window(self._display, self._screen, window, root._backend, root._lock)
+
+    def find_window(self, predicate: Callable[[Window], bool]) -> Optional[Window]:
+        """Return the first window satisfying `predicate` in the breadth-first order."""
+        windows = collections.deque([self._root_window])
+        while len(windows) > 0:
+            window = windows.popleft()
+            if predicate(window):
+                return window
+            windows.extend(window.get_children())
+        return None
+
+
+CONNECTION_PURPOSES = ["query", "capture", "input", "cursor"]
+
 
 class Display:
-    def __init__(self, display_name: Optional[str] = None):
+    """Connections to an X server, one for each purpose.
+
+    A connection serializes its requests, so capturing a large image would delay input injection
+    if they shared one. `screen` works on the "query" connection for metadata, and `bind` gives
+    a window on the connection for the other purposes.
+    """
+
+    def __init__(self, display_name: Optional[str] = None, capture_backend: str = "auto"):
+        self._display_name = display_name
         self._display = Xlib.display.Display(display_name)
+        self._connections: Dict[str, Tuple[Xlib.display.Display, threading.RLock]] = {
+            "query": (self._display, threading.RLock())
+        }
+        self._connections_lock = threading.Lock()
+        self._capture_backend_name = capture_backend
+        self._backend: Optional[CaptureBackend] = None
+
+    def connection(self, purpose: str) -> Tuple[Xlib.display.Display, threading.RLock]:
+        """Get the connection for `purpose` and the lock to use it, opening it at the first call."""
+        if purpose not in CONNECTION_PURPOSES:
+            raise RuntimeError("unknown connection purpose: {}".format(purpose))
+
+        with self._connections_lock:
+            if purpose not in self._connections:
+                self._connections[purpose] = (Xlib.display.Display(self._display_name), threading.RLock())
+            return self._connections[purpose]
+
+    @property
+    def capture_backend(self) -> CaptureBackend:
+        if self._backend is None:
+            display, _ = self.connection("capture")
+            self._backend = get_capture_backend(display, self._capture_backend_name)
+        return self._backend
 
     def screen(self, display_no: Optional[int] = None) -> Screen:
-        return Screen(self._display, self._display.screen())
+        _, lock = self.connection("query")
+        return Screen(self._display, self._display.screen(display_no), lock=lock)
+
+    def bind(self, window: Window, purpose: str) -> Window:
+        """Get the same window on the connection for `purpose`."""
+        display, lock = self.connection(purpose)
+        backend = self.capture_backend if purpose == "capture" else None
+        xwindow = display.create_resource_object("window", window.id)
+        ret = Window(display, display.screen(), xwindow, backend, lock)
+        ret.region = window.region
+        return ret
 
     def screen_count(self) -> int:
         return self._display.screen_count()
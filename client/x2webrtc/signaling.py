@@ -30,6 +30,20 @@ class CopyAndPasteSignaling(SignalingPlugin):
         return True
 
 
+class LoopbackSignaling(SignalingPlugin):
+    """Exchange the descriptions directly with a peer connection in the same process."""
+
+    def __init__(self, remote: RTCPeerConnection) -> None:
+        self._remote = remote
+
+    async def __call__(self, pc: RTCPeerConnection) -> bool:
+        await pc.setLocalDescription(await pc.createOffer())
+        await self._remote.setRemoteDescription(pc.localDescription)
+        await self._remote.setLocalDescription(await self._remote.createAnswer())
+        await pc.setRemoteDescription(self._remote.localDescription)
+        return True
+
+
 def _load_plugin(py_path: pathlib.Path) -> SignalingPlugin:
     _logger.info("loading {} as a plugin".format(py_path))
     if not py_path.exists() or py_path.is_dir():
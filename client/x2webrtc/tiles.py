@@ -0,0 +1,181 @@
+import dataclasses
+import io
+import logging
+import struct
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy
+from aiortc import RTCDataChannel
+from PIL import Image
+
+from x2webrtc import metrics
+from x2webrtc.channels import ChannelSet
+
+_logger = logging.getLogger(__name__)
+
+_TILE_BYTES = metrics.REGISTRY.counter("x2webrtc_tile_bytes_total", "bytes of lossless tiles sent")
+_ENCODE_TILES_SECONDS = metrics.REGISTRY.histogram(
+    "x2webrtc_encode_tiles_seconds", "time to find and compress the changed tiles of a captured image"
+)
+
+TILE_PROTOCOL = "x2webrtc-tiles-1"
+TILE_SIZE = 64
+
+# NOTE: version, padding, screen width and height, then the x, y, width and height of the tile,
+# followed by the PNG image of the tile
+_TILE_VERSION = 1
+_TILE_HEADER = struct.Struct("<BxHHHHHH")
+
+# NOTE: in bytes; tiles are not sent to a channel with this much data queued, and it receives every tile
+# once it drains instead
+MAX_BUFFERED_AMOUNT = 1 << 20
+
+
+def changed_tiles(
+    previous: Optional[numpy.ndarray], current: numpy.ndarray, tile_size: int = TILE_SIZE
+) -> List[Tuple[int, int]]:
+    """Return the top-left corners of the tiles which differ between two BGRX images.
+
+    Every tile is returned if `previous` is None or has a different shape.
+    """
+    height, width = current.shape[:2]
+    rows, cols = -(-height // tile_size), -(-width // tile_size)
+    if previous is None or previous.shape != current.shape:
+        return [(x * tile_size, y * tile_size) for y in range(rows) for x in range(cols)]
+
+    # NOTE: compare a BGRX pixel as one uint32 rather than four bytes
+    diff = previous.view(numpy.uint32)[..., 0] != current.view(numpy.uint32)[..., 0]
+    padded = numpy.zeros((rows * tile_size, cols * tile_size), dtype=bool)
+    padded[:height, :width] = diff
+    dirty = padded.reshape(rows, tile_size, cols, tile_size).any(axis=(1, 3))
+    ys, xs = numpy.nonzero(dirty)
+    return [(int(x) * tile_size, int(y) * tile_size) for y, x in zip(ys, xs)]
+
+
+def encode_tile(img: numpy.ndarray, x: int, y: int, tile_size: int = TILE_SIZE) -> bytes:
+    """Encode the tile of a BGRX image at (x, y) into a message of the tile channel."""
+    height, width = img.shape[:2]
+    tile = numpy.ascontiguousarray(img[y : y + tile_size, x : x + tile_size])
+    h, w = tile.shape[:2]
+
+    buf = io.BytesIO()
+    Image.frombuffer("RGB", (w, h), tile, "raw", "BGRX", 0, 1).save(buf, format="PNG", compress_level=1)
+    return _TILE_HEADER.pack(_TILE_VERSION, width, height, x, y, w, h) + buf.getvalue()
+
+
+def decode_tile(data: bytes) -> Tuple[Tuple[int, int], Tuple[int, int, int, int], bytes]:
+    """Return the screen size, the rectangle of the tile and its PNG image."""
+    if len(data) < _TILE_HEADER.size:
+        raise RuntimeError("truncated tile: {} bytes".format(len(data)))
+
+    version, width, height, x, y, w, h = _TILE_HEADER.unpack_from(data)
+    if version != _TILE_VERSION:
+        raise RuntimeError("unsupported tile version: {}".format(version))
+    return (width, height), (x, y, w, h), data[_TILE_HEADER.size :]
+
+
+@dataclasses.dataclass
+class _Peer:
+    # NOTE: whether the channel still needs every tile
+    needs_full: bool = True
+
+
+class TileStream:
+    """Send the changed tiles of captured images losslessly over data channels.
+
+    Small text smeared by the video codec stays crisp on the viewer, which composites the tiles
+    onto a canvas. Compression runs on a dedicated thread fed with the latest image only, so
+    a slow channel lowers the tile rate rather than stalling the capture. A newly opened channel,
+    or one that has drained after being congested, receives every tile first and then the same
+    changes as the others.
+    """
+
+    def __init__(self, tile_size: int = TILE_SIZE) -> None:
+        self._tile_size = tile_size
+        self._cond = threading.Condition()
+        self._closed = False
+        self._pending: Optional[numpy.ndarray] = None
+        self._has_pending = False
+        self._work: Optional[numpy.ndarray] = None
+        self._previous: Optional[numpy.ndarray] = None
+        self._channels: ChannelSet[_Peer] = ChannelSet(_TILE_BYTES)
+        self._thread = threading.Thread(target=self._run, name="x2webrtc-tiles", daemon=True)
+        self._thread.start()
+
+    def attach(self, channel: RTCDataChannel) -> None:
+        self._channels.attach(channel, _Peer)
+
+    def put_frame(self, img: numpy.ndarray) -> None:
+        """Hand a BGRX image over to the compression thread; only the latest one is kept."""
+        with self._cond:
+            if self._closed or len(self._channels) == 0:
+                return
+
+            if self._pending is None or self._pending.shape != img.shape:
+                self._pending = numpy.empty_like(img)
+            numpy.copyto(self._pending, img)
+            self._has_pending = True
+            self._cond.notify()
+
+    def _encode(self, img: numpy.ndarray) -> None:
+        channels = self._channels.items()
+        if len(channels) == 0:
+            return
+
+        start = time.perf_counter()
+        cache: Dict[Tuple[int, int], bytes] = {}
+
+        def tiles_of(corners: List[Tuple[int, int]]) -> List[bytes]:
+            for corner in corners:
+                if corner not in cache:
+                    cache[corner] = encode_tile(img, corner[0], corner[1], self._tile_size)
+            return [cache[corner] for corner in corners]
+
+        changed = tiles_of(changed_tiles(self._previous, img, self._tile_size))
+        messages: List[Tuple[RTCDataChannel, bytes]] = []
+        for channel, peer in channels:
+            if channel.bufferedAmount > MAX_BUFFERED_AMOUNT:
+                # NOTE: a congested channel is skipped without holding the others back; it misses these
+                # changes, so it receives every tile once it recovers
+                peer.needs_full = True
+                continue
+
+            tiles = tiles_of(changed_tiles(None, img, self._tile_size)) if peer.needs_full else changed
+            messages.extend((channel, data) for data in tiles)
+            peer.needs_full = False
+
+        self._channels.send(messages)
+        _ENCODE_TILES_SECONDS.observe(time.perf_counter() - start)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._has_pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+
+                self._pending, self._work = self._work, self._pending
+                self._has_pending = False
+
+            img = self._work
+            assert img is not None
+            try:
+                self._encode(img)
+            except Exception:
+                _logger.exception("got an unexpected exception")
+                continue
+
+            # NOTE: the next changes are computed against what the uncongested viewers have
+            if self._previous is None or self._previous.shape != img.shape:
+                self._previous = img.copy()
+            else:
+                numpy.copyto(self._previous, img)
+
+    def close(self) -> None:
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
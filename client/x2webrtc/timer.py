@@ -1,36 +1,124 @@
 import asyncio
+import dataclasses
+import math
 import time
-from typing import Optional
+from typing import Optional, Tuple
 
+_NS_PER_SEC = 1000000000
 
-class Timer:
-    def __init__(self, fps: int):
-        self._last: Optional[float] = None
-        self._duration = 1.0 / fps
-
-    def _calc_wait_sec(self) -> float:
-        current = time.time()
-        if self._last is not None:
-            diff = current - self._last
-            self._last += self._duration
-
-            if diff < self._duration:
-                return self._duration - diff
-            else:
-                return 0.0
-        else:
-            self._last = current
+
+def _monotonic_ns() -> int:
+    # NOTE: `time.monotonic_ns` is unavailable in Python 3.6
+    return int(time.monotonic() * _NS_PER_SEC)
+
+
+monotonic_ns = getattr(time, "monotonic_ns", _monotonic_ns)
+
+
+@dataclasses.dataclass
+class TimerStats:
+    ticks: int = 0
+    # NOTE: ticks dropped because the caller was late by more than one period
+    skipped: int = 0
+    max_lateness: float = 0.0
+    _mean_lateness: float = 0.0
+    _m2: float = 0.0
+
+    @property
+    def mean_lateness(self) -> float:
+        return self._mean_lateness
+
+    @property
+    def jitter(self) -> float:
+        """Standard deviation of the lateness of ticks in seconds."""
+        if self.ticks < 2:
             return 0.0
+        return math.sqrt(self._m2 / (self.ticks - 1))
 
-    def reset_throttle(self) -> None:
-        self._last = time.time()
+    def record(self, lateness: float) -> None:
+        self.ticks += 1
+        delta = lateness - self._mean_lateness
+        self._mean_lateness += delta / self.ticks
+        self._m2 += delta * (lateness - self._mean_lateness)
+        self.max_lateness = max(self.max_lateness, lateness)
 
-    async def wait_async(self) -> None:
-        to_wait = self._calc_wait_sec()
-        if to_wait > 0.0:
-            await asyncio.sleep(to_wait)
+
+class FrameSchedule:
+    """Deadlines of ticks at a fixed rate on a monotonic clock.
+
+    Deadlines are derived from the first tick, so they never drift, and ticks
+    which are already more than one period late are skipped instead of being
+    fired in a burst.
+    """
+
+    def __init__(self, fps: float) -> None:
+        self._period_ns = int(_NS_PER_SEC / fps)
+        self._next_ns: Optional[int] = None
+        self.stats = TimerStats()
+
+    @property
+    def period(self) -> float:
+        return self._period_ns / _NS_PER_SEC
+
+    def set_fps(self, fps: float) -> None:
+        self._period_ns = int(_NS_PER_SEC / fps)
+        self.reset()
+
+    def reset(self) -> None:
+        self._next_ns = None
+
+    def next_tick(self, now_ns: int) -> Tuple[int, int]:
+        """Return the deadline of the next tick and nanoseconds to wait until then."""
+        if self._next_ns is None:
+            self._next_ns = now_ns
+
+        late_ns = now_ns - self._next_ns
+        if late_ns > self._period_ns:
+            missed = late_ns // self._period_ns
+            self._next_ns += missed * self._period_ns
+            self.stats.skipped += missed
+
+        deadline = self._next_ns
+        self._next_ns += self._period_ns
+        return deadline, max(deadline - now_ns, 0)
+
+    def record(self, deadline_ns: int, now_ns: int) -> None:
+        self.stats.record(max(now_ns - deadline_ns, 0) / _NS_PER_SEC)
+
+
+class Timer:
+    """Pace a thread at a fixed rate."""
+
+    def __init__(self, fps: float) -> None:
+        self._schedule = FrameSchedule(fps)
+
+    @property
+    def stats(self) -> TimerStats:
+        return self._schedule.stats
+
+    def set_fps(self, fps: float) -> None:
+        self._schedule.set_fps(fps)
+
+    def reset(self) -> None:
+        self._schedule.reset()
 
     def wait(self) -> None:
-        to_wait = self._calc_wait_sec()
-        if to_wait > 0.0:
-            time.sleep(to_wait)
+        deadline, to_wait = self._schedule.next_tick(monotonic_ns())
+        if to_wait > 0:
+            time.sleep(to_wait / _NS_PER_SEC)
+        self._schedule.record(deadline, monotonic_ns())
+
+
+class AsyncTimer(Timer):
+    """Pace a coroutine at a fixed rate on the clock of the event loop.
+
+    `wait` is also available, but a timer should be waited on either from a thread or from
+    the loop, because the two clocks may differ.
+    """
+
+    async def wait_async(self) -> None:
+        loop = asyncio.get_event_loop()
+        deadline, to_wait = self._schedule.next_tick(int(loop.time() * _NS_PER_SEC))
+        if to_wait > 0:
+            await asyncio.sleep(to_wait / _NS_PER_SEC)
+        self._schedule.record(deadline, int(loop.time() * _NS_PER_SEC))
@@ -1,15 +1,30 @@
+import asyncio
+import collections
+import dataclasses
 import fractions
-import queue
+import logging
+import threading
 import time
-from typing import Optional
+from typing import Callable, List, Optional, Tuple, Union
 
 import numpy
-from aiortc.mediastreams import MediaStreamTrack
+from aiortc.mediastreams import MediaStreamError, MediaStreamTrack
 from av import VideoFrame
 
-from x2webrtc.timer import Timer
+from x2webrtc import metrics
+from x2webrtc.timer import AsyncTimer, TimerStats
+
+_logger = logging.getLogger(__name__)
+
+_CONVERT_SECONDS = metrics.REGISTRY.histogram(
+    "x2webrtc_convert_seconds", "time to copy a captured image into a video frame"
+)
+_REPEATED_FRAMES = metrics.REGISTRY.counter(
+    "x2webrtc_repeated_frames_total", "frames resent by the track because no new frame was available"
+)
 
 VIDEO_TIME_BASE = fractions.Fraction(1, 1000)
+PACKED_FORMAT_CHANNELS = {"rgb24": 3, "bgr24": 3, "bgr0": 4, "bgra": 4, "rgb0": 4, "rgba": 4}
 
 
 def _create_initial_frame(width: int = 640, height: int = 480) -> VideoFrame:
@@ -17,18 +32,186 @@ def _create_initial_frame(width: int = 640, height: int = 480) -> VideoFrame:
     return VideoFrame.from_ndarray(img, format="rgb24")
 
 
+def _plane_view(frame: VideoFrame, channels: int) -> numpy.ndarray:
+    plane = frame.planes[0]
+    buf = numpy.frombuffer(memoryview(plane), dtype=numpy.uint8).reshape(frame.height, plane.line_size)
+    return buf[:, : frame.width * channels].reshape(frame.height, frame.width, channels)
+
+
+def fit_size(width: int, height: int, max_width: int, max_height: int) -> Tuple[int, int]:
+    """Return the size of an image scaled down to fit in (max_width, max_height), keeping the aspect ratio.
+
+    The size is rounded down to even numbers for 4:2:0 chroma subsampling, and images are never scaled up.
+    """
+    ratio = min(max_width / width, max_height / height)
+    if ratio >= 1.0:
+        return width, height
+    return max(2, int(width * ratio) & ~1), max(2, int(height * ratio) & ~1)
+
+
+class _Downscaler:
+    """Scale packed images down and convert them to YUV 4:2:0 in one pass.
+
+    libswscale does both while reading the image once, which is much faster than either
+    in numpy, and the encoder then takes the frame as is. Pixels are area-averaged where PyAV
+    supports it, so small text does not alias when a 4K screen is scaled down to 1080p.
+    """
+
+    def __init__(self) -> None:
+        # NOTE: only read by libswscale, so it is reused unlike the output frames
+        self._staging: Optional[VideoFrame] = None
+        # NOTE: PyAV 7 takes no interpolation and scales bilinearly, so this is dropped at the first TypeError
+        self._area = True
+
+    def scale(self, img: numpy.ndarray, format: str, width: int, height: int) -> VideoFrame:
+        h, w = img.shape[:2]
+        staging = self._staging
+        if staging is None or (staging.width, staging.height, staging.format.name) != (w, h, format):
+            staging = self._staging = VideoFrame(w, h, format)
+        numpy.copyto(_plane_view(staging, PACKED_FORMAT_CHANNELS[format]), img)
+        if self._area:
+            try:
+                return staging.reformat(width, height, "yuv420p", interpolation="AREA")
+            except TypeError:
+                self._area = False
+        return staging.reformat(width, height, "yuv420p")
+
+
+@dataclasses.dataclass
+class FrameBufferStats:
+    published: int = 0
+    served: int = 0
+    # NOTE: frames replaced by a newer one before `recv` took them
+    overwritten: int = 0
+    # NOTE: frames dropped for exceeding the latency budget once a newer one was published
+    stale: int = 0
+    # NOTE: frames skipped for a newer one by `recv`; counted apart from the others, which the producer updates
+    skipped: int = 0
+
+
+class LatestFrameBuffer:
+    """A single-producer/single-consumer handoff that always serves the freshest frame.
+
+    The producer never blocks: when the ring of `depth` frames is full, the oldest one is
+    overwritten, and frames older than `latency_budget` are dropped once a newer one is
+    published. The consumer takes the newest frame and skips the others. Frames are recycled
+    through a free list, and the ownership of a frame is passed by atomic `deque` operations,
+    so no lock is shared between the two threads.
+    """
+
+    def __init__(self, depth: int = 1, latency_budget: float = 0.1) -> None:
+        self._depth = depth
+        self._latency_budget = latency_budget
+        self._ready: "collections.deque[Tuple[float, VideoFrame, Optional[numpy.ndarray]]]" = collections.deque()
+        self._free: "collections.deque[Tuple[VideoFrame, numpy.ndarray]]" = collections.deque()
+        self._serving: Optional[Tuple[VideoFrame, Optional[numpy.ndarray]]] = None
+        self.stats = FrameBufferStats()
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of frames waiting for the consumer."""
+        return len(self._ready)
+
+    def acquire(self, width: int, height: int, format: str) -> Tuple[VideoFrame, numpy.ndarray]:
+        """Get a writable frame (producer side)."""
+        while True:
+            try:
+                frame, view = self._free.popleft()
+            except IndexError:
+                break
+            if (frame.width, frame.height, frame.format.name) == (width, height, format):
+                return frame, view
+
+        frame = VideoFrame(width, height, format)
+        return frame, _plane_view(frame, PACKED_FORMAT_CHANNELS[format])
+
+    def _recycle(self, frame: VideoFrame, view: Optional[numpy.ndarray]) -> None:
+        # NOTE: frames published without a view were not acquired here, and are left to the GC
+        if view is not None:
+            self._free.append((frame, view))
+
+    def publish(self, frame: VideoFrame, view: Optional[numpy.ndarray]) -> None:
+        """Hand a frame over to the consumer (producer side)."""
+        now = time.monotonic()
+        while True:
+            try:
+                published = self._ready[0][0]
+            except IndexError:
+                break
+            expired = now - published > self._latency_budget
+            if not expired and len(self._ready) < self._depth:
+                break
+
+            # NOTE: the consumer may take the frames meanwhile, but it only takes them all at once
+            try:
+                _, old_frame, old_view = self._ready.popleft()
+            except IndexError:
+                break
+            if expired:
+                self.stats.stale += 1
+            else:
+                self.stats.overwritten += 1
+            self._recycle(old_frame, old_view)
+
+        self._ready.append((now, frame, view))
+        self.stats.published += 1
+
+    def take(self) -> Optional[VideoFrame]:
+        """Get the newest frame, or None if no new frame is available (consumer side).
+
+        The older frames are skipped, and the previously taken frame is recycled, so it must
+        not be in use anymore. The newest frame is served even if it exceeds the latency budget.
+        """
+        taken: Optional[Tuple[VideoFrame, Optional[numpy.ndarray]]] = None
+        while True:
+            try:
+                _, frame, view = self._ready.popleft()
+            except IndexError:
+                break
+
+            if taken is not None:
+                self.stats.skipped += 1
+                self._recycle(*taken)
+            taken = (frame, view)
+
+        if taken is None:
+            return None
+
+        if self._serving is not None:
+            self._recycle(*self._serving)
+        self._serving = taken
+        self.stats.served += 1
+        return taken[0]
+
+
 class ScreenCaptureTrack(MediaStreamTrack):  # type: ignore
 
     kind = "video"
 
-    def __init__(self, fps: int = 30, max_buf_sec: float = 1.0) -> None:
+    def __init__(
+        self,
+        fps: int = 30,
+        buffer_depth: int = 1,
+        latency_budget: float = 0.1,
+        repeat_frames: bool = True,
+        output_size: Optional[Tuple[int, int]] = None,
+    ) -> None:
         super().__init__()
 
         self._fps = fps
-        self._queue: "queue.Queue[VideoFrame]" = queue.Queue(int(fps * max_buf_sec))
+        # NOTE: the maximum size of frames sent to the encoder; larger captures are scaled down to fit in it
+        self._output_size = output_size
+        self._downscaler = _Downscaler()
+        # NOTE: disabled when the capture loop skips static frames and refreshes them by itself,
+        # so the encoder idles while nothing changes
+        self._repeat_frames = repeat_frames
+        self._buffer = LatestFrameBuffer(buffer_depth, latency_budget)
         self._last_frame = _create_initial_frame()
-        self._sender_timer = Timer(fps)
-        self._receiver_timer = Timer(fps)
+        self._sender_timer = AsyncTimer(fps)
+        self._receiver_timer = AsyncTimer(fps)
+
+        self._scale = 1.0
+        self._video_scale = (1.0, 1.0)
 
         self._start: Optional[float] = None
         self._active: bool = False
@@ -41,37 +224,297 @@ class ScreenCaptureTrack(MediaStreamTrack):  # type: ignore
     def active(self, value: bool) -> None:
         self._active = value
 
+    @property
+    def fps(self) -> int:
+        return self._fps
+
+    def set_fps(self, fps: int) -> None:
+        self._fps = fps
+        self._sender_timer.set_fps(fps)
+        self._receiver_timer.set_fps(fps)
+
+    @property
+    def scale(self) -> float:
+        """Scale applied to the size of captured images, or to the output size if any, in (0, 1]."""
+        return self._scale
+
+    @scale.setter
+    def scale(self, value: float) -> None:
+        if value <= 0.0 or value > 1.0:
+            raise ValueError("scale must be in (0, 1]: {}".format(value))
+        self._scale = value
+
+    @property
+    def video_scale(self) -> Tuple[float, float]:
+        """Horizontal and vertical scale of the latest frame against its captured image."""
+        return self._video_scale
+
     def wait_for_next_put(self) -> None:
         self._sender_timer.wait()
 
-    def put_frame(self, img: numpy.ndarray) -> None:
+    async def wait_for_next_put_async(self) -> None:
+        await self._sender_timer.wait_async()
+
+    @property
+    def stats(self) -> FrameBufferStats:
+        return self._buffer.stats
+
+    @property
+    def queue_depth(self) -> int:
+        return self._buffer.queue_depth
+
+    @property
+    def sender_timer_stats(self) -> TimerStats:
+        return self._sender_timer.stats
+
+    @property
+    def receiver_timer_stats(self) -> TimerStats:
+        return self._receiver_timer.stats
+
+    def put_frame(self, img: numpy.ndarray, format: str = "rgb24", convert_yuv: bool = False) -> None:
+        """Copy a packed image into a recycled frame and hand it over to `recv`.
+
+        `img` must be a (height, width, channels) array laid out as `format`.
+        Passing a BGRX capture with `format="bgr0"` avoids any conversion here;
+        the encoder converts it to YUV only once. An image larger than the output size,
+        or any image if `convert_yuv` is set, is instead scaled and converted to YUV here
+        in one pass, which takes the conversion off the encoder.
+        """
         if not self.active or self.readyState != "live":
             return
 
-        frame = VideoFrame.from_ndarray(img, format="rgb24")
-        try:
-            self._queue.put_nowait(frame)
-        except queue.Full:
-            # NOTE(igarashi): might be either a bug of Timer (i.e. diff >> duration) or a delay of recv()
-            self._sender_timer.reset_throttle()
-            time.sleep(0.1)
+        start = time.perf_counter()
+        height, width = img.shape[:2]
+        # NOTE: the adaptation scale shrinks the output size, or the captured size without one; libswscale
+        # filters the image rather than decimating it, and keeps the size even
+        max_width, max_height = self._output_size or (width, height)
+        size = fit_size(width, height, int(max_width * self._scale), int(max_height * self._scale))
+        self._video_scale = (size[0] / width, size[1] / height)
+
+        if convert_yuv or size != (width, height):
+            self._buffer.publish(self._downscaler.scale(img, format, size[0], size[1]), None)
+        else:
+            frame, view = self._buffer.acquire(width, height, format)
+            numpy.copyto(view, img)
+            self._buffer.publish(frame, view)
+        _CONVERT_SECONDS.observe(time.perf_counter() - start)
 
     async def recv(self) -> VideoFrame:
-        # NOTE(igarashi): If there is no available frames in the queue,
+        # NOTE(igarashi): If there is no available frames in the buffer,
         # put the last frame we have already sent.
-        await self._receiver_timer.wait_async()
-        current = time.time()
+        while True:
+            await self._receiver_timer.wait_async()
+            frame = self._buffer.take()
+            if frame is not None or self._repeat_frames:
+                break
+            if self.readyState != "live":
+                raise MediaStreamError
+
+        current = time.monotonic()
         if self._start is None:
             self._start = current
 
         diff = current - self._start
 
-        try:
-            frame = self._queue.get_nowait()
+        if frame is not None:
             self._last_frame = frame
-        except queue.Empty:
+        else:
             frame = self._last_frame
+            _REPEATED_FRAMES.inc()
 
         frame.pts = int(diff / VIDEO_TIME_BASE)
         frame.time_base = VIDEO_TIME_BASE
         return frame
+
+
+class SubscriberTrack(MediaStreamTrack):
+    """A per-peer view of a `BroadcastTrack`.
+
+    Frames are shared with the other subscribers, so they must not be modified here.
+    """
+
+    kind = "video"
+
+    def __init__(self, queue_size: int, last_frame: Optional[Callable[[], Optional[VideoFrame]]] = None) -> None:
+        super().__init__()
+
+        self._event_loop: asyncio.AbstractEventLoop = asyncio.get_event_loop()
+        self._frames: "collections.deque[VideoFrame]" = collections.deque(maxlen=queue_size)
+        self._available = asyncio.Event()
+        self._active: bool = False
+        # NOTE: returns the latest frame broadcast before this track started
+        self._last_frame = last_frame
+        self._started = False
+        self.dropped_frames = 0
+
+    @property
+    def active(self) -> bool:
+        return self._active
+
+    @active.setter
+    def active(self, value: bool) -> None:
+        self._active = value
+
+    def _push(self, frame: VideoFrame) -> None:
+        # NOTE: called from the capture thread; deque.append is atomic and drops the oldest frame when full
+        if len(self._frames) == self._frames.maxlen:
+            self.dropped_frames += 1
+        self._frames.append(frame)
+        try:
+            self._event_loop.call_soon_threadsafe(self._available.set)
+        except RuntimeError:
+            # NOTE: the event loop has been closed on shutdown
+            pass
+
+    def stop(self) -> None:
+        super().stop()
+        # NOTE: wake up `recv` waiting for a frame, so that it raises MediaStreamError
+        self._available.set()
+
+    async def recv(self) -> VideoFrame:
+        # NOTE: Unlike `ScreenCaptureTrack`, we wait for a new frame instead of resending the last one,
+        # because its timestamp is shared with the other subscribers. Only the first frame may be one
+        # broadcast before, since an idle screen may not be captured again until something changes.
+        while True:
+            if self.readyState != "live":
+                raise MediaStreamError
+
+            try:
+                frame = self._frames.popleft()
+            except IndexError:
+                last = self._last_frame() if not self._started and self._last_frame is not None else None
+                if last is None:
+                    self._available.clear()
+                    await self._available.wait()
+                    continue
+                frame = last
+            self._started = True
+            return frame
+
+
+class BroadcastTrack:
+    """Feed frames captured once to every subscribed peer connection."""
+
+    def __init__(
+        self,
+        fps: int = 30,
+        queue_size: int = 2,
+        max_subscribers: int = 4,
+        output_size: Optional[Tuple[int, int]] = None,
+    ) -> None:
+        self._output_size = output_size
+        self._downscaler = _Downscaler()
+        self._queue_size = queue_size
+        self._max_subscribers = max_subscribers
+        self._subscribers: List[SubscriberTrack] = []
+        self._lock = threading.Lock()
+        self._sender_timer = AsyncTimer(fps)
+        self._start: Optional[float] = None
+        self._video_scale = (1.0, 1.0)
+        # NOTE: the latest frame for a new subscriber, or the latest image while nobody is watching,
+        # which is converted only once someone subscribes
+        self._last_frame: Optional[VideoFrame] = None
+        self._idle_image: Optional[numpy.ndarray] = None
+        self._idle_format = "rgb24"
+
+    @property
+    def active(self) -> bool:
+        with self._lock:
+            return any(s.active for s in self._subscribers)
+
+    @property
+    def video_scale(self) -> Tuple[float, float]:
+        """Horizontal and vertical scale of the latest frame against its captured image."""
+        return self._video_scale
+
+    @property
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return len(self._subscribers)
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of frames waiting for the slowest subscriber."""
+        with self._lock:
+            return max((len(s._frames) for s in self._subscribers), default=0)
+
+    @property
+    def dropped_frames(self) -> int:
+        with self._lock:
+            return sum(s.dropped_frames for s in self._subscribers)
+
+    def subscribe(self) -> SubscriberTrack:
+        with self._lock:
+            if len(self._subscribers) >= self._max_subscribers:
+                raise RuntimeError("too many subscribers: {}".format(len(self._subscribers)))
+
+            track = SubscriberTrack(self._queue_size, self._get_last_frame)
+            self._subscribers.append(track)
+            return track
+
+    def unsubscribe(self, track: SubscriberTrack) -> None:
+        with self._lock:
+            if track in self._subscribers:
+                self._subscribers.remove(track)
+        _logger.info("subscriber left (dropped_frames={})".format(track.dropped_frames))
+        track.stop()
+
+    def wait_for_next_put(self) -> None:
+        self._sender_timer.wait()
+
+    async def wait_for_next_put_async(self) -> None:
+        await self._sender_timer.wait_async()
+
+    @property
+    def sender_timer_stats(self) -> TimerStats:
+        return self._sender_timer.stats
+
+    def _convert(self, downscaler: _Downscaler, img: numpy.ndarray, format: str, convert_yuv: bool) -> VideoFrame:
+        current = time.monotonic()
+        if self._start is None:
+            self._start = current
+
+        # NOTE: A frame may stay in use by a slow peer for an unbounded time while the others go on,
+        # so frames are not recycled here.
+        start = time.perf_counter()
+        height, width = img.shape[:2]
+        size = (width, height) if self._output_size is None else fit_size(width, height, *self._output_size)
+        self._video_scale = (size[0] / width, size[1] / height)
+        if convert_yuv or size != (width, height):
+            frame = downscaler.scale(img, format, size[0], size[1])
+        else:
+            frame = VideoFrame(width, height, format)
+            numpy.copyto(_plane_view(frame, PACKED_FORMAT_CHANNELS[format]), img)
+        _CONVERT_SECONDS.observe(time.perf_counter() - start)
+        frame.pts = int((current - self._start) / VIDEO_TIME_BASE)
+        frame.time_base = VIDEO_TIME_BASE
+        return frame
+
+    def _get_last_frame(self) -> Optional[VideoFrame]:
+        with self._lock:
+            if self._last_frame is None and self._idle_image is not None:
+                # NOTE: called on the event loop, so the downscaler of the capture thread is not shared
+                self._last_frame = self._convert(_Downscaler(), self._idle_image, self._idle_format, True)
+            return self._last_frame
+
+    def put_frame(self, img: numpy.ndarray, format: str = "rgb24", convert_yuv: bool = False) -> None:
+        with self._lock:
+            subscribers = [s for s in self._subscribers if s.active and s.readyState == "live"]
+            if len(subscribers) == 0:
+                # NOTE: a damage-tracking or static-skipping capture may not send another image while
+                # the screen stays idle, so the latest one is kept for the next subscriber
+                if self._idle_image is None or self._idle_image.shape != img.shape:
+                    self._idle_image = numpy.empty_like(img)
+                numpy.copyto(self._idle_image, img)
+                self._idle_format = format
+                self._last_frame = None
+                return
+
+        frame = self._convert(self._downscaler, img, format, convert_yuv)
+        with self._lock:
+            self._last_frame = frame
+        for s in subscribers:
+            s._push(frame)
+
+
+FrameSink = Union[ScreenCaptureTrack, BroadcastTrack]
@@ -1,23 +1,81 @@
 import asyncio
 from typing import List
-import json
 import logging
-from typing import Optional
+import time
+from typing import Any, Optional, Sequence, Tuple, Union
 
-from aiortc import RTCConfiguration, RTCDataChannel, RTCIceServer, RTCPeerConnection
+from aiortc import RTCConfiguration, RTCDataChannel, RTCIceServer, RTCPeerConnection, RTCRtpCodecParameters
+from aiortc.codecs import get_encoder
+from av import VideoFrame
 
-from x2webrtc import models
+from x2webrtc import metrics, models
+from x2webrtc.adaptation import AdaptationController
 from x2webrtc.config import Config
-from x2webrtc.input import InputHandler
+from x2webrtc.cursor import CURSOR_PROTOCOL, CursorStream
+from x2webrtc.input import InputDispatcher
+from x2webrtc.plugin import SignalingPlugin
+from x2webrtc.relay import EncoderRelay
 from x2webrtc.signaling import get_signaling_method
-from x2webrtc.track import ScreenCaptureTrack
+from x2webrtc.tiles import TILE_PROTOCOL, TileStream
+from x2webrtc.track import ScreenCaptureTrack, SubscriberTrack
 
 _logger = logging.getLogger(__name__)
 
+_ENCODE_SECONDS = metrics.REGISTRY.histogram("x2webrtc_encode_seconds", "time to encode a video frame for a peer")
+
+
+class _TimedEncoder:
+    """Measure the encode time of the encoder used by a sender."""
+
+    def __init__(self, encoder: Any) -> None:
+        self._encoder = encoder
+
+    @property
+    def target_bitrate(self) -> Optional[int]:
+        return getattr(self._encoder, "target_bitrate", None)
+
+    @target_bitrate.setter
+    def target_bitrate(self, bitrate: int) -> None:
+        if hasattr(self._encoder, "target_bitrate"):
+            self._encoder.target_bitrate = bitrate
+
+    def encode(self, frame: VideoFrame, force_keyframe: bool = False) -> Tuple[List[bytes], int]:
+        start = time.perf_counter()
+        try:
+            return self._encoder.encode(frame, force_keyframe)
+        finally:
+            _ENCODE_SECONDS.observe(time.perf_counter() - start)
+
+
+def _attach_encode_timer(pc: RTCPeerConnection) -> None:
+    for transceiver in pc.getTransceivers():
+        if transceiver.kind != "video" or len(transceiver._codecs) == 0:
+            continue
+
+        sender: Any = transceiver.sender
+        codec: RTCRtpCodecParameters = transceiver._codecs[0]
+        # NOTE: the same trick as `EncoderRelay.attach`; wrap the encoder installed by the relay if any
+        encoder = getattr(sender, "_RTCRtpSender__encoder", None) or get_encoder(codec)
+        setattr(sender, "_RTCRtpSender__encoder", _TimedEncoder(encoder))
+
 
 class WebRTCClient:
-    def __init__(self, config: Config, track: ScreenCaptureTrack, input_handler: InputHandler):
+    def __init__(
+        self,
+        config: Config,
+        track: Union[ScreenCaptureTrack, SubscriberTrack],
+        input_dispatcher: InputDispatcher,
+        relay: Optional[EncoderRelay] = None,
+        adaptation: Optional[AdaptationController] = None,
+        signaling: Optional[SignalingPlugin] = None,
+        tiles: Optional[TileStream] = None,
+        cursor: Optional[CursorStream] = None,
+        extra_tracks: Sequence[ScreenCaptureTrack] = (),
+    ):
         self._config = config
+        self._signaling = signaling
+        self._relay = relay
+        self._adaptation = adaptation
 
         peer_connection_config = config.get_peer_connection_config()
         ice_servers: List[RTCIceServer] = [
@@ -25,17 +83,47 @@ class WebRTCClient:
         ]
         self._pc = RTCPeerConnection(RTCConfiguration(iceServers=ice_servers))
         self._track = track
-        self._input_handler = input_handler
+        self._input_dispatcher = input_dispatcher
 
         self._pc.addTrack(self._track)
-        self._control_channel: RTCDataChannel = self._pc.createDataChannel("control")
+        # NOTE: e.g., the other monitors; they share the stream of the first track
+        self._extra_tracks = list(extra_tracks)
+        for extra_track in self._extra_tracks:
+            self._pc.addTrack(extra_track)
+        # NOTE: The viewer sends binary messages only if it knows this protocol, and JSON otherwise
+        self._control_channel: RTCDataChannel = self._pc.createDataChannel("control", protocol=models.BINARY_PROTOCOL)
         self._control_channel.on("message", self._on_message)
+        # NOTE: A lost packet must not delay the following moves, so pointer motion has its own channel
+        # without retransmission or ordering. Button events stay on the reliable control channel.
+        self._motion_channel: RTCDataChannel = self._pc.createDataChannel(
+            "motion", ordered=False, maxRetransmits=0, protocol=models.BINARY_PROTOCOL
+        )
+        self._motion_channel.on("message", self._on_motion)
+        if tiles is not None:
+            # NOTE: Lossless tiles must all arrive in order, so the channel is reliable and ordered
+            tiles.attach(self._pc.createDataChannel("tiles", protocol=TILE_PROTOCOL))
+        if cursor is not None:
+            # NOTE: Cursor shapes are cached by the viewer and must arrive, but a lost position must not delay
+            # the following ones, just like pointer motion
+            cursor.attach(
+                self._pc.createDataChannel("cursor", protocol=CURSOR_PROTOCOL),
+                self._pc.createDataChannel(
+                    "cursor-position", ordered=False, maxRetransmits=0, protocol=CURSOR_PROTOCOL
+                ),
+            )
+        self._motion_seq: Optional[int] = None
+        self.stale_motions = 0
 
         self._lock = asyncio.Lock()
         self._connection_task: Optional[asyncio.Task[None]] = None
 
     async def _run(self):
         self._track.active = True
+        for extra_track in self._extra_tracks:
+            extra_track.active = True
+        adaptation_task: Optional["asyncio.Future[None]"] = None
+        if self._adaptation is not None:
+            adaptation_task = asyncio.ensure_future(self._adaptation.run())
         try:
             # TODO(igarashi): Handle connection closed
             while True:
@@ -47,27 +135,50 @@ class WebRTCClient:
         except asyncio.CancelledError:
             _logger.warn("operation cancelled")
         finally:
+            if adaptation_task is not None:
+                adaptation_task.cancel()
+            _logger.info("dropped {} stale motions".format(self.stale_motions))
             self._connection_task = None
             self._track.active = False
+            for extra_track in self._extra_tracks:
+                extra_track.active = False
             await self._pc.close()
 
-    def _on_message(self, message_str: str) -> None:
-        try:
-            data = json.loads(message_str)
-            message = models.from_dict(data)
-            if isinstance(message, models.InputReport):
-                self._input_handler.send(message)
+    def _on_message(self, message: Union[str, bytes]) -> None:
+        # NOTE: Parsing and X requests are made on the input thread, so that they never stall the event loop
+        self._input_dispatcher.put(message)
 
+    def _on_motion(self, message: Union[str, bytes]) -> None:
+        try:
+            if not isinstance(message, bytes):
+                raise RuntimeError("motion must be a binary message")
+            seq, event = models.from_binary_motion(message)
         except Exception:
-            _logger.exception("got an unexpected exception")
+            _logger.exception("got an invalid motion")
+            return
+
+        if self._motion_seq is not None and not models.is_newer_seq(seq, self._motion_seq):
+            self.stale_motions += 1
+            return
+
+        self._motion_seq = seq
+        self._input_dispatcher.put(models.InputReport([event]))
 
     async def _establish_connection(self):
         loop = asyncio.get_event_loop()
-        signaling = get_signaling_method(self._config.signaling_plugin)
+        signaling = self._signaling
+        if signaling is None:
+            signaling = get_signaling_method(self._config.signaling_plugin)
         ret = await signaling(self._pc)
         if not ret:
             raise RuntimeError("signaling failed: failed to establish connection")
 
+        if self._relay is not None:
+            self._relay.attach(self._pc)
+        _attach_encode_timer(self._pc)
+        if self._adaptation is not None:
+            self._adaptation.attach(self._pc)
+
         self._connection_task = loop.create_task(self._run())
 
     async def connect(self) -> None:
@@ -7,8 +7,14 @@ export class WebRTCClient {
 
     private screen: MediaStreamScreen;
 
-    constructor(screen: MediaStreamScreen) {
+    // NOTE: creates a screen for each video track after the first one (e.g., the other monitors)
+    private createExtraScreen: () => MediaStreamScreen;
+
+    private hasMainTrack: boolean = false;
+
+    constructor(screen: MediaStreamScreen, createExtraScreen: () => MediaStreamScreen = null) {
         this.screen = screen;
+        this.createExtraScreen = createExtraScreen;
 
         this.pc = new RTCPeerConnection({
             iceServers: [
@@ -37,14 +43,37 @@ export class WebRTCClient {
         }
 
         const stream = streams[0];
+        // NOTE: every monitor is a video track of the same stream; the first one is shown on the main screen,
+        // which sends input, and the others are shown on extra screens
+        const trackStream = new MediaStream([event.track]);
+        if (this.hasMainTrack) {
+            if (this.createExtraScreen !== null) {
+                this.createExtraScreen().SetupMediaStream(trackStream);
+            }
+            return;
+        }
+
+        this.hasMainTrack = true;
         stream.onremovetrack = (e) => {
             alert("Disconnected");
         };
-        this.screen.SetupMediaStream(stream);
+        this.screen.SetupMediaStream(trackStream);
     }
 
     private onDataChannel(event: RTCDataChannelEvent): void {
         const channel = event.channel;
+        if (channel.label === "motion") {
+            this.screen.SetupMotionChannel(channel);
+            return;
+        }
+        if (channel.label === "tiles") {
+            this.screen.SetupTileChannel(channel);
+            return;
+        }
+        if (channel.label === "cursor" || channel.label === "cursor-position") {
+            this.screen.SetupCursorChannel(channel);
+            return;
+        }
         if (channel.label !== "control") {
             console.error(`Unknown datachannel opened: ${channel.label}`);
             return;
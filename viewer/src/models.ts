@@ -35,7 +35,33 @@ export class MouseButtonEvent {
 
 }
 
-export type ScreenEvent = MouseMoveEvent | MouseButtonEvent;
+export class KeyEvent {
+    kind: "key";
+    // NOTE: `KeyboardEvent.code`, which names a physical key
+    code: string;
+    event_kind: ButtonEventKind;
+
+    constructor(code: string, event: ButtonEventKind) {
+        this.kind = "key";
+        this.code = code;
+        this.event_kind = event;
+    }
+}
+
+export class WheelEvent {
+    kind: "wheel";
+    // NOTE: in steps; positive values scroll right and down
+    delta_x: number;
+    delta_y: number;
+
+    constructor(deltaX: number, deltaY: number) {
+        this.kind = "wheel";
+        this.delta_x = deltaX < 0 ? Math.ceil(deltaX) : Math.floor(deltaX);
+        this.delta_y = deltaY < 0 ? Math.ceil(deltaY) : Math.floor(deltaY);
+    }
+}
+
+export type ScreenEvent = MouseMoveEvent | MouseButtonEvent | KeyEvent | WheelEvent;
 
 export class InputReport {
     kind: "input";
@@ -46,3 +72,164 @@ export class InputReport {
         this.events = events;
     }
 }
+
+// NOTE: The client accepts the binary format when it creates the data channel with this protocol.
+// A message is a header (version, number of events) followed by fixed-size event records of
+// (event type, button, button event kind, x, y, timestamp in milliseconds), all in little endian.
+export const BinaryProtocol = "x2webrtc-binary-1";
+
+const BinaryVersion = 1;
+const BinaryHeaderSize = 4;
+const BinaryEventSize = 12;
+
+enum BinaryEventType {
+    MouseMove = 0,
+    MouseButton = 1,
+}
+
+const X11Buttons: { [kind in MouseButtonKind]: number } = {
+    [MouseButtonKind.Left]: 1,
+    [MouseButtonKind.Middle]: 2,
+    [MouseButtonKind.Right]: 3,
+};
+
+// NOTE: Reports including keys or wheels are sent in JSON
+export function canEncodeBinary(report: InputReport): boolean {
+    return report.events.every(ev => ev.kind === "mouse-move" || ev.kind === "mouse-button");
+}
+
+export function encodeBinary(report: InputReport, timestamp: number): ArrayBuffer {
+    const buf = new ArrayBuffer(BinaryHeaderSize + BinaryEventSize * report.events.length);
+    const view = new DataView(buf);
+    view.setUint8(0, BinaryVersion);
+    view.setUint16(2, report.events.length, true);
+
+    let offset = BinaryHeaderSize;
+    for (const ev of report.events) {
+        if (ev.kind === "mouse-move") {
+            view.setUint8(offset, BinaryEventType.MouseMove);
+            view.setUint16(offset + 4, ev.x, true);
+            view.setUint16(offset + 6, ev.y, true);
+        } else if (ev.kind === "mouse-button") {
+            view.setUint8(offset, BinaryEventType.MouseButton);
+            view.setUint8(offset + 1, X11Buttons[ev.button_kind]);
+            view.setUint8(offset + 2, ev.event_kind);
+        }
+        view.setUint32(offset + 8, timestamp >>> 0, true);
+        offset += BinaryEventSize;
+    }
+    return buf;
+}
+
+// NOTE: Pointer motion is sent on the unreliable "motion" channel, one message per move, as
+// (version, sequence number, x, y, timestamp in milliseconds) in little endian.
+// The client drops a move older than the latest one it has received.
+const BinaryMotionSize = 16;
+
+export function encodeBinaryMotion(seq: number, ev: MouseMoveEvent, timestamp: number): ArrayBuffer {
+    const buf = new ArrayBuffer(BinaryMotionSize);
+    const view = new DataView(buf);
+    view.setUint8(0, BinaryVersion);
+    view.setUint32(4, seq >>> 0, true);
+    view.setUint16(8, ev.x, true);
+    view.setUint16(10, ev.y, true);
+    view.setUint32(12, timestamp >>> 0, true);
+    return buf;
+}
+
+// NOTE: Lossless tiles of the screen arrive on the "tiles" channel, one message per tile, as
+// (version, screen width, screen height, x, y, width, height) in little endian followed by a PNG image.
+export const TileProtocol = "x2webrtc-tiles-1";
+
+const TileVersion = 1;
+const TileHeaderSize = 14;
+
+export interface Tile {
+    screenWidth: number;
+    screenHeight: number;
+    x: number;
+    y: number;
+    width: number;
+    height: number;
+    image: Blob;
+}
+
+export function decodeTile(data: ArrayBuffer): Tile {
+    const view = new DataView(data);
+    if (data.byteLength < TileHeaderSize || view.getUint8(0) !== TileVersion) {
+        return null;
+    }
+
+    return {
+        screenWidth: view.getUint16(2, true),
+        screenHeight: view.getUint16(4, true),
+        x: view.getUint16(6, true),
+        y: view.getUint16(8, true),
+        width: view.getUint16(10, true),
+        height: view.getUint16(12, true),
+        image: new Blob([data.slice(TileHeaderSize)], { type: "image/png" }),
+    };
+}
+
+// NOTE: Shapes arrive on the reliable "cursor" channel, and positions on the unordered "cursor-position"
+// channel without retransmits. Every message starts with (version, kind) in little endian. A shape message
+// continues with (serial, width, height, hotspot x, hotspot y) and a PNG image, which is sent once per
+// serial, and a position message with (sequence number, serial of the shape, signed x, signed y).
+export const CursorProtocol = "x2webrtc-cursor-2";
+
+const CursorVersion = 2;
+const CursorShapeHeaderSize = 16;
+const CursorPositionSize = 12;
+
+export interface CursorShape {
+    kind: "shape";
+    serial: number;
+    xhot: number;
+    yhot: number;
+    image: Blob;
+}
+
+export interface CursorPosition {
+    kind: "position";
+    seq: number;
+    serial: number;
+    x: number;
+    y: number;
+}
+
+export function decodeCursorMessage(data: ArrayBuffer): CursorShape | CursorPosition {
+    const view = new DataView(data);
+    if (data.byteLength < CursorPositionSize || view.getUint8(0) !== CursorVersion) {
+        return null;
+    }
+
+    const serial = view.getUint32(4, true);
+    switch (view.getUint8(1)) {
+        case 0:
+            if (data.byteLength < CursorShapeHeaderSize) {
+                return null;
+            }
+            return {
+                kind: "shape",
+                serial: serial,
+                xhot: view.getUint16(12, true),
+                yhot: view.getUint16(14, true),
+                image: new Blob([data.slice(CursorShapeHeaderSize)], { type: "image/png" }),
+            };
+        case 1:
+            return {
+                kind: "position",
+                seq: view.getUint16(2, true),
+                serial: serial,
+                x: view.getInt16(8, true),
+                y: view.getInt16(10, true),
+            };
+    }
+    return null;
+}
+
+// NOTE: serial number arithmetic (RFC 1982) on the 16-bit sequence numbers of cursor positions
+export function isNewerCursorSeq(seq: number, last: number): boolean {
+    const delta = (seq - last) & 0xFFFF;
+    return 0 < delta && delta < 0x8000;
+}
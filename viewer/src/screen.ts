@@ -1,4 +1,4 @@
-import { InputReport, ScreenEvent, MouseMoveEvent, MouseButtonEvent, MouseButtonKind, ButtonEventKind } from "./models";
+import { InputReport, ScreenEvent, MouseMoveEvent, MouseButtonEvent, MouseButtonKind, ButtonEventKind, KeyEvent, WheelEvent as ScreenWheelEvent, BinaryProtocol, canEncodeBinary, encodeBinary, encodeBinaryMotion, TileProtocol, Tile, decodeTile, CursorProtocol, CursorPosition, decodeCursorMessage, isNewerCursorSeq } from "./models";
 
 
 export class MediaStreamScreen {
@@ -7,6 +7,11 @@ export class MediaStreamScreen {
 
     public readonly MouseMoveThrottleTime: number = 50;
 
+    // NOTE: pixels of `WheelEvent.deltaY` (and deltaX) per wheel step
+    public readonly WheelStepPixels: number = 100;
+
+    public readonly WheelStepLines: number = 3;
+
     private canvas: HTMLCanvasElement;
 
     private ctx: CanvasRenderingContext2D;
@@ -15,8 +20,33 @@ export class MediaStreamScreen {
 
     private dataChannel: RTCDataChannel = null;
 
+    private motionChannel: RTCDataChannel = null;
+
+    private motionSeq: number = 0;
+
     private mediaStream: MediaStream = null;
 
+    // NOTE: milliseconds a tile has to stay unchanged before it is drawn over the video; the video
+    // shows the regions that are changing, and the lossless tiles sharpen them once they settle
+    public readonly TileSettleTime: number = 200;
+
+    // NOTE: lossless tiles are composited here in screen pixels
+    private tileCanvas: HTMLCanvasElement = null;
+
+    private tileCtx: CanvasRenderingContext2D = null;
+
+    // NOTE: the latest tiles by their position, with the time each one was updated
+    private tiles: Map<string, { x: number, y: number, width: number, height: number, updatedAt: number }> = new Map();
+
+    private tileQueue: Promise<void> = Promise.resolve();
+
+    // NOTE: cursor shapes by their serial, drawn over the screen at the latest position
+    private cursorShapes: { [serial: number]: { image: ImageBitmap, xhot: number, yhot: number } } = {};
+
+    private cursorPosition: CursorPosition = null;
+
+    private cursorQueue: Promise<void> = Promise.resolve();
+
     private started: boolean = false;
 
     private sendReportIntervalId: number;
@@ -25,6 +55,10 @@ export class MediaStreamScreen {
 
     private mouseMoveThrottle: number = null;
 
+    private wheelDeltaX: number = 0;
+
+    private wheelDeltaY: number = 0;
+
     constructor(canvas: HTMLCanvasElement) {
         this.canvas = canvas;
         this.ctx = canvas.getContext("2d");
@@ -32,6 +66,11 @@ export class MediaStreamScreen {
         this.canvas.addEventListener("mousedown", this.canvasMouseDown);
         this.canvas.addEventListener("mouseup", this.canvasMouseUp);
         this.canvas.addEventListener("mousemove", this.canvasMouseMove);
+        this.canvas.addEventListener("wheel", this.canvasWheel);
+        this.canvas.addEventListener("keydown", this.canvasKeyDown);
+        this.canvas.addEventListener("keyup", this.canvasKeyUp);
+        // NOTE: a canvas receives keyboard events only if it is focusable
+        this.canvas.tabIndex = 0;
         this.canvas.addEventListener("contextmenu", (e) => {
             e.preventDefault();
         });
@@ -57,8 +96,13 @@ export class MediaStreamScreen {
         if (toSend.length == 0) return;
 
         const report = new InputReport(toSend);
-        const json = JSON.stringify(report);
-        this.dataChannel.send(json);
+        // NOTE: Fall back to JSON if the client does not accept the binary format
+        if (this.dataChannel.protocol === BinaryProtocol && canEncodeBinary(report)) {
+            this.dataChannel.send(encodeBinary(report, Math.floor(performance.now())));
+        } else {
+            const json = JSON.stringify(report);
+            this.dataChannel.send(json);
+        }
     }
 
     private getScreenPixel = (e: MouseEvent): { x: number, y: number } => {
@@ -88,6 +132,8 @@ export class MediaStreamScreen {
         const { x, y } = this.getScreenPixel(e);
         this.eventQueue.push(new MouseMoveEvent(x, y));
         this.eventQueue.push(new MouseButtonEvent(this.getMouseButtonKind(e), ButtonEventKind.ButtonDown));
+        // NOTE: Moves on the motion channel are not delayed, so button events must not wait for the next interval
+        this.sendReport();
     }
 
     private canvasMouseUp = (e: MouseEvent) => {
@@ -96,6 +142,8 @@ export class MediaStreamScreen {
         const { x, y } = this.getScreenPixel(e);
         this.eventQueue.push(new MouseMoveEvent(x, y));
         this.eventQueue.push(new MouseButtonEvent(this.getMouseButtonKind(e), ButtonEventKind.ButtonUp));
+        // NOTE: Moves on the motion channel are not delayed, so button events must not wait for the next interval
+        this.sendReport();
     }
 
     private canvasMouseMove = (e: MouseEvent) => {
@@ -108,14 +156,75 @@ export class MediaStreamScreen {
             this.mouseMoveThrottle = null;
         }, this.MouseMoveThrottleTime);
         const { x, y } = this.getScreenPixel(e);
-        this.eventQueue.push(new MouseMoveEvent(x, y));
+        const ev = new MouseMoveEvent(x, y);
+        // NOTE: Send moves right away on the unreliable channel if available, so that a lost packet
+        // never delays the following input
+        if (this.motionChannel != null && this.motionChannel.readyState === "open") {
+            this.motionSeq = (this.motionSeq + 1) >>> 0;
+            this.motionChannel.send(encodeBinaryMotion(this.motionSeq, ev, Math.floor(performance.now())));
+            return;
+        }
+        this.eventQueue.push(ev);
+    }
+
+    private canvasWheel = (e: WheelEvent) => {
+        if (!this.started) return;
+
+        e.preventDefault();
+        const scale = e.deltaMode === 0 ? 1 / this.WheelStepPixels : e.deltaMode === 1 ? 1 / this.WheelStepLines : 1;
+        this.wheelDeltaX += e.deltaX * scale;
+        this.wheelDeltaY += e.deltaY * scale;
+
+        // NOTE: keep fractions of steps for the next event, so that smooth scrolling is not lost
+        const ev = new ScreenWheelEvent(this.wheelDeltaX, this.wheelDeltaY);
+        if (ev.delta_x === 0 && ev.delta_y === 0) return;
+        this.wheelDeltaX -= ev.delta_x;
+        this.wheelDeltaY -= ev.delta_y;
+        this.eventQueue.push(ev);
+    }
+
+    private canvasKeyDown = (e: KeyboardEvent) => {
+        if (!this.started) return;
+
+        e.preventDefault();
+        // NOTE: the X server repeats a held key by itself
+        if (e.repeat) return;
+        this.eventQueue.push(new KeyEvent(e.code, ButtonEventKind.ButtonDown));
+        this.sendReport();
+    }
+
+    private canvasKeyUp = (e: KeyboardEvent) => {
+        if (!this.started) return;
+
+        e.preventDefault();
+        this.eventQueue.push(new KeyEvent(e.code, ButtonEventKind.ButtonUp));
+        this.sendReport();
     }
 
     private updateFrameByVideo = () => {
         this.ctx.drawImage(this.video, 0, 0);
+        this.drawTiles();
+        this.drawCursor();
         window.requestAnimationFrame(this.updateFrameByVideo);
     }
 
+    private drawTiles() {
+        if (this.tileCanvas === null) {
+            return;
+        }
+        // NOTE: the video may be scaled down from the screen
+        const sx = this.canvas.width / this.tileCanvas.width;
+        const sy = this.canvas.height / this.tileCanvas.height;
+        const settled = performance.now() - this.TileSettleTime;
+        this.tiles.forEach((tile) => {
+            if (tile.updatedAt > settled) return;
+            this.ctx.drawImage(
+                this.tileCanvas, tile.x, tile.y, tile.width, tile.height,
+                tile.x * sx, tile.y * sy, tile.width * sx, tile.height * sy,
+            );
+        });
+    }
+
     private updateCanvasSize() {
         this.canvas.width = this.video.videoWidth;
         this.canvas.height = this.video.videoHeight;
@@ -130,6 +239,100 @@ export class MediaStreamScreen {
         this.dataChannel = channel;
     }
 
+    public SetupMotionChannel(channel: RTCDataChannel) {
+        if (channel.protocol !== BinaryProtocol) {
+            console.error(`Unknown motion protocol: ${channel.protocol}`);
+            return;
+        }
+        this.motionChannel = channel;
+    }
+
+    public SetupTileChannel(channel: RTCDataChannel) {
+        if (channel.protocol !== TileProtocol) {
+            console.error(`Unknown tile protocol: ${channel.protocol}`);
+            return;
+        }
+        channel.binaryType = "arraybuffer";
+        channel.onmessage = (e: MessageEvent) => {
+            const tile = decodeTile(e.data);
+            if (tile === null) {
+                console.error("Invalid tile");
+                return;
+            }
+            // NOTE: tiles are decoded in parallel but drawn in the order they arrived
+            const decoded = createImageBitmap(tile.image);
+            this.tileQueue = this.tileQueue.then(() => decoded).then(
+                (image) => this.drawTile(tile, image),
+                (err) => console.error(err),
+            );
+        };
+        channel.onclose = (e) => {
+            this.tileCanvas = null;
+            this.tileCtx = null;
+            this.tiles.clear();
+        };
+    }
+
+    private drawTile(tile: Tile, image: ImageBitmap) {
+        if (this.tileCanvas === null || this.tileCanvas.width !== tile.screenWidth || this.tileCanvas.height !== tile.screenHeight) {
+            this.tileCanvas = document.createElement("canvas");
+            this.tileCanvas.width = tile.screenWidth;
+            this.tileCanvas.height = tile.screenHeight;
+            this.tileCtx = this.tileCanvas.getContext("2d");
+            this.tiles.clear();
+        }
+        this.tileCtx.drawImage(image, tile.x, tile.y);
+        image.close();
+        this.tiles.set(`${tile.x},${tile.y}`, {
+            x: tile.x, y: tile.y, width: tile.width, height: tile.height, updatedAt: performance.now(),
+        });
+    }
+
+    // NOTE: used for both the shape and the position channels of the cursor
+    public SetupCursorChannel(channel: RTCDataChannel) {
+        if (channel.protocol !== CursorProtocol) {
+            console.error(`Unknown cursor protocol: ${channel.protocol}`);
+            return;
+        }
+        channel.binaryType = "arraybuffer";
+        channel.onmessage = (e: MessageEvent) => {
+            const message = decodeCursorMessage(e.data);
+            if (message === null) {
+                console.error("Invalid cursor message");
+                return;
+            }
+            if (message.kind === "shape") {
+                const decoded = createImageBitmap(message.image);
+                this.cursorQueue = this.cursorQueue.then(() => decoded).then(
+                    (image) => {
+                        this.cursorShapes[message.serial] = { image: image, xhot: message.xhot, yhot: message.yhot };
+                    },
+                    (err) => console.error(err),
+                );
+            } else {
+                // NOTE: positions may arrive out of order
+                if (this.cursorPosition !== null && !isNewerCursorSeq(message.seq, this.cursorPosition.seq)) return;
+                this.cursorPosition = message;
+            }
+        };
+        channel.onclose = (e) => {
+            this.cursorShapes = {};
+            this.cursorPosition = null;
+        };
+    }
+
+    private drawCursor() {
+        const position = this.cursorPosition;
+        if (position === null) {
+            return;
+        }
+        const shape = this.cursorShapes[position.serial];
+        if (shape === undefined) {
+            return;
+        }
+        this.ctx.drawImage(shape.image, position.x - shape.xhot, position.y - shape.yhot);
+    }
+
     public StartReport = () => {
         if (this.started)
             return;
@@ -144,6 +347,7 @@ export class MediaStreamScreen {
             return;
 
         this.dataChannel = null;
+        this.motionChannel = null;
         this.mediaStream = null;
         window.clearInterval(this.sendReportIntervalId);
         this.started = false;
@@ -7,7 +7,12 @@ import { MediaStreamScreen } from "./screen";
 
 const canvas = <HTMLCanvasElement>document.getElementById("screen-canvas");
 const screen = new MediaStreamScreen(canvas);
-const client = new WebRTCClient(screen);
+const client = new WebRTCClient(screen, () => {
+    const extraCanvas = document.createElement("canvas");
+    extraCanvas.className = "extra-screen-canvas";
+    canvas.parentElement.appendChild(extraCanvas);
+    return new MediaStreamScreen(extraCanvas);
+});
 
 
 $(() => {